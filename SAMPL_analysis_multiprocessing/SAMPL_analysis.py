@@ -8,57 +8,162 @@
 - How to use it
     After running the script, user needs to follow instructions and specify data directory and frame rate using CLI
     Erros may occur if any of the .dlm files to be analyzed lacks a "alignable" swim bout. If this happens, please delete this .dlm file (which is usually unreasonably small) and rerun the script.
+    Results of each .dlm file are saved under <folder>/dlm results/. When rerun, .dlm files analyzed before with the same settings are skipped.
+    To find problem .dlm files before analysis, use if_scan=True or preprocessing.scan_dlm.scan_root(), which saves SAMPL scan report.csv.
+    If the root directory has SAMPL data manifest.csv (see SAMPL_dataARR), .dlm files are analyzed where they are and results are saved under <root>/<condition>/<exp>.
+    To analyze new .dlm files as they are recorded, without prompts, use SAMPL_watch.py.
     An "aligned" swim bout contains data 500ms before and 300ms after the time of the peak speed.
     After running the script, pease refer to catalog.csv fiels for descriptions of the data extracted. A copy of catalog fiels can be found under <docs> folder.
 - Requirments
     Please refer to the README file for required packages
 '''
 import sys
-import os,glob
+import os
+import sqlite3
 from bout_analysis import grab_fish_angle_v5
-from bout_analysis.logger import log_SAMPL_ana
-from tqdm import tqdm
+from bout_analysis.logger import log_SAMPL_ana, start_log_listener, stop_log_listener
+from preprocessing.data_manifest import DATA_MANIFEST, get_dlm_folders
+from preprocessing.scan_dlm import SCAN_REPORT, scan_files
+from bout_analysis.recording_index import INDEX_FILE, update_recording_index
+from bout_analysis.staging import DEFAULT_STAGE_BUDGET_MB, run_staged
 import time
 
-def SAMPL_analysis_mp(root,frame_rate, if_epoch_data=False, if_multiprocessing=True):
-    """Analyze behavior data. Extract bouts. Align bouts.
+def get_dlm_input(root, frame_rate, if_epoch_data=False, if_epoch_float32=False, chunk_rows=None, n_shards=None, if_telemetry=False):
+    """find folders with .dlm files under root. If root has SAMPL data manifest.csv, experiment folders and their .dlm files are also read from it, see preprocessing/data_manifest.py
 
     Args:
-        root (string): directory of behavior data to be analyzed. Data in all subfolders of the root directory will be analyzed. .dlm files in the same folder will be combined for bout extraction.
-        frame_rate (int): Frame rate 
+        root (string): directory of behavior data to be analyzed
+        frame_rate (int): Frame rate
+        other args: see SAMPL_analysis_mp()
+
+    Returns:
+        list: arguments of grab_fish_angle_v5.run() for each folder
+    """
+    dlm_input = []
+    folders, missing = get_dlm_folders(root)
+    if missing:
+        log_SAMPL_ana('SAMPL_ana_log').warning(f"{len(missing)} .dlm files in {DATA_MANIFEST} not found, e.g. {missing[0]}")
+    for folder, new_dlm_paths in folders:
+        # experiment folders of a data manifest may not exist yet
+        os.makedirs(folder, exist_ok=True)
+        dlm_input.append((new_dlm_paths, folder, frame_rate, if_epoch_data, if_epoch_float32, chunk_rows, n_shards, if_telemetry))
+    return dlm_input
+
+def scan_dlm_input(dlm_input, report_dir, if_multiprocessing=True):
+    """scan .dlm files before analysis and save SAMPL scan report.csv, see preprocessing/scan_dlm.py. Unreadable files are not analyzed
+
+    Args:
+        dlm_input (list): output of get_dlm_input()
+        report_dir (string): folder to save the report
+        if_multiprocessing (bool, optional): whether to scan files in parallel. Defaults to True.
+
+    Returns:
+        list: dlm_input without unreadable files
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    filenames = [file for filenames, *_ in dlm_input for file in filenames]
+    frame_rates = [frame_rate for filenames, _, frame_rate, *_ in dlm_input for _ in filenames]
+    tic = time.time()
+    scan = scan_files(filenames, frame_rates, if_multiprocessing)
+    scan.to_csv(os.path.join(report_dir, SCAN_REPORT))
+    logger.info(f"Scan: {len(scan)} .dlm files in {time.time()-tic:.1f}s. " + ', '.join(f"{status} {n}" for status, n in scan['status'].value_counts().items()))
+    for _, row in scan.loc[scan['status'].isin(['unreadable','likely_skipped'])].iterrows():
+        logger.warning(f"Scan: {row['status']}, {row['reason']}: {row['file']}", extra={'folder':row['folder'], 'file':row['file'], 'stage':'scan'})
+    unreadable = set(scan.loc[scan['status'] == 'unreadable', 'file'])
+    scanned_input = []
+    for filenames, *folder_args in dlm_input:
+        filenames = [file for file in filenames if file not in unreadable]
+        if filenames:
+            scanned_input.append((filenames, *folder_args))
+    return scanned_input
+
+def SAMPL_analysis_batch(jobs, if_epoch_data=False, if_multiprocessing=True, if_epoch_float32=False, chunk_rows=None, n_shards=None, if_resume=True, if_telemetry=False, log_dir=None, report_dir=None, memory_budget_MB=None, max_retries=1, task_timeout_s=None, if_scan=False, if_prefetch=False, scratch_dir=None, stage_budget_MB=DEFAULT_STAGE_BUDGET_MB, root_log_dirs=None):
+    """Analyze behavior data of multiple root directories. .dlm files of all roots are analyzed in one pool, largest first,
+    so that the next root doesn't wait for the slowest folder of the previous one. Each folder is merged as soon as its .dlm files are analyzed.
+
+    Args:
+        jobs (list): tuples of (root, frame_rate)
+        report_dir (string, optional): folder to save SAMPL schedule, failures and scan reports. Defaults to None (log_dir or the current directory).
+        root_log_dirs (dict, optional): root: folder to also save log files of the root, with records of its folders. Records of all roots are saved to log_dir. Defaults to None.
+        other args: see SAMPL_analysis_mp()
     """
+    # all processes log through one listener
+    log_queue, log_listener = start_log_listener(log_dir, root_log_dirs=root_log_dirs)
     logger = log_SAMPL_ana('SAMPL_ana_log')
     logger.info(f"Analysis Started!")
-    logger.info(f"Root dir: {root}")
-    logger.info(f"Frame Rate: {frame_rate}")
-    # for progress bar and time estimation (2022.0126 update)
-    # dlm_parent_folders = []
-    dlm_directories = []
     dlm_input = []
-    new_dlm_paths = []
-    for parent_path, _, files in os.walk(root):
-        files.sort()
-        if len([dlm_files for dlm_files in files if ".dlm" in dlm_files]) > 0:
-            new_dlm_paths = ([os.path.join(parent_path, dlm_files) for dlm_files in files if ".dlm" in dlm_files])
-        if new_dlm_paths:
-            # dlm_parent_folders.append(parent_path)
-            dlm_directories.extend(new_dlm_paths)
-            dlm_input.append((new_dlm_paths, parent_path, frame_rate, if_epoch_data))
+    for root, frame_rate in jobs:
+        logger.info(f"Root dir: {root}")
+        logger.info(f"Frame Rate: {frame_rate}")
+        # folders under more than one root (e.g. a root and its subfolder) are analyzed once
+        analyzed_folders = {folder for _, folder, *_ in dlm_input}
+        dlm_input.extend(folder_input for folder_input in get_dlm_input(root, frame_rate, if_epoch_data, if_epoch_float32, chunk_rows, n_shards, if_telemetry)
+                         if folder_input[1] not in analyzed_folders)
+    report_dir = report_dir or log_dir or os.getcwd()
         
-    if if_multiprocessing and len(dlm_directories) > 5:
-        grab_fish_angle_v5.runMP(dlm_input)
+    try:
+        if if_scan:
+            dlm_input = scan_dlm_input(dlm_input, report_dir, if_multiprocessing)
+        dlm_file_num = sum(len(filenames) for filenames, *_ in dlm_input)
+
+        def run_analysis(dlm_input, report_dir):
+            if if_multiprocessing and dlm_file_num > 5 and not n_shards:  # epoch shards use their own process pool, which can't be started inside runMP workers
+                # .dlm files are analyzed largest first. predicted vs actual time of each file saved in report_dir
+                grab_fish_angle_v5.runMP(dlm_input, report_dir=report_dir, if_resume=if_resume, log_queue=log_queue, memory_budget_MB=memory_budget_MB,
+                                         max_retries=max_retries, task_timeout_s=task_timeout_s)
 
-    else:
-        with tqdm(total=len(dlm_input)) as pbar:  
-            for filenames, root, frame_rate, if_epoch_data in dlm_input:
-                # print(f"\n\n- In {root}")
-                grab_fish_angle_v5.run(filenames, root, frame_rate, if_epoch_data)
-                pbar.update(1)
+            else:
+                grab_fish_angle_v5.runSP(dlm_input, if_resume=if_resume, report_dir=report_dir, max_retries=max_retries, if_prefetch=if_prefetch)
+
+        if scratch_dir:
+            # folders are analyzed in waves copied to local scratch, outputs synced back after each wave
+            run_staged(dlm_input, run_analysis, scratch_dir, stage_budget_MB, report_dir)
+        else:
+            run_analysis(dlm_input, report_dir)
+        for root in dict.fromkeys(root for root, _ in jobs):
+            # index of recordings, parameters and analysis status, see bout_analysis/recording_index.py
+            try:
+                n_updated, n_removed = update_recording_index(root)
+                logger.info(f"{INDEX_FILE} of {root}: {n_updated} recordings updated, {n_removed} removed")
+            except (sqlite3.Error, OSError) as error:
+                logger.warning(f"{INDEX_FILE} of {root} not updated: {error}")
+    finally:
+        stop_log_listener(log_listener)
+
+def SAMPL_analysis_mp(root,frame_rate, if_epoch_data=False, if_multiprocessing=True, if_epoch_float32=False, chunk_rows=None, n_shards=None, if_resume=True, if_telemetry=False, log_dir=None, memory_budget_MB=None, max_retries=1, task_timeout_s=None, if_scan=False, if_prefetch=False, scratch_dir=None, stage_budget_MB=DEFAULT_STAGE_BUDGET_MB):
+    """Analyze behavior data. Extract bouts. Align bouts.
+
+    Args:
+        root (string): directory of behavior data to be analyzed. Data in all subfolders of the root directory will be analyzed. .dlm files in the same folder will be combined for bout extraction.
+        frame_rate (int): Frame rate 
+        if_epoch_data (bool, optional): whether to save epoch data (all_data.h5). Defaults to False.
+        if_multiprocessing (bool, optional): whether to analyze .dlm files in parallel. Results of each .dlm are saved under <folder>/dlm results/ and merged by folder. Defaults to True.
+        if_epoch_float32 (bool, optional): whether to save float columns of epoch data as float32. Defaults to False.
+        chunk_rows (int, optional): read and analyze each .dlm in chunks of complete epochs of about chunk_rows rows, for recordings too large to fit in memory. Defaults to None (whole file).
+        n_shards (int, optional): split epochs of each .dlm into n_shards and analyze them in parallel, for folders with a few very long .dlm files. Folders are then analyzed one by one. Defaults to None.
+        if_resume (bool, optional): whether to skip .dlm files analyzed before with the same versions and settings, e.g. when rerunning after a crash. Only changed files are analyzed, all folders are merged again. Defaults to True.
+        if_telemetry (bool, optional): whether to record time, CPU time and peak memory of each analysis stage. Saved as analysis telemetry.csv/.json in each folder. Defaults to False.
+        log_dir (string, optional): folder to save SAMPL_ana_log.log and SAMPL_ana_log.jsonl (structured records). Defaults to None (current directory).
+        memory_budget_MB (float, optional): memory available to multiprocessing workers, in MB, e.g. on shared analysis nodes. Files are started only while their estimated memory fits, and fewer files run at a time when memory use nears the budget. Defaults to None (one file per CPU).
+        max_retries (int, optional): number of retries of a .dlm file or folder that failed. Failed files are skipped, logged with the traceback and saved to SAMPL failures report.csv in root, so one bad file doesn't stop the run. Defaults to 1.
+        task_timeout_s (float, optional): time limit of each .dlm file or folder merge in seconds when multiprocessing. The worker is stopped and the task counts as failed. Defaults to None (no limit).
+        if_scan (bool, optional): whether to scan .dlm files before analysis, see preprocessing/scan_dlm.py. Problem files are logged and listed in SAMPL scan report.csv in root. Unreadable files are not analyzed. Defaults to False.
+        if_prefetch (bool, optional): whether to read the next .dlm files and write results in background threads while the current file is analyzed, when files are analyzed one by one (if_multiprocessing=False, 5 files or fewer, or n_shards). Helps with data on network volumes. Defaults to False.
+        scratch_dir (string, optional): local directory (e.g. SSD) to stage folders on network volumes. Folders are copied to scratch in waves while the previous wave is analyzed, and outputs are synced back after each wave, see bout_analysis/staging.py. Defaults to None (analyzed in place).
+        stage_budget_MB (float, optional): scratch space for .dlm files, in MB. Each wave takes at most half of it. Defaults to DEFAULT_STAGE_BUDGET_MB (4096).
+
+    Recordings of root, their parameters and analysis status are indexed in SAMPL recordings.sqlite in root after analysis, see bout_analysis/recording_index.py.
+    """
+    SAMPL_analysis_batch([(root, frame_rate)], if_epoch_data=if_epoch_data, if_multiprocessing=if_multiprocessing, if_epoch_float32=if_epoch_float32,
+                         chunk_rows=chunk_rows, n_shards=n_shards, if_resume=if_resume, if_telemetry=if_telemetry, log_dir=log_dir, report_dir=root, memory_budget_MB=memory_budget_MB,
+                         max_retries=max_retries, task_timeout_s=task_timeout_s, if_scan=if_scan, if_prefetch=if_prefetch,
+                         scratch_dir=scratch_dir, stage_budget_MB=stage_budget_MB)
 
 
 if __name__ == "__main__":
     if_multiprocessing = True
     if_epoch_data = False
+    if_epoch_float32 = False
     # if want to use Command Line Inputs
     root_dir = input("- Where's the root folder? \n")
     frame_rate = input("- What's the frame rate in int.? \n")
@@ -71,7 +176,10 @@ if __name__ == "__main__":
     if confirm == 'y':
         if_epoch_data = True
         print("^ Saving raw epoch values.")
+        confirm = input("- Save epoch data as float32 to reduce file size? (y/n): ")
+        if confirm == 'y':
+            if_epoch_float32 = True
     if if_multiprocessing:
         print("^ Multiprocessing...")
-    SAMPL_analysis_mp(root_dir, frame_rate, if_epoch_data=if_epoch_data, if_multiprocessing=if_multiprocessing)
+    SAMPL_analysis_mp(root_dir, frame_rate, if_epoch_data=if_epoch_data, if_multiprocessing=if_multiprocessing, if_epoch_float32=if_epoch_float32)
     print("--- Analysis ended ---")
@@ -3,10 +3,11 @@
     This scripts allows for batch analysis of a list of folders.
 - How to use
     "list_of_root_folders" contains a list of tuples containing root directory and frame rate.
+    All folders are analyzed in one process pool, see SAMPL_analysis_batch()
 '''
 
 # %%
-from SAMPL_analysis import SAMPL_analysis_mp
+from SAMPL_analysis import SAMPL_analysis_batch
 from bout_analysis.logger import log_SAMPL_ana
 
 # %%
@@ -25,4 +26,4 @@ list_of_root_folders = [
 
 for (root, fr) in list_of_root_folders:
     LoF_logger.info(f"Analyzed dataset: {root}")
-    SAMPL_analysis_mp(root, fr)
\ No newline at end of file
+SAMPL_analysis_batch(list_of_root_folders)
\ No newline at end of file
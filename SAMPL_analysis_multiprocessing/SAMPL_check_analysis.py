@@ -0,0 +1,456 @@
+'''
+- What is this script
+    This script checks that options of the analysis give the same results as analyzing whole .dlm files one folder at a time (grab_fish_angle_v5.run())
+- How does it work
+    The root folder is copied to a temporary directory and analyzed by run() as the reference. Each check analyzes another copy and compares the hdf5 outputs
+    1. chunks: .dlm files read and analyzed in chunks of complete epochs (chunk_rows)
+    2. shards: epochs of each .dlm file analyzed in parallel (n_shards)
+    3. runMP: .dlm files analyzed in parallel as separate tasks, and folders merged (runMP())
+    4. resume: .dlm files analyzed one by one and folders merged (runSP()). When run again, no file is analyzed.
+       Epoch data are removed from results of each .dlm file after merging. If the first file of each folder is removed and put back,
+       the folder is merged again from the first file and all its files are analyzed again, as their epoch data are removed
+    5. append: the last .dlm file of each folder is added after the folder is merged. Only added files are analyzed and appended to the outputs
+    6. failures: by runMP(), a .dlm file hangs and another fails once. The failing file is retried, the hanging file is stopped by the timeout (task_timeout_s),
+       retried and skipped. Only the skipped file is analyzed when resumed
+    7. pack: .dlm files packed by pack_root() (preprocessing/pack_dlm.py). A .dlm file modified after packing is read from the file, then packed again
+    8. watch: watch() (bout_analysis/watch.py) with a data manifest that can't be read, then with a batch that fails. Neither stops the watch
+    Prints the results and exits with 1 if a check fails.
+- How to use it
+    python SAMPL_check_analysis.py <root folder> <frame rate> [names of checks, default all]
+    The root folder is not modified. Use a small root folder with two experiment folders or more, and .dlm files with a few thousand rows or more.
+- Requirments
+    Please refer to the README file for required packages
+'''
+import sys
+import os
+import shutil
+import tempfile
+import time
+import pandas as pd
+from SAMPL_analysis import get_dlm_input
+from bout_analysis import grab_fish_angle_v5, watch
+from bout_analysis.dlm_cache import CACHE_FOLDER, get_cache_file, has_epoch_data, read_file_info
+from preprocessing.read_ini import get_ini_file
+from preprocessing.data_manifest import DATA_MANIFEST
+from preprocessing.read_dlm import get_pack, read_dlm
+from preprocessing.pack_dlm import get_pack_file, pack_root
+from bout_analysis.task_guard import FAILURES_REPORT
+
+OUTPUTS = ['bout_data.h5', 'IEI_data.h5', 'all_data.h5']
+CHUNK_ROWS = 3000  # small, so that files are split into many chunks
+N_SHARDS = 3
+# smoothed with the first frame of the next epoch when analyzing the whole file, see stitch_res.py
+CHUNK_DIFFERENCES = {'/grabbed_all':['xvel_sm','yvel_sm']}
+TIMEOUT_S = 30  # much longer than analyzing a small .dlm file
+# .dlm files next to these files hang or fail once, see faulty_run_file()
+HANG_SUFFIX = '.hang'
+FAIL_SUFFIX = '.fail'
+RUN_FILE = grab_fish_angle_v5.run_file
+UPDATE_RECORDING_INDEX = watch.update_recording_index
+
+def copy_root(root, dest):
+    """copy a root folder without outputs of the analysis
+
+    Args:
+        root (string): directory of behavior data
+        dest (string): directory of the copy
+    """
+    def ignore(path, names):
+        return [name for name in names if name.endswith('.h5') or name == 'dlm results' or (name.startswith('SAMPL ') and name != DATA_MANIFEST)]
+    shutil.copytree(root, dest, ignore=ignore)
+
+def get_h5_differences(file, other_file, skip_columns={}):
+    """compare keys and values of two hdf5 outputs. Floats are compared with the default tolerance of pandas
+
+    Args:
+        file (string): hdf5 file
+        other_file (string): hdf5 file
+        skip_columns (dict, optional): key: columns not compared. Defaults to {}.
+
+    Returns:
+        list: keys that differ
+    """
+    if not os.path.exists(other_file):
+        return ['missing']
+    with pd.HDFStore(file, mode='r') as store, pd.HDFStore(other_file, mode='r') as other_store:
+        if sorted(store.keys()) != sorted(other_store.keys()):
+            return ['keys']
+        differences = []
+        for key in store.keys():
+            data, other_data = [this_store.select(key).drop(columns=skip_columns.get(key, []), errors='ignore') for this_store in [store, other_store]]
+            try:
+                pd.testing.assert_frame_equal(data.reset_index(drop=True), other_data.reset_index(drop=True), check_dtype=False)
+            except AssertionError:
+                differences.append(key)
+        return differences
+
+def is_same_outputs(dlm_input, other_dlm_input, root, h5_names=OUTPUTS, skip_columns={}):
+    """compare hdf5 outputs of each folder of two copies of a root folder, and print the results
+
+    Args:
+        dlm_input (list): output of get_dlm_input() of a copy
+        other_dlm_input (list): output of get_dlm_input() of another copy, in the same order
+        root (string): directory of the other copy, for printing
+        h5_names (list, optional): hdf5 files compared. Defaults to OUTPUTS.
+        skip_columns (dict, optional): see get_h5_differences(). Defaults to {}.
+
+    Returns:
+        bool: True if all outputs are the same
+    """
+    if_same = True
+    for (_, folder, *_), (_, other_folder, *_) in zip(dlm_input, other_dlm_input):
+        for h5_name in h5_names:
+            differences = get_h5_differences(os.path.join(folder, h5_name), os.path.join(other_folder, h5_name), skip_columns)
+            if_same = if_same and not differences
+            print(f"{'Same' if not differences else 'DIFFERENT'}: {os.path.relpath(other_folder, root)}/{h5_name}" + (f" {', '.join(differences)}" if differences else ""))
+    return if_same
+
+def get_copy_input(root, check_dir, name, frame_rate, **kwargs):
+    """copy the root folder and get its folders to analyze, with epoch data
+
+    Args:
+        root (string): directory of behavior data
+        check_dir (string): temporary directory
+        name (string): name of the copy
+        frame_rate (int): frame rate
+        kwargs: see get_dlm_input()
+
+    Returns:
+        list: output of get_dlm_input() of the copy
+    """
+    copy = os.path.join(check_dir, name)
+    copy_root(root, copy)
+    return get_dlm_input(copy, frame_rate, if_epoch_data=True, **kwargs)
+
+def analyze_copy(root, check_dir, name, frame_rate, **kwargs):
+    """copy the root folder and analyze folders one by one by run()
+
+    Args:
+        see get_copy_input()
+
+    Returns:
+        list: output of get_dlm_input() of the copy
+    """
+    dlm_input = get_copy_input(root, check_dir, name, frame_rate, **kwargs)
+    for args in dlm_input:
+        grab_fish_angle_v5.run(*args)
+    return dlm_input
+
+def check_chunks(root, frame_rate, check_dir, reference):
+    """check that analyzing .dlm files in chunks (chunk_rows) gives the same outputs, except CHUNK_DIFFERENCES
+
+    Args:
+        root (string): directory of behavior data
+        frame_rate (int): frame rate
+        check_dir (string): temporary directory
+        reference (list): output of get_dlm_input() of the reference copy
+
+    Returns:
+        bool: True if the check passes
+    """
+    dlm_input = analyze_copy(root, check_dir, 'chunks', frame_rate, chunk_rows=CHUNK_ROWS)
+    return is_same_outputs(reference, dlm_input, os.path.join(check_dir, 'chunks'), skip_columns=CHUNK_DIFFERENCES)
+
+def check_shards(root, frame_rate, check_dir, reference):
+    """check that analyzing epochs of each .dlm file in parallel (n_shards) gives the same outputs
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    dlm_input = analyze_copy(root, check_dir, 'shards', frame_rate, n_shards=N_SHARDS)
+    return is_same_outputs(reference, dlm_input, os.path.join(check_dir, 'shards'))
+
+def check_runMP(root, frame_rate, check_dir, reference):
+    """check that analyzing .dlm files in parallel by runMP() gives the same outputs
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    dlm_input = get_copy_input(root, check_dir, 'runMP', frame_rate)
+    grab_fish_angle_v5.runMP(dlm_input, if_resume=False)
+    return is_same_outputs(reference, dlm_input, os.path.join(check_dir, 'runMP'))
+
+def get_folder_size(folder):
+    """get the size of files in a folder and its subfolders
+
+    Args:
+        folder (string): directory
+
+    Returns:
+        int: bytes
+    """
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(folder) for name in names)
+
+def get_files_to_analyze(dlm_input):
+    """get .dlm files that runSP() or runMP() would analyze when resumed
+
+    Args:
+        dlm_input (list): output of get_dlm_input()
+
+    Returns:
+        list: .dlm directories
+    """
+    return [task[1] for task in grab_fish_angle_v5.get_file_input(dlm_input, if_resume=True)]
+
+def move_away(files, dest):
+    """move .dlm files and their parameters.ini out of their folders
+
+    Args:
+        files (list): .dlm directories
+        dest (string): directory to move them to
+
+    Returns:
+        list: (directory, directory after moving) of each file, to move them back
+    """
+    moved = []
+    for i, file in enumerate(files):
+        for this_file in [file, get_ini_file(file)]:
+            # a subfolder for each .dlm file, as .dlm files of different folders may have the same name
+            moved_file = os.path.join(dest, str(i), os.path.basename(this_file))
+            os.makedirs(os.path.dirname(moved_file), exist_ok=True)
+            shutil.move(this_file, moved_file)
+            moved.append((this_file, moved_file))
+    return moved
+
+def check_resume(root, frame_rate, check_dir, reference):
+    """check that runSP() gives the same outputs, that a run is resumed without analyzing any file again,
+    and that epoch data of each .dlm file are removed after merging but are analyzed again if a folder is merged again from the first file
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    copy = os.path.join(check_dir, 'resume')
+    dlm_input = get_copy_input(root, check_dir, 'resume', frame_rate)
+    grab_fish_angle_v5.runSP(dlm_input, if_resume=True)
+    if_pass = is_same_outputs(reference, dlm_input, copy)
+    files = [file for filenames, *_ in dlm_input for file in filenames]
+    to_analyze = get_files_to_analyze(dlm_input)
+    if_pruned = not any(has_epoch_data(get_cache_file(file)) for file in files)
+    cache_MB = sum(get_folder_size(os.path.join(folder, CACHE_FOLDER)) for _, folder, *_ in dlm_input) / 2**20
+    epoch_MB = sum(os.path.getsize(os.path.join(folder, 'all_data.h5')) for _, folder, *_ in dlm_input) / 2**20
+    print(f"{'Resumed' if not to_analyze else 'NOT RESUMED'}: {len(to_analyze)} of {len(files)} .dlm files analyzed again")
+    print(f"{'Removed' if if_pruned else 'NOT REMOVED'}: epoch data of .dlm files after merging. {cache_MB:.1f} MB of dlm results, {epoch_MB:.1f} MB of all_data.h5")
+    if_pass = if_pass and not to_analyze and if_pruned
+
+    # merged again from the first file
+    moved = move_away([filenames[0] for filenames, *_ in dlm_input if len(filenames) > 1], os.path.join(check_dir, 'moved'))
+    dlm_input = get_dlm_input(copy, frame_rate, if_epoch_data=True)
+    grab_fish_angle_v5.runSP(dlm_input, if_resume=True)
+    for file, moved_file in moved:
+        shutil.move(moved_file, file)
+    dlm_input = get_dlm_input(copy, frame_rate, if_epoch_data=True)
+    to_analyze = get_files_to_analyze(dlm_input)
+    if_all = sorted(to_analyze) == sorted(file for filenames, *_ in dlm_input if len(filenames) > 1 for file in filenames)
+    print(f"{'Analyzed again' if if_all else 'NOT ANALYZED AGAIN'}: {len(to_analyze)} .dlm files of folders merged again from the first file")
+    grab_fish_angle_v5.runSP(dlm_input, if_resume=True)
+    return is_same_outputs(reference, dlm_input, copy) and if_all and if_pass
+
+def check_append(root, frame_rate, check_dir, reference):
+    """check that .dlm files added after a folder is merged are analyzed and appended without analyzing other files again, and give the same outputs
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    copy = os.path.join(check_dir, 'append')
+    dlm_input = get_copy_input(root, check_dir, 'append', frame_rate)
+    last_files = [filenames[-1] for filenames, *_ in dlm_input if len(filenames) > 1]
+    moved = move_away(last_files, os.path.join(check_dir, 'added'))
+    grab_fish_angle_v5.runSP(get_dlm_input(copy, frame_rate, if_epoch_data=True), if_resume=True)
+    for file, moved_file in moved:
+        shutil.move(moved_file, file)
+    dlm_input = get_dlm_input(copy, frame_rate, if_epoch_data=True)
+    analyzed_at = {file:read_file_info(get_cache_file(file))['analyzed_at'] for filenames, *_ in dlm_input for file in filenames if file not in last_files}
+    to_analyze = get_files_to_analyze(dlm_input)
+    if_added = sorted(to_analyze) == sorted(last_files)
+    print(f"{'Added' if if_added else 'NOT ADDED'}: {len(to_analyze)} .dlm files to analyze, {len(last_files)} files added")
+    grab_fish_angle_v5.runSP(dlm_input, if_resume=True)
+    if_kept = all(read_file_info(get_cache_file(file))['analyzed_at'] == time for file, time in analyzed_at.items())
+    print(f"{'Appended' if if_kept else 'NOT APPENDED'}: {len(analyzed_at)} .dlm files merged before not analyzed again")
+    return is_same_outputs(reference, dlm_input, copy) and if_added and if_kept
+
+def faulty_run_file(i, file, *args, **kwargs):
+    """run_file() of grab_fish_angle_v5 that hangs on .dlm files with HANG_SUFFIX and fails once on files with FAIL_SUFFIX.
+    Files mark the faults, so that they are seen by pool workers however these are started
+    """
+    if os.path.exists(file + HANG_SUFFIX):
+        time.sleep(TIMEOUT_S * 100)
+    if os.path.exists(file + FAIL_SUFFIX):
+        os.remove(file + FAIL_SUFFIX)
+        raise RuntimeError(f'failed by {os.path.basename(__file__)}')
+    return RUN_FILE(i, file, *args, **kwargs)
+
+def check_failures(root, frame_rate, check_dir, reference):
+    """check that runMP() retries a .dlm file that failed, skips a file that runs longer than the timeout after retrying it,
+    merges folders without the skipped file, and analyzes only the skipped file when resumed
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    copy = os.path.join(check_dir, 'failures')
+    dlm_input = get_copy_input(root, check_dir, 'failures', frame_rate)
+    # the last file of a folder, so that it is appended when resumed
+    hang_file, fail_file = dlm_input[0][0][-1], dlm_input[-1][0][0]
+    for marker in [hang_file + HANG_SUFFIX, fail_file + FAIL_SUFFIX]:
+        open(marker, 'w').close()
+    grab_fish_angle_v5.run_file = faulty_run_file
+    try:
+        grab_fish_angle_v5.runMP(dlm_input, report_dir=copy, if_resume=False, max_retries=1, task_timeout_s=TIMEOUT_S)
+    finally:
+        grab_fish_angle_v5.run_file = RUN_FILE
+    os.remove(hang_file + HANG_SUFFIX)
+    failures = pd.read_csv(os.path.join(copy, FAILURES_REPORT))
+    expected = [(hang_file, 1, 'TimeoutError'), (hang_file, 2, 'TimeoutError'), (fail_file, 1, 'RuntimeError')]
+    if_failed = sorted(zip(failures['file'], failures['attempt'], failures['error'])) == sorted(expected)
+    print(f"{'Failed' if if_failed else 'NOT FAILED'}: {', '.join(f'{os.path.basename(file)} attempt {attempt} {error}' for file, attempt, error in zip(failures['file'], failures['attempt'], failures['error']))}")
+    to_analyze = get_files_to_analyze(dlm_input)
+    if_skipped = to_analyze == [hang_file]
+    print(f"{'Skipped' if if_skipped else 'NOT SKIPPED'}: {len(to_analyze)} .dlm files to analyze when resumed")
+    grab_fish_angle_v5.runMP(dlm_input, report_dir=copy, if_resume=True, task_timeout_s=TIMEOUT_S)
+    if_removed = not os.path.exists(os.path.join(copy, FAILURES_REPORT))
+    print(f"{'Resumed' if if_removed else 'NOT RESUMED'}: failures report removed after resuming without failures")
+    return is_same_outputs(reference, dlm_input, copy) and if_failed and if_skipped and if_removed
+
+def check_pack(root, frame_rate, check_dir, reference):
+    """check that .dlm files packed by pack_root() give the same outputs, and that a .dlm file modified after packing
+    is read from the file until it is packed again
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    copy = os.path.join(check_dir, 'pack')
+    copy_root(root, copy)
+    pack_root(copy, report_dir=check_dir, if_multiprocessing=False)
+    dlm_input = analyze_copy(copy, check_dir, 'packed', frame_rate)
+    files = [file for filenames, *_ in dlm_input for file in filenames]
+    if_packed = all(get_pack(file) for file in files)
+    print(f"{'Packed' if if_packed else 'NOT PACKED'}: {sum(bool(get_pack(file)) for file in files)} of {len(files)} .dlm files read from packs")
+    if_pass = is_same_outputs(reference, dlm_input, os.path.join(check_dir, 'packed')) and if_packed
+
+    # the last line removed after packing
+    modified = os.path.join(copy, os.path.relpath(dlm_input[0][1], os.path.join(check_dir, 'packed')), os.path.basename(dlm_input[0][0][-1]))
+    with open(modified, 'rb') as f:
+        data = f.read()
+    with open(modified, 'wb') as f:
+        f.write(data[:data.rstrip(b'\n').rindex(b'\n') + 1])
+    files = [file for filenames, *_ in get_dlm_input(copy, frame_rate) for file in filenames]
+    packed_file = os.path.join(get_pack_file(os.path.dirname(modified)), os.path.basename(modified))
+    if_stale = modified in files and packed_file not in files
+    print(f"{'Stale' if if_stale else 'NOT STALE'}: {os.path.basename(modified)} read from the file after it was modified")
+    report = pack_root(copy, report_dir=check_dir, if_multiprocessing=False)
+    packed_again = report.loc[report['status'] == 'packed', 'file'].to_list()
+    files = [file for filenames, *_ in get_dlm_input(copy, frame_rate) for file in filenames]
+    if_repacked = packed_again == [modified] and packed_file in files and read_dlm(0, packed_file).reset_index(drop=True).equals(read_dlm(0, modified).reset_index(drop=True))
+    print(f"{'Packed again' if if_repacked else 'NOT PACKED AGAIN'}: {len(packed_again)} .dlm files packed again, same values as the modified file")
+    return if_pass and if_stale and if_repacked
+
+def failing_update_recording_index(root):
+    """update_recording_index() of watch.py that fails on the first call, so that a batch fails after its files are analyzed
+    """
+    watch.update_recording_index = UPDATE_RECORDING_INDEX
+    raise RuntimeError(f'failed by {os.path.basename(__file__)}')
+
+def read_log(log_dir):
+    """read the text log of a run
+
+    Args:
+        log_dir (string): log_dir of the run
+
+    Returns:
+        string: SAMPL_ana_log.log
+    """
+    with open(os.path.join(log_dir, 'SAMPL_ana_log.log')) as f:
+        return f.read()
+
+def check_watch(root, frame_rate, check_dir, reference):
+    """check that watch() keeps watching after a poll fails on a data manifest that can't be read, and after a batch fails,
+    and that files are analyzed at the next polls with the same outputs
+
+    Args:
+        see check_chunks()
+
+    Returns:
+        bool: True if the check passes
+    """
+    copy = os.path.join(check_dir, 'watch')
+    log_dir = os.path.join(check_dir, 'watch log')
+    os.makedirs(log_dir)
+    dlm_input = get_copy_input(root, check_dir, 'watch', frame_rate)
+    # lacks the columns of a data manifest
+    pd.DataFrame({'file':['missing.dlm']}).to_csv(os.path.join(copy, DATA_MANIFEST))
+    watch.watch([(copy, frame_rate)], poll_s=0, settle_s=0, if_epoch_data=True, log_dir=log_dir, report_dir=log_dir, max_polls=2)
+    log = read_log(log_dir)
+    if_polled = log.count('not polled') == 2 and 'Traceback' in log
+    print(f"{'Polled again' if if_polled else 'NOT POLLED AGAIN'}: {log.count('not polled')} polls failed on the data manifest, watch not stopped")
+
+    os.remove(os.path.join(copy, DATA_MANIFEST))
+    watch.update_recording_index = failing_update_recording_index
+    try:
+        watch.watch([(copy, frame_rate)], poll_s=0, settle_s=0, if_epoch_data=True, log_dir=log_dir, report_dir=log_dir, max_polls=2)
+    finally:
+        watch.update_recording_index = UPDATE_RECORDING_INDEX
+    log = read_log(log_dir)
+    if_batch = log.count('poll failed') == 1 and log.count('batch analyzed') == 0
+    print(f"{'Polled again' if if_batch else 'NOT POLLED AGAIN'}: {log.count('poll failed')} batch failed, watch not stopped")
+    return is_same_outputs(reference, dlm_input, copy) and if_polled and if_batch
+
+CHECKS = {
+    'chunks':check_chunks,
+    'shards':check_shards,
+    'runMP':check_runMP,
+    'resume':check_resume,
+    'append':check_append,
+    'failures':check_failures,
+    'pack':check_pack,
+    'watch':check_watch,
+}
+
+def check_analysis(root, frame_rate, checks=CHECKS):
+    """run checks against the reference analysis of a root folder
+
+    Args:
+        root (string): directory of behavior data, copied and not modified
+        frame_rate (int): frame rate
+        checks (list, optional): names of checks in CHECKS. Defaults to all.
+
+    Returns:
+        bool: True if all checks pass
+    """
+    if_pass = True
+    check_dir = tempfile.mkdtemp(prefix='SAMPL check analysis ')
+    try:
+        reference = analyze_copy(root, check_dir, 'reference', frame_rate)
+        for name in checks:
+            print(f"--- {name}")
+            if_passed = CHECKS[name](root, frame_rate, check_dir, reference)
+            if_pass = if_pass and if_passed
+            print(f"--- {name} {'passed' if if_passed else 'FAILED'}")
+    finally:
+        shutil.rmtree(check_dir, ignore_errors=True)
+    return if_pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or any(name not in CHECKS for name in sys.argv[3:]):
+        print(f"^ Usage: python SAMPL_check_analysis.py <root folder> <frame rate> [{' '.join(CHECKS)}]")
+        sys.exit(1)
+    if_pass = check_analysis(sys.argv[1], int(sys.argv[2]), sys.argv[3:] or list(CHECKS))
+    print(f"--- Analysis check {'passed' if if_pass else 'failed'} ---")
+    sys.exit(0 if if_pass else 1)
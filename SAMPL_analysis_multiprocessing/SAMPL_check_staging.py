@@ -0,0 +1,113 @@
+'''
+- What is this script
+    This script checks local scratch staging (scratch_dir of SAMPL_analysis_mp(), see bout_analysis/staging.py) against a local directory standing in for a network volume
+- How does it work
+    The root folder is copied to a temporary directory three times. Reads from the copies are slowed down by READ_LATENCY_S per file copied.
+    1. One copy is analyzed in place and one through staging, in waves of one folder or more. Merged outputs must be the same
+    2. The third copy is analyzed through staging and stopped after the first wave is analyzed, before it is synced back.
+       Results of .dlm files of the first wave must be synced back and reused when the run is resumed
+    .dlm files are analyzed one by one (runSP). Prints the results and exits with 1 if a check fails.
+- How to use it
+    python SAMPL_check_staging.py <root folder> <frame rate> [seconds of latency per file, default 0.05]
+    The root folder is not modified. Use a small root folder with two experiment folders or more.
+- Requirments
+    Please refer to the README file for required packages
+'''
+import sys
+import os
+import shutil
+import tempfile
+import time
+import pandas as pd
+from SAMPL_analysis import get_dlm_input
+from bout_analysis import grab_fish_angle_v5, staging
+from preprocessing.read_dlm import get_dlm_size
+
+OUTPUTS = ['bout_data.h5', 'IEI_data.h5']
+
+def is_same_h5(file, other_file):
+    """check whether two hdf5 outputs have the same keys and values
+
+    Args:
+        file (string): hdf5 file
+        other_file (string): hdf5 file
+
+    Returns:
+        bool:
+    """
+    with pd.HDFStore(file, mode='r') as store, pd.HDFStore(other_file, mode='r') as other_store:
+        if sorted(store.keys()) != sorted(other_store.keys()):
+            return False
+        return all(store.select(key).equals(other_store.select(key)) for key in store.keys())
+
+def run_wave(scratch_input, wave_dir):
+    grab_fish_angle_v5.runSP(scratch_input, report_dir=wave_dir)
+
+def stop_after_first_wave(scratch_input, wave_dir):
+    grab_fish_angle_v5.runSP(scratch_input, report_dir=wave_dir)
+    raise KeyboardInterrupt
+
+def check_staging(root, frame_rate, latency_s=0.05):
+    """check that staging gives the same outputs as analysis in place, and that results of a stopped wave are kept
+
+    Args:
+        root (string): directory of behavior data, copied and not modified
+        frame_rate (int): frame rate
+        latency_s (float, optional): seconds added to each file copied from or to the copies. Defaults to 0.05.
+
+    Returns:
+        bool: True if all checks pass
+    """
+    if_pass = True
+    check_dir = tempfile.mkdtemp(prefix='SAMPL check staging ')
+    try:
+        roots = {name:os.path.join(check_dir, name) for name in ['in_place', 'staged', 'stopped']}
+        for copy_root in roots.values():
+            shutil.copytree(root, copy_root, ignore=shutil.ignore_patterns('dlm results', 'SAMPL *'))
+        scratch_dir = os.path.join(check_dir, 'scratch')
+        staging.READ_LATENCY_S = latency_s
+        dlm_input = {name:get_dlm_input(copy_root, frame_rate) for name, copy_root in roots.items()}
+        # about one folder per wave
+        largest_folder = max(sum(get_dlm_size(file) for file in filenames) for filenames, *_ in dlm_input['in_place'])
+        budget_MB = 2 * largest_folder / 2**20
+
+        # 1. staged vs in place
+        tic = time.time()
+        grab_fish_angle_v5.runSP(dlm_input['in_place'])
+        print(f"In place: {time.time() - tic:.1f}s")
+        tic = time.time()
+        staging.run_staged(dlm_input['staged'], run_wave, scratch_dir, budget_MB)
+        print(f"Staged: {time.time() - tic:.1f}s, {len(staging.get_waves(dlm_input['staged'], budget_MB * 2**20))} waves, {latency_s}s per file copied")
+        for (_, folder, *_), (_, staged_folder, *_) in zip(dlm_input['in_place'], dlm_input['staged']):
+            for output in OUTPUTS:
+                if_same = os.path.exists(os.path.join(staged_folder, output)) and is_same_h5(os.path.join(folder, output), os.path.join(staged_folder, output))
+                if_pass = if_pass and if_same
+                print(f"{'Same' if if_same else 'DIFFERENT'}: {os.path.relpath(staged_folder, roots['staged'])}/{output}")
+
+        # 2. stopped after the first wave
+        first_wave = staging.get_waves(dlm_input['stopped'], budget_MB * 2**20)[0]
+        try:
+            staging.run_staged(dlm_input['stopped'], stop_after_first_wave, scratch_dir, budget_MB)
+        except KeyboardInterrupt:
+            pass
+        first_wave_files = [file for filenames, *_ in first_wave for file in filenames]
+        to_analyze = [task[1] for task in grab_fish_angle_v5.get_file_input(first_wave, if_resume=True)]
+        if_kept = not to_analyze
+        if_pass = if_pass and if_kept
+        print(f"{'Kept' if if_kept else 'LOST'}: results of {len(first_wave_files) - len(to_analyze)} of {len(first_wave_files)} .dlm files of the stopped wave are reused when resumed")
+        if_removed = not os.listdir(scratch_dir)
+        if_pass = if_pass and if_removed
+        print(f"{'Removed' if if_removed else 'NOT REMOVED'}: scratch")
+    finally:
+        staging.READ_LATENCY_S = 0
+        shutil.rmtree(check_dir, ignore_errors=True)
+    return if_pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print("^ Usage: python SAMPL_check_staging.py <root folder> <frame rate> [seconds of latency per file]")
+        sys.exit(1)
+    if_pass = check_staging(sys.argv[1], int(sys.argv[2]), *[float(arg) for arg in sys.argv[3:]])
+    print(f"--- Staging check {'passed' if if_pass else 'failed'} ---")
+    sys.exit(0 if if_pass else 1)
@@ -0,0 +1,175 @@
+'''
+- What is this script
+    This script checks bout detection of .dlm files being recorded (bout_analysis/stream_bouts.py, used by SAMPL_monitor.py) against the analysis of closed files
+- How does it work
+    A .dlm file is copied to a temporary directory in chunks of random sizes, as if it was being recorded. The first chunk is the first line, and other chunks may end in the middle of a line.
+    After each chunk, new rows are read (read_dlm.read_dlm_tail()) and bouts are detected. The recording ends when parameters.ini is saved next to the copy.
+    1. Rows read while the file grows must be the same as rows of read_dlm(), including fish num of gen2 program files (fish num from 1)
+    2. Confirmed bouts must be the same as bout_attributes of the analysis of the closed file (stream_bouts.BOUT_COLUMNS)
+    Both are checked on the file, and if fish num of the file starts from 0, on copies with fish num + 1 as saved by the gen2 program,
+    and with 2 fish in the first frame, so that the first rows read have no fish num 0.
+    Prints the results and exits with 1 if a check fails.
+- How to use it
+    python SAMPL_check_stream.py <.dlm file> <frame rate> [mean chunk size in bytes, default 65536] [random seed, default 0]
+    The .dlm file is not modified.
+- Requirments
+    Please refer to the README file for required packages
+'''
+import sys
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from preprocessing.read_dlm import DLM_COLUMNS, read_dlm, new_dlm_tail, read_dlm_tail
+from preprocessing.read_ini import get_ini_file
+from bout_analysis.grab_fish_angle_v5 import analyze_file
+from bout_analysis.stream_bouts import BOUT_COLUMNS, new_bout_stream, update_bout_stream, close_bout_stream
+
+SMALL_CHUNK_P = 0.2  # fraction of chunks of a few bytes, so that reads of one line or less are checked
+
+def stream_growing_file(file, dest, frame_rate, chunk_bytes, rng):
+    """copy a .dlm file in chunks of random sizes and read it after each chunk as it grows
+
+    Args:
+        file (string): .dlm file to copy
+        dest (string): directory of the copy, named as file
+        frame_rate (int): frame rate
+        chunk_bytes (int): mean chunk size
+        rng (Generator): random chunk sizes
+
+    Returns:
+        DataFrame: rows read
+        DataFrame: confirmed bouts, BOUT_COLUMNS
+        int: number of chunks
+    """
+    with open(file, 'rb') as f:
+        data = f.read()
+    dlm_tail = new_dlm_tail(dest)
+    stream = new_bout_stream(dest, frame_rate)
+    rows, confirmed = [], []
+    n_chunks = 0
+    offset = 0
+    with open(dest, 'wb') as f:
+        while True:
+            if offset < len(data):
+                if not n_chunks:
+                    size = data.index(b'\n') + 1
+                elif rng.random() < SMALL_CHUNK_P:
+                    size = int(rng.integers(1, 64))
+                else:
+                    size = int(rng.integers(1, 2*chunk_bytes))
+                f.write(data[offset:offset+size])
+                f.flush()
+                offset += size
+                n_chunks += 1
+            else:
+                # the recording ends
+                with open(get_ini_file(dest), 'w'):
+                    pass
+            raw, if_closed = read_dlm_tail(dlm_tail, idle_s=np.inf)
+            events = []
+            if raw is not None:
+                rows.append(raw.copy())
+                events, _ = update_bout_stream(stream, raw)
+            if if_closed:
+                events += close_bout_stream(stream)
+            confirmed.extend(bout for status, bout in events if status == 'confirmed')
+            if if_closed:
+                break
+    return pd.concat(rows), pd.DataFrame(confirmed, columns=BOUT_COLUMNS), n_chunks
+
+def is_same_bouts(bouts, other_bouts):
+    """check whether two bout tables are the same, floats compared with np.isclose
+
+    Args:
+        bouts (DataFrame): BOUT_COLUMNS
+        other_bouts (DataFrame): BOUT_COLUMNS
+
+    Returns:
+        int: number of bouts of bouts found in other_bouts, in the same order
+    """
+    if len(bouts) != len(other_bouts):
+        return 0
+    bouts, other_bouts = bouts.reset_index(drop=True), other_bouts.reset_index(drop=True)
+    same = np.ones(len(bouts), dtype=bool)
+    for column in BOUT_COLUMNS:
+        if pd.api.types.is_float_dtype(bouts[column]) and pd.api.types.is_float_dtype(other_bouts[column]):
+            same &= np.isclose(bouts[column].values, other_bouts[column].values, equal_nan=True)
+        else:
+            same &= (pd.Series(bouts[column].values) == pd.Series(other_bouts[column].values)).values
+    return int(same.sum())
+
+def check_file(file, check_dir, frame_rate, chunk_bytes, rng):
+    """check rows and confirmed bouts of a file read as it grows
+
+    Args:
+        file (string): .dlm file
+        check_dir (string): temporary directory
+        frame_rate (int): frame rate
+        chunk_bytes (int): mean chunk size
+        rng (Generator): random chunk sizes
+
+    Returns:
+        bool: True if both checks pass
+    """
+    dest = os.path.join(check_dir, 'growing', os.path.basename(file))
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    for old_file in [dest, get_ini_file(dest)]:
+        if os.path.exists(old_file):
+            os.remove(old_file)
+    rows, confirmed, n_chunks = stream_growing_file(file, dest, frame_rate, chunk_bytes, rng)
+    raw = read_dlm(0, file)
+    if_same_rows = rows[DLM_COLUMNS].equals(raw[DLM_COLUMNS])
+    print(f"{'Same' if if_same_rows else 'DIFFERENT'}: {len(rows)} rows read in {n_chunks} chunks, {len(raw)} rows of read_dlm()")
+    res, *_ = analyze_file(0, file, os.path.dirname(file), frame_rate)
+    if type(res) == str:
+        print(f"Skipped by the analysis: {res}, {len(confirmed)} bouts confirmed")
+        return if_same_rows and confirmed.empty
+    bout_attributes = res['bout_attributes'][BOUT_COLUMNS]
+    n_same = is_same_bouts(confirmed, bout_attributes)
+    if_same_bouts = n_same == len(bout_attributes)
+    print(f"{'Same' if if_same_bouts else 'DIFFERENT'}: {n_same}/{len(bout_attributes)} bouts of bout_attributes confirmed, {len(confirmed)} bouts confirmed")
+    return if_same_rows and if_same_bouts
+
+def check_stream(file, frame_rate, chunk_bytes=65536, seed=0):
+    """check bout detection of a .dlm file read as it grows, see stream_growing_file(), on the file and as saved by the gen2 program
+
+    Args:
+        file (string): .dlm file, copied and not modified
+        frame_rate (int): frame rate
+        chunk_bytes (int, optional): mean chunk size in bytes. Defaults to 65536.
+        seed (int, optional): random seed of chunk sizes. Defaults to 0.
+
+    Returns:
+        bool: True if all checks pass
+    """
+    rng = np.random.default_rng(seed)
+    check_dir = tempfile.mkdtemp(prefix='SAMPL check stream ')
+    try:
+        print(f"--- {os.path.basename(file)}")
+        if_pass = check_file(file, check_dir, frame_rate, chunk_bytes, rng)
+        raw = pd.read_csv(file, sep="\t", header=None)
+        if raw.shape[1] == len(DLM_COLUMNS) and raw[1].min() == 0:
+            variants = {'fish num from 1':raw.copy(), '2 fish in the first frame':raw.copy()}
+            # as saved by the gen2 program
+            variants['fish num from 1'][1] += 1
+            variants['2 fish in the first frame'].loc[0, 1] = 1
+            for variant, variant_raw in variants.items():
+                variant_file = os.path.join(check_dir, variant, os.path.basename(file))
+                os.makedirs(os.path.dirname(variant_file))
+                variant_raw.to_csv(variant_file, sep="\t", header=False, index=False, float_format='%.6f')
+                print(f"--- {os.path.basename(file)}, {variant}")
+                if_pass = check_file(variant_file, check_dir, frame_rate, chunk_bytes, rng) and if_pass
+    finally:
+        shutil.rmtree(check_dir, ignore_errors=True)
+    return if_pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4, 5]:
+        print("^ Usage: python SAMPL_check_stream.py <.dlm file> <frame rate> [mean chunk size in bytes] [random seed]")
+        sys.exit(1)
+    if_pass = check_stream(sys.argv[1], int(sys.argv[2]), *[int(arg) for arg in sys.argv[3:]])
+    print(f"--- Stream check {'passed' if if_pass else 'failed'} ---")
+    sys.exit(0 if if_pass else 1)
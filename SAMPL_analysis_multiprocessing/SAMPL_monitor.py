@@ -0,0 +1,48 @@
+'''
+- What is this script
+    This script is part of the SAMPL analysis pipeline.
+    It keeps running and monitors boxes while they record, from the .dlm files being recorded in the root folders of a config file
+- How does it work
+    Root folders are checked every poll_s seconds. For each box (folder), only rows appended to the .dlm file being recorded since the last check are read.
+    Epochs, frames with one fish, speed crossings and aligned bouts are counted and saved as a status .json file, replaced at every check.
+    Boxes with few frames with one fish or few aligned bouts compared to other boxes are flagged, e.g. dirty cuvettes or dead fish.
+    Counts are estimates for monitoring, see bout_analysis/monitor.py. Analyze data by SAMPL_analysis.py or SAMPL_watch.py
+- How to use it
+    python SAMPL_monitor.py <config file>
+    The config file is a .json file, e.g.
+        {
+            "roots": [["/Volumes/LabData/SAMPL_data_in_use/HC", 166], ["/Volumes/LabData/SAMPL_data_in_use/TauLong", 166]],
+            "status_file": "/Volumes/LabData/SAMPL_logs/SAMPL monitor status.json",
+            "poll_s": 60,
+            "window_h": 1,
+            "history_h": 24,
+            "log_dir": "/Volumes/LabData/SAMPL_logs"
+        }
+    roots are [root folder, frame rate]. Other keys are optional, see monitor() in bout_analysis/monitor.py.
+    Stop it with Ctrl+C. The status file has, for each box: the file being recorded, counts and counts per hour of the last window_h hours,
+    counts of each hour of the last history_h hours, and flags.
+- Requirments
+    Please refer to the README file for required packages
+'''
+import sys
+import json
+from bout_analysis.monitor import monitor
+
+def SAMPL_monitor(config_file):
+    """monitor boxes of root folders of a config file while they record
+
+    Args:
+        config_file (string): directory of the .json config file
+    """
+    with open(config_file) as f:
+        config = json.load(f)
+    jobs = [(root, int(frame_rate)) for root, frame_rate in config.pop('roots')]
+    monitor(jobs, **config)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("^ Usage: python SAMPL_monitor.py <config file>")
+        sys.exit(1)
+    SAMPL_monitor(sys.argv[1])
+    print("--- Monitor ended ---")
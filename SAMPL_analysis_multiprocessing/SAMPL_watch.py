@@ -0,0 +1,47 @@
+'''
+- What is this script
+    This script is part of the SAMPL analysis pipeline.
+    It keeps running and analyzes .dlm files of the root folders in a config file as soon as each recording ends, for continuous acquisition
+- How does it work
+    Root folders are checked every poll_s seconds. A .dlm file is analyzed once it is closed: unchanged since the last check with its parameters.ini saved,
+    or not modified for settle_s seconds. Results are the same as SAMPL_analysis.py and are appended to the results of each folder as new files arrive.
+    See bout_analysis/watch.py
+- How to use it
+    python SAMPL_watch.py <config file>
+    The config file is a .json file, e.g.
+        {
+            "roots": [["/Volumes/LabData/SAMPL_data_in_use/HC", 166], ["/Volumes/LabData/SAMPL_data_in_use/TauLong", 166]],
+            "poll_s": 60,
+            "settle_s": 300,
+            "max_batch_files": 64,
+            "log_dir": "/Volumes/LabData/SAMPL_logs"
+        }
+    roots are [root folder, frame rate] or [root folder, frame rate, log folder of the root]. Records of all roots are also saved to log_dir. Other keys are optional, see watch() in bout_analysis/watch.py and SAMPL_analysis_mp() in SAMPL_analysis.py.
+    Stop it with Ctrl+C. When started again, files analyzed before are skipped. The state of each root is saved as SAMPL watch state.json in the root folder.
+- Requirments
+    Please refer to the README file for required packages
+'''
+import sys
+import json
+from bout_analysis.watch import watch
+
+def SAMPL_watch(config_file):
+    """watch root folders of a config file and analyze new .dlm files
+
+    Args:
+        config_file (string): directory of the .json config file
+    """
+    with open(config_file) as f:
+        config = json.load(f)
+    roots = config.pop('roots')
+    jobs = [(root, int(frame_rate)) for root, frame_rate, *_ in roots]
+    root_log_dirs = {root:root_log_dir[0] for root, _, *root_log_dir in roots if root_log_dir}
+    watch(jobs, root_log_dirs=root_log_dirs, **config)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("^ Usage: python SAMPL_watch.py <config file>")
+        sys.exit(1)
+    SAMPL_watch(sys.argv[1])
+    print("--- Watch ended ---")
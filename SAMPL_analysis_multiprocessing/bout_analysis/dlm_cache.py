@@ -0,0 +1,260 @@
+'''
+Results of single .dlm files, saved under <folder>/dlm results/<dlm name>.h5
+Used by runMP, which analyzes each .dlm file as a separate task and merges results of each folder afterwards.
+Merged results are the same as run(), which analyzes .dlm files of a folder one by one.
+
+Keys in each file:
+    file_info: one row. size and modification time of the .dlm file before it was read (and hash if packed), analyzer versions, settings and constants,
+        number of aligned bouts and the message if the .dlm file is skipped. Saved last, so a file without file_info is incomplete
+    fish_length: estimated fish length
+    bout and IEI data: same keys as bout_data.h5 and IEI_data.h5
+    epoch data: same keys as all_data.h5, if epoch data are saved. Appended by epoch_store.append_epoch_data().
+        Removed by prune_epoch_data() once copied to all_data.h5 by merge_folder(), so that epoch data are not stored twice
+    telemetry: time and memory use of each stage, if recorded. See telemetry.py
+
+Results are reused if the .dlm file and the settings are unchanged (see is_cache_current()), so that an interrupted run resumes
+from the files not yet analyzed. file_info of all .dlm files in a folder is saved as <folder>/dlm results/manifest.csv after merging.
+The manifest also lists the .dlm files already merged, so that new .dlm files can be appended without merging the whole folder again.
+If a folder with epoch data must be merged again from the first file, e.g. a new .dlm file is named before merged files, .dlm files without epoch data are analyzed again.
+'''
+import os
+import hashlib
+import pandas as pd
+from bout_analysis.stitch_res import BOUT_IEI_DATA_KEYS
+from bout_analysis.epoch_store import EPOCH_DATA_KEYS
+from preprocessing.read_dlm import get_dlm_folder, get_pack, get_packed_info
+
+CACHE_FOLDER = 'dlm results'
+MANIFEST_NAME = 'manifest.csv'
+HASH_BLOCK_SIZE = 2**23  # bytes to read at a time for hashing
+EPOCH_CACHE_KEYS = ['epoch_index'] + EPOCH_DATA_KEYS
+
+def get_cache_file(file):
+    """get the result file of a .dlm file
+
+    Args:
+        file (string): .dlm directory
+
+    Returns:
+        string: directory of the result file
+    """
+    dlm_name = os.path.basename(file).split('.dlm')[0]
+    return os.path.join(get_dlm_folder(file), CACHE_FOLDER, f"{dlm_name}.h5")
+
+def get_dlm_state(file, if_hash=True):
+    """get size, modification time and md5 hash of a .dlm file. Those of the original file if packed, see pack_dlm.py
+
+    Args:
+        file (string): .dlm directory
+        if_hash (bool, optional): whether to hash the file, which reads the whole file. Defaults to True.
+
+    Returns:
+        dict: dlm_size, dlm_mtime, dlm_hash (None if not hashed)
+    """
+    if get_pack(file):
+        info = get_packed_info(file)
+        return {
+            'dlm_size':int(info['dlm_size']),
+            'dlm_mtime':info['dlm_mtime'],
+            'dlm_hash':info['dlm_hash'],
+        }
+    dlm_hash = None
+    if if_hash:
+        md5 = hashlib.md5()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                md5.update(block)
+        dlm_hash = md5.hexdigest()
+    return {
+        'dlm_size':os.path.getsize(file),
+        'dlm_mtime':os.path.getmtime(file),
+        'dlm_hash':dlm_hash,
+    }
+
+def remove_file_res(cache_file):
+    """remove results of a .dlm file before analyzing it again
+
+    Args:
+        cache_file (string): output of get_cache_file()
+    """
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+def save_file_res(cache_file, res, fish_length, file_info):
+    """save bout and IEI data of one .dlm file. Epoch data, if any, should be saved to cache_file beforehand
+
+    Args:
+        cache_file (string): output of get_cache_file()
+        res (dict): bout and IEI data. None if the .dlm file is skipped
+        fish_length (DataFrame): estimated fish length
+        file_info (dict): .dlm state, analyzer versions, settings, aligned bout number, message
+    """
+    with pd.HDFStore(cache_file, mode='a') as store:
+        if res is not None:
+            store.put('fish_length', fish_length, format='table')
+            for key in BOUT_IEI_DATA_KEYS:
+                # empty tables are not saved in table format
+                store.put(key, res[key], format='table')
+        store.put('file_info', pd.DataFrame(file_info, index=[0]), format='table')
+
+def read_file_info(cache_file):
+    """read file_info saved by save_file_res()
+
+    Args:
+        cache_file (string): output of get_cache_file()
+
+    Returns:
+        Series: file info. None if the result file is missing or incomplete
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with pd.HDFStore(cache_file, mode='r') as store:
+            if 'file_info' not in store:
+                return None
+            return store.select('file_info').iloc[0]
+    except Exception:
+        # e.g. file not closed after a crash
+        return None
+
+def is_cache_current(file, settings):
+    """check whether saved results of a .dlm file can be reused.
+    The .dlm file is only hashed if its modification time changed, e.g. after copying, and a hash is saved (packed files only)
+
+    Args:
+        file (string): .dlm directory
+        settings (dict): analyzer versions, settings and constants of the current run. Must all match file_info
+
+    Returns:
+        bool: True if results are saved with the same settings and the .dlm file is unchanged
+    """
+    file_info = read_file_info(get_cache_file(file))
+    if file_info is None:
+        return False
+    if any(key not in file_info or file_info[key] != value for key, value in settings.items()):
+        return False
+    dlm_state = get_dlm_state(file, if_hash=False)
+    if dlm_state['dlm_size'] != file_info['dlm_size']:
+        return False
+    if dlm_state['dlm_mtime'] == file_info['dlm_mtime']:
+        return True
+    if not file_info['dlm_hash']:
+        return False
+    return get_dlm_state(file)['dlm_hash'] == file_info['dlm_hash']
+
+def has_epoch_data(cache_file):
+    """check whether epoch data of a .dlm file are in its result file
+
+    Args:
+        cache_file (string): output of get_cache_file()
+
+    Returns:
+        bool: True if saved and not pruned yet
+    """
+    if not os.path.exists(cache_file):
+        return False
+    with pd.HDFStore(cache_file, mode='r') as store:
+        return 'epoch_index' in store
+
+def prune_epoch_data(cache_file):
+    """remove epoch data from the result file of a .dlm file, once copied to all_data.h5. Bout and IEI data, file_info and telemetry are kept.
+    hdf5 files don't shrink when keys are removed, so the other keys are copied to a new file, which replaces the result file in one step
+
+    Args:
+        cache_file (string): output of get_cache_file()
+    """
+    if not has_epoch_data(cache_file):
+        return
+    with pd.HDFStore(cache_file, mode='r') as store, pd.HDFStore(cache_file + '.part', mode='w') as pruned:
+        keys = [key for key in store.keys() if key.lstrip('/') not in EPOCH_CACHE_KEYS]
+        # file_info last, see save_file_res()
+        for key in sorted(keys, key=lambda key: key == '/file_info'):
+            pruned.put(key, store.select(key), format='table')
+    os.replace(cache_file + '.part', cache_file)
+
+def save_manifest(folder, filenames):
+    """save file_info of .dlm files in a folder as <folder>/dlm results/manifest.csv
+
+    Args:
+        folder (string): root directory
+        filenames (list): .dlm directories
+    """
+    manifest = pd.DataFrame()
+    for file in filenames:
+        cache_file = get_cache_file(file)
+        file_info = read_file_info(cache_file)
+        if file_info is None:
+            continue
+        this_info = file_info.to_frame().T.assign(file=os.path.basename(file), cache_file=cache_file)
+        manifest = pd.concat([manifest, this_info], ignore_index=True)
+    # results of .dlm files arranged by a data manifest may be saved elsewhere, see preprocessing/data_manifest.py
+    os.makedirs(os.path.join(folder, CACHE_FOLDER), exist_ok=True)
+    manifest_file = os.path.join(folder, CACHE_FOLDER, MANIFEST_NAME)
+    # replaced in one step, so that an interrupted save leaves the previous manifest
+    manifest.to_csv(manifest_file + '.part')
+    os.replace(manifest_file + '.part', manifest_file)
+
+def read_manifest(folder):
+    """read <folder>/dlm results/manifest.csv
+
+    Args:
+        folder (string): root directory
+
+    Returns:
+        DataFrame: file_info of merged .dlm files, in the order of file names. None if the folder is not merged yet
+    """
+    manifest_file = os.path.join(folder, CACHE_FOLDER, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return None
+    return pd.read_csv(manifest_file, index_col=0, keep_default_na=False)
+
+def remove_manifest(folder):
+    """remove the manifest before merging, so that results of an interrupted merge are not appended to
+
+    Args:
+        folder (string): root directory
+    """
+    manifest_file = os.path.join(folder, CACHE_FOLDER, MANIFEST_NAME)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
+def save_telemetry(cache_file, records):
+    """save telemetry records of one .dlm file
+
+    Args:
+        cache_file (string): output of get_cache_file()
+        records (DataFrame): output of telemetry.pop_records()
+    """
+    with pd.HDFStore(cache_file, mode='a') as store:
+        store.put('telemetry', records, format='table')
+
+def read_telemetry(cache_file):
+    """read telemetry records saved by save_telemetry()
+
+    Args:
+        cache_file (string): output of get_cache_file()
+
+    Returns:
+        DataFrame: records. Empty if not recorded
+    """
+    if not os.path.exists(cache_file):
+        return pd.DataFrame()
+    with pd.HDFStore(cache_file, mode='r') as store:
+        return store.select('telemetry') if 'telemetry' in store else pd.DataFrame()
+
+def read_file_res(cache_file):
+    """read results saved by save_file_res()
+
+    Args:
+        cache_file (string): output of get_cache_file()
+
+    Returns:
+        dict: bout and IEI data
+        DataFrame: estimated fish length
+        Series: file info
+    """
+    with pd.HDFStore(cache_file, mode='r') as store:
+        file_info = store.select('file_info').iloc[0]
+        res = {key:store.select(key) if key in store else pd.DataFrame() for key in BOUT_IEI_DATA_KEYS}
+        fish_length = store.select('fish_length') if 'fish_length' in store else pd.DataFrame()
+    return res, fish_length, file_info
@@ -0,0 +1,132 @@
+'''
+Epoch data store for all_data.h5
+Functions:
+    1. Build an epoch index for grabbed_all: one row per epoch with row offsets, start/end time, duration and bout counts
+    2. Append epoch data of each dlm file, together with its epoch index, to all_data.h5 as soon as the file is analyzed
+
+Epoch data are per-frame tables and can be much larger than the memory on multi-day recordings.
+Instead of concatenating all dlm files in memory, each file is appended to the tables in all_data.h5,
+so memory use is bounded by one dlm file. Row indices continue across files, same as concatenating with ignore_index=True.
+Float columns can be saved as float32 to halve the file size.
+When .dlm files are analyzed as separate tasks (runMP), epoch data of each file are saved to its own file first, then copied to all_data.h5 in chunks.
+
+grabbed_all is saved file by file, epoch after epoch. The epoch index records where each epoch starts and ends in grabbed_all,
+so that plotting scripts can read a few epochs by row offsets (pd.read_hdf(start=, stop=)) without loading the whole table.
+absTime and epochNum are saved as data columns, which also allows queries such as where="absTime >= t0 & absTime < t1".
+'''
+import os
+import pandas as pd
+import numpy as np
+
+EPOCH_DATA_KEYS = ['grabbed_all','baseline_angVel','epoch_attributes','heading_matched','epoch_pitch_heading_RMS']
+EPOCH_DATA_COLUMNS = ['epochNum','absTime']  # searchable columns in grabbed_all
+EPOCH_INDEX_COLUMNS = ['epochNum','file','row_start','row_stop','start_time','end_time','frame_num','duration','bout_num','aligned_bout_num']
+FILE_NAME_ITEMSIZE = 255  # max length of dlm file names in epoch_index
+CHUNK_ROWS = 2000000  # rows to copy at a time in copy_epoch_data()
+
+def get_epoch_index(grabbed, bout_attributes, file, row_offset):
+    """get epoch index of one analyzed dlm file
+
+    Args:
+        grabbed (DataFrame): grabbed_all of one dlm file, epochs are continuous
+        bout_attributes (DataFrame): bout_attributes of the same dlm file
+        file (string): .dlm directory
+        row_offset (int): number of rows already saved in grabbed_all
+
+    Returns:
+        DataFrame: one row per epoch. row_start:row_stop are the rows of the epoch in grabbed_all
+    """
+    grouped = grabbed.reset_index(drop=True).groupby('epochNum', sort=False)
+    epoch_index = pd.DataFrame({
+        'epochNum':grouped['epochNum'].first().values,
+        'file':os.path.basename(file),
+        'row_start':grouped.head(1).index.values + row_offset,
+        'row_stop':grouped.tail(1).index.values + row_offset + 1,
+        'start_time':grouped['absTime'].first().values,
+        'end_time':grouped['absTime'].last().values,
+    })
+    epoch_index = epoch_index.assign(
+        frame_num = epoch_index['row_stop'] - epoch_index['row_start'],
+        duration = (epoch_index['end_time'] - epoch_index['start_time']).dt.total_seconds(),
+        bout_num = epoch_index['epochNum'].map(bout_attributes.groupby('epochNum').size()).fillna(0).astype(int),
+        aligned_bout_num = epoch_index['epochNum'].map(bout_attributes.groupby('epochNum')['if_align'].sum()).fillna(0).astype(int),
+    )
+    return epoch_index
+
+def to_float32(df):
+    """downcast float64 columns to float32"""
+    float_cols = df.select_dtypes(include='float64').columns
+    return df.astype(dict.fromkeys(float_cols, 'float32'))
+
+def append_epoch_data(output_dir, res, file, if_new_file, if_float32=False, h5_name='all_data.h5'):
+    """append epoch data of one dlm file and its epoch index to all_data.h5
+
+    Args:
+        output_dir (string): folder to save all_data.h5
+        res (dict): output of grab_fish_angle()
+        file (string): .dlm directory
+        if_new_file (bool): whether to overwrite all_data.h5. True for the first dlm file in the folder
+        if_float32 (bool, optional): whether to save float columns as float32. Defaults to False.
+        h5_name (string, optional): name of the h5 file. Defaults to 'all_data.h5'.
+    """
+    with pd.HDFStore(f'{output_dir}/{h5_name}', mode='w' if if_new_file else 'a') as store:
+        row_offset = store.get_storer('grabbed_all').nrows if 'grabbed_all' in store else 0
+        epoch_offset = store.get_storer('epoch_index').nrows if 'epoch_index' in store else 0
+        epoch_index = get_epoch_index(res['grabbed_all'], res['bout_attributes'], file, row_offset)
+        epoch_index.index = np.arange(epoch_offset, epoch_offset+len(epoch_index))
+        store.append('epoch_index', epoch_index, min_itemsize={'file':FILE_NAME_ITEMSIZE})
+        for key in EPOCH_DATA_KEYS:
+            df = res[key]
+            if len(df) == 0:
+                continue
+            offset = store.get_storer(key).nrows if key in store else 0
+            df = df.set_axis(np.arange(offset, offset+len(df)))
+            if if_float32:
+                df = to_float32(df)
+            store.append(key, df, data_columns=EPOCH_DATA_COLUMNS if key == 'grabbed_all' else None)
+
+def copy_epoch_data(source_h5, output_dir, if_new_file, chunk_rows=CHUNK_ROWS):
+    """append epoch data saved by append_epoch_data() for one dlm file to all_data.h5, chunk_rows rows at a time.
+    Row offsets in the epoch index are shifted by the number of rows already in grabbed_all
+
+    Args:
+        source_h5 (string): h5 file containing epoch data of one dlm file
+        output_dir (string): folder to save all_data.h5
+        if_new_file (bool): whether to overwrite all_data.h5. True for the first dlm file in the folder
+        chunk_rows (int, optional): number of rows to copy at a time. Defaults to CHUNK_ROWS.
+
+    Returns:
+        dict: column names of each key of epoch data
+    """
+    epoch_data_columns = dict.fromkeys(EPOCH_DATA_KEYS, [])
+    with pd.HDFStore(source_h5, mode='r') as source, pd.HDFStore(f'{output_dir}/all_data.h5', mode='w' if if_new_file else 'a') as store:
+        row_offset = store.get_storer('grabbed_all').nrows if 'grabbed_all' in store else 0
+        epoch_offset = store.get_storer('epoch_index').nrows if 'epoch_index' in store else 0
+        epoch_index = source.select('epoch_index')
+        epoch_index = epoch_index.assign(
+            row_start = epoch_index['row_start'] + row_offset,
+            row_stop = epoch_index['row_stop'] + row_offset,
+        ).set_axis(np.arange(epoch_offset, epoch_offset+len(epoch_index)))
+        store.append('epoch_index', epoch_index, min_itemsize={'file':FILE_NAME_ITEMSIZE})
+        for key in EPOCH_DATA_KEYS:
+            if key not in source:
+                continue
+            offset = store.get_storer(key).nrows if key in store else 0
+            for df in source.select(key, chunksize=chunk_rows):
+                df = df.set_axis(np.arange(offset, offset+len(df)))
+                store.append(key, df, data_columns=EPOCH_DATA_COLUMNS if key == 'grabbed_all' else None)
+                offset += len(df)
+                epoch_data_columns[key] = df.columns.to_list()
+    return epoch_data_columns
+
+def get_epoch_data_columns(output_dir):
+    """get column names of each key of epoch data saved in all_data.h5, for catalogs
+
+    Args:
+        output_dir (string): folder containing all_data.h5
+
+    Returns:
+        dict: column names of each key of epoch data
+    """
+    with pd.HDFStore(f'{output_dir}/all_data.h5', mode='r') as store:
+        return {key:store.select(key, stop=0).columns.to_list() if key in store else [] for key in EPOCH_DATA_KEYS}
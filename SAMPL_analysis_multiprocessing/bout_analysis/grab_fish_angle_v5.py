@@ -23,29 +23,67 @@ NOTE
 221212: bug fixed in matching fish heading to trajectory on x. Changed angular velocity filter from 100 to 250
 221215: speed threshold changed back to 5
 230810: bug fixed in assigning adjusted swim/bout windows
+261019: epoch index saved in all_data.h5 for fetching epochs by row offsets or time. absTime and epochNum are searchable in grabbed_all
+261019: epoch data appended to all_data.h5 after each dlm file instead of concatenated in memory. optional float32 downcast
+261019: optional streaming mode (chunk_rows) reads and analyzes each dlm in chunks of complete epochs
+261019: bug fixed in assigning epoch_attributes to matching epochs. Values were aligned by epochNum to the position of epochs
+261019: optional epoch sharding (n_shards) runs grab_fish_angle on shards of epochs of one dlm in parallel
+261019: runMP analyzes dlm files as separate tasks, largest first, and merges results of each folder. predicted vs actual task time saved as schedule report
+261019: results of each dlm file are reused if the file and settings are unchanged (resume). file_info saved in dlm results/manifest.csv
+261019: new dlm files named after merged files are appended to saved results instead of merging the whole folder again
+261019: optional telemetry (if_telemetry) records time and memory use of each stage, saved as analysis telemetry.csv/.json
+261019: log records of runMP workers are sent to one listener in the main process. structured records saved as SAMPL_ana_log.jsonl
+261019: runMP merges each folder as soon as its dlm files are analyzed. SAMPL_analysis_batch runs many root folders in one pool
+261019: optional memory budget (memory_budget_MB) of runMP. tasks are admitted by estimated memory and throttled when RSS nears the budget
+261019: failed tasks no longer stop the run. retried (max_retries), optional timeout per dlm file (task_timeout_s), saved to SAMPL failures report.csv
+261019: optional prefetch (if_prefetch) of runSP reads the next dlm files and writes results in background threads while the current file is analyzed
+261019: SCHEDULE_REPORT constant for the schedule report name, used by staging.py to combine reports of waves
+261019: dlm files packed in .dlmpack containers are read by read_exp_parameters() and run_file(). dlm_size is the size of the original file
+261019: read_exp_parameters() reads the .ini file next to each dlm file, which may be outside the folder if arranged by a data manifest. bug fixed in pairing .ini files with dlm files
+261019: read_exp_parameters() reads .ini files in threads (preprocessing/read_ini.py), cached until modified, into one typed DataFrame
+261019: runMP can run on a persistent pool from start_pool(), kept open across runs by watch.py
+261019: bout detection of grab_fish_angle() also runs frame by frame on dlm files being recorded, see stream_bouts.py
+261019: boxes are monitored while recording by monitor.py, reading only rows appended since the last check
 '''
 # %%
 # Import Modules and functions
 import sys
 import os
 import glob
-import configparser
 import pandas as pd 
 import numpy as np 
 from collections import defaultdict
 import time
+import queue
+import contextlib
+import multiprocessing
 from datetime import datetime
 from datetime import timedelta
 import math
-from preprocessing.read_dlm import read_dlm
-from preprocessing.analyze_dlm_v5 import analyze_dlm_resliced
+from preprocessing.read_dlm import read_dlm, read_dlm_chunks, get_pack, get_dlm_name, get_dlm_size, read_packed_parameters
+from preprocessing.read_ini import parse_ini, to_parameter_frame, read_dlm_parameters
+from preprocessing.analyze_dlm_v5 import analyze_dlm_resliced, analyze_dlm_ver
 from bout_analysis.logger import log_SAMPL_ana
-from multiprocessing import Pool
+from bout_analysis.stitch_res import BOUT_IEI_DATA_KEYS, get_wolpert_IEI, get_res_offsets, shift_res, merge_res
+from bout_analysis.epoch_store import EPOCH_DATA_KEYS, EPOCH_INDEX_COLUMNS, append_epoch_data, copy_epoch_data, get_epoch_data_columns
+from bout_analysis.dlm_cache import get_cache_file, get_dlm_state, remove_file_res, save_file_res, read_file_info, read_file_res, is_cache_current, read_manifest, save_manifest, remove_manifest, save_telemetry, read_telemetry, has_epoch_data, prune_epoch_data
+from bout_analysis.scheduler import SCHEDULE_REPORT, sort_by_size, get_schedule_report
+from bout_analysis.memory_budget import MONITOR_INTERVAL, DEFAULT_BYTES_PER_FRAME, estimate_frames, get_rss, get_pool_rss, measure_bytes_per_frame, select_task, adjust_concurrency
+from bout_analysis.task_guard import FAILURES_REPORT, init_worker, run_guarded, stop_worker, get_failure, log_failure, run_with_retries, save_failures_report
+from bout_analysis.prefetch import prefetch, start_writer, write, stop_writer
+from bout_analysis import telemetry
+from bout_analysis.telemetry import start_stage, end_stage
+from multiprocessing import Pool, current_process
 import multiprocessing.pool as mpp
 import tqdm
 
 global grab_fish_angle_ver
-grab_fish_angle_ver = 'v5.3.20230816'
+grab_fish_angle_ver = 'v5.4.20261019'
+
+# Constants independent of frame rate. Other constants are defined in grab_fish_angle()
+PROPULSION_THRESHOLD = 5  # mm/s, speed threshold above which samples are considered propulsion
+BASELINE_THRESHOLD = 2  # mm/s, speed threshold below which samples are considered at baseline (not propelling)
+MIN_SWIM_INTERVAL = 0.1  # s, minimum swim interval duration
 
 # %%
 # Define functions
@@ -59,35 +97,7 @@ def read_parameters(ini_file):
     Returns:
         DataFrame: extracted parameters
     """
-    config = configparser.ConfigParser()
-    config.read(ini_file)
-    box_number = config.getint('User-defined parameters','Box number')
-    genotype = config.get('User-defined parameters','Genotype').replace('"','')
-    age = config.getint('User-defined parameters','Age')
-    notes = config.get('User-defined parameters','Notes').replace('"','')
-    initials = config.get('User-defined parameters','Inititals').replace('"','')
-    light_cycle = config.getint('User-defined parameters','Light cycle')
-    dir = config.get('User-defined parameters','Save data to?').replace('"','')
-    line_1 = config.getint('User-defined parameters','Mom line number')
-    line_2 = config.getint('User-defined parameters','Dad line number')
-    cross_id = config.get('User-defined parameters','cross ID').replace('"','')
-    num_fish = config.getint('User-defined parameters','Num fish')
-    filename = config.get('User-defined parameters','Filename').replace('"','')
-    parameters = pd.DataFrame({
-        'box_number':box_number,
-        'genotype':genotype,
-        'age':age,
-        'notes':notes,
-        'initials':initials,
-        'light_cycle':light_cycle,
-        'dir':dir,
-        'line_1':line_1,
-        'line_2':line_2,
-        'cross_id':cross_id,
-        'num_fish':num_fish,
-        'filename':filename,
-    }, index=[0])
-    return parameters
+    return to_parameter_frame([parse_ini(ini_file)])
 
 
 def grp_by_epoch(df):
@@ -138,23 +148,22 @@ def smooth_ML(a,WSZ):
 # analyzed = pd.read_pickle(filenames[file_i])
 # fish_length = pd.read_pickle(f"./data/{file_i+1}_fish_length.pkl")
 
-def grab_fish_angle(analyzed, fish_length,sample_rate):
+def grab_fish_angle(analyzed, fish_length,sample_rate, index_offset=0):
     """    Function to analyze epochs, find bouts, and calculate things we care
 
     Args:
         analyzed (DataFrame): 
         fish_length (int): 
         sample_rate (int): 
+        index_offset (int, optional): number of rows in grabbed_all of previous chunks, if analyzed is a chunk of the .dlm file. Defaults to 0.
 
     Returns:
         dict: one dictionary with multiple dataframes
     """
+    tic = start_stage()
     # %%
     # Constants
-    PROPULSION_THRESHOLD = 5  # mm/s, speed threshold above which samples are considered propulsion
-    BASELINE_THRESHOLD = 2  # mm/s, speed threshold below which samples are considered at baseline (not propelling)
     SAMPLE_RATE = sample_rate  # Hz
-    MIN_SWIM_INTERVAL = 0.1  # s, minimum swim interval duration
     POST_BOUT_BUF = math.ceil(0.1 * SAMPLE_RATE)  # 4 frames for 40hz
     PRE_BOUT_BUF = math.ceil(0.1 * SAMPLE_RATE)  # 4 frames for 40hz
     BOUT_WINDOW_HALF = math.ceil(0.3 * SAMPLE_RATE)  # 12 frames for 40hz, changed in v4
@@ -427,6 +436,7 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
     #     PropBoutHeadingPairsIEIyVel
     #     PropBoutHeadingPairsSecondAlignedPitch
     #     PropBoutHeadingPairsSecondAlignedHeading
+    tic = end_stage(tic, 'bout_detection', frames=len(df), bouts=len(bout_attributes))
     # %%
     # now, all the information we need to extract bouts are stored in bout_attributes. Get bouts to align and re_index for upcoming analysis
     bout_aligned = bout_attributes.loc[bout_attributes['if_align']].reset_index(drop=True)
@@ -536,7 +546,7 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
         ].assign(bout_i=[i]*All_Aligned_FRAMES, frame_i=range(All_Aligned_FRAMES))
         for i, bout in bout_aligned.iterrows()  # loop through bouts
         # add a condition for inflect alignment
-        if bout['boutInflectAlign'] > PRE_PEAK_FRAMES and bout['boutInflectAlign'] < df.loc[df['epochNum']==bout['epochNum']].index.max()-POST_PEAK_FRAMES
+        if bout['boutInflectAlign'] + index_offset > PRE_PEAK_FRAMES and bout['boutInflectAlign'] < df.loc[df['epochNum']==bout['epochNum']].index.max()-POST_PEAK_FRAMES
     ]).set_index(['bout_i','frame_i']).rename(columns={
         'angVelSmoothed':'propBoutInflAligned_angVel',
         'swimSpeed':'propBoutInflAligned_speed',
@@ -708,6 +718,7 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
         fisn_length = bout_attributes['epochNum'].map(fish_length.set_index('epochNum').to_dict()['fishLenEst'])
     )
 
+    tic = end_stage(tic, 'alignment', frames=len(df), bouts=len(bout_res2))
     # print(".", end="")
     # %% [markdown]
     # ## Extract IEI values
@@ -845,16 +856,8 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
                                     'yvel':'propBoutIEIAligned_yvel'})
 
     # find matching IEI, pre-IEI pitch and post-IEI net rotation
-    IEI_wolpert = pd.DataFrame({
-        # wolpert values starts from the second IEI, thus exclude the first IEI match index
-        'IEI_matchIndex': IEI_res2.loc[1:,'IEI_matchIndex'].tolist(),
-        # only get the pre IEI value, exclude the last speed_window_start.diff(). Be aware that df.loc[a:b] includes both a and b
-        'wolpert_IEI': IEI_res2.loc[:len(IEI_res2)-2,'propBoutIEI'].tolist(),
-        # same as above, exclude the last pitch
-        'wolpert_preIEI_pitch': IEI_res2.loc[:len(IEI_res2)-2,'propBoutIEI_pitchFirst'].tolist(),
-        'wolpert_postIEI_netRot': (IEI_res2.loc[1:,'propBoutIEI_pitchFirst'].values - IEI_res2.loc[:len(IEI_res2)-2,'propBoutIEI_pitchLast'].values).tolist(),
-        'wolpert_Time': IEI_res2.loc[1:,'propBoutIEItime'].tolist()
-        })
+    IEI_wolpert = get_wolpert_IEI(IEI_res2)
+    tic = end_stage(tic, 'IEI_extraction', frames=len(df), bouts=len(IEI_res2))
 
     # %% [markdown]
     # ## Acqure epoch information
@@ -865,7 +868,8 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
     # get angular vel at baseline speed. store separately. TO SAVE
     all_baseline_angVel = df.loc[df['swimSpeed']<BASELINE_THRESHOLD,['angVel','epochNum']]
     # get average of angvel per epoch
-    epoch_attributes = pd.DataFrame(index=range(len(grouped_df.size())))
+    # index by epochNum so that values are assigned to matching epochs, then reset index to epoch order
+    epoch_attributes = pd.DataFrame(index=grouped_df.size().index)
     epoch_attributes = epoch_attributes.assign(
         mean_bl_angVel = grp_by_epoch(all_baseline_angVel)[['angVel']].mean(),
         epoch_absTime = grouped_df.head(1)['absTime'].values,
@@ -875,7 +879,7 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
         epoch_pause_yvel = grouped_df.apply(lambda e: e.loc[e['swimSpeed']<BASELINE_THRESHOLD,'yvel'].mean()),
         epoch_bout_yvel = grouped_df.apply(lambda e: e.loc[e['swimSpeed']>PROPULSION_THRESHOLD,'yvel'].mean()),
         yvel_mean = grouped_df.apply(lambda e: e.loc[e['swimSpeed']>PROPULSION_THRESHOLD,'yvel'].mean()),
-    ).reset_index()
+    ).reset_index(drop=True).reset_index()
 
     # print(".", end='')
 
@@ -916,6 +920,8 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
         )
     )
 
+    end_stage(tic, 'epoch_attributes', frames=len(df))
+
     # output dictionary
     output = {'grabbed_all':df,  # note, this is different from MATLAB grabbed values (line 694). Here, only epochs with bouts (max_swimSpeed filtered) are included
               'baseline_angVel':all_baseline_angVel,  # angVel of swimSpeed < baseline threshold
@@ -937,7 +943,207 @@ def grab_fish_angle(analyzed, fish_length,sample_rate):
 
     return output
 
-def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
+def split_epochs(analyzed, n_shards):
+    """split epochs into shards of continuous epochs with similar number of frames.
+    Epochs without propulsion are dropped, same as in grab_fish_angle()
+
+    Args:
+        analyzed (DataFrame): output of analyze_dlm_resliced()
+        n_shards (int): number of shards
+
+    Returns:
+        list: DataFrames of shards
+    """
+    df = analyzed.loc[grp_by_epoch(analyzed)['swimSpeed'].transform('max') >= PROPULSION_THRESHOLD]
+    epoch_rows = grp_by_epoch(df).size()
+    # assign each epoch to a shard by the row it starts at
+    shard_of_epoch = np.minimum((epoch_rows.cumsum() - epoch_rows) * n_shards // max(len(df),1), n_shards-1)
+    shard_idx = df['epochNum'].map(shard_of_epoch).values
+    return [shard for _, shard in df.groupby(shard_idx, sort=True)]
+
+def grab_fish_angle_sharded(analyzed, fish_length, sample_rate, n_shards, index_offset=0):
+    """Run grab_fish_angle() on shards of epochs in parallel and merge results. Used for single .dlm files with many epochs.
+    Results are the same as grab_fish_angle(analyzed), see stitch_res.py for details.
+    Worker processes (e.g. from runMP) cannot start a pool, in which case shards are not used.
+
+    Args:
+        analyzed (DataFrame): output of analyze_dlm_resliced()
+        fish_length (DataFrame): output of analyze_dlm_resliced()
+        sample_rate (int): frame rate
+        n_shards (int): number of shards, which is also the number of processes
+        index_offset (int, optional): see grab_fish_angle(). Defaults to 0.
+
+    Returns:
+        dict: one dictionary with multiple dataframes, same as grab_fish_angle()
+    """
+    if current_process().daemon:
+        return grab_fish_angle(analyzed, fish_length, sample_rate, index_offset)
+    shards = split_epochs(analyzed, n_shards)
+    if len(shards) < 2:
+        return grab_fish_angle(analyzed, fish_length, sample_rate, index_offset)
+    shard_offsets = np.cumsum([0] + [len(shard) for shard in shards[:-1]]) + index_offset
+    with Pool(len(shards)) as pool:
+        res_shards = pool.starmap(grab_fish_angle, [(shard, fish_length, sample_rate, offset) for shard, offset in zip(shards, shard_offsets)])
+    if any(type(res) == str for res in res_shards):
+        # some shards have no aligned bouts. analyze all epochs together
+        return grab_fish_angle(analyzed, fish_length, sample_rate, index_offset)
+    # shift and merge
+    offsets = None
+    for shard_i, res in enumerate(res_shards):
+        if offsets:
+            res_shards[shard_i] = shift_res(res, offsets)
+        offsets = get_res_offsets(res_shards[shard_i], offsets)
+    return merge_res(res_shards, list(res_shards[0].keys()))
+
+def grab_fish_angle_chunks(i, file, folder, frame_rate, chunk_rows, n_shards=None):
+    """Read and analyze one .dlm file in chunks of complete epochs. Peak memory is set by chunk_rows instead of the file size.
+    Results of each chunk are shifted to continue from previous chunks, see stitch_res.py
+
+    Args:
+        i (int): index of the file in the folder
+        file (string): .dlm directory
+        folder (string): directory of folder containing the current dlm
+        frame_rate (int): frame rate
+        chunk_rows (int): number of .dlm rows to read at a time
+        n_shards (int, optional): if given, epochs of each chunk are analyzed in n_shards processes. Defaults to None.
+
+    Yields:
+        dict: shifted output of grab_fish_angle() for one chunk
+        DataFrame: estimated fish length of the chunk
+        string: analyze_dlm version
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    offsets = None
+    fishNum_offset = 0
+    # chunks without aligned bouts are analyzed together with the next chunk
+    analyzed_carry = pd.DataFrame()
+    fish_length_carry = pd.DataFrame()
+    chunks = read_dlm_chunks(i, file, chunk_rows)
+    while True:
+        tic = start_stage()
+        raw = next(chunks, None)
+        if raw is None:
+            break
+        end_stage(tic, 'read_dlm', frames=len(raw))
+        analyzed, fish_length, analyze_dlm_ver = analyze_dlm_resliced(raw, i, file, folder, frame_rate, fishNum_offset)
+        fishNum_offset += raw['fishNum'].sum()
+        del raw
+        if type(analyzed) == str:
+            continue
+        analyzed = pd.concat([analyzed_carry, analyzed], ignore_index=True)
+        fish_length = pd.concat([fish_length_carry, fish_length], ignore_index=True)
+        if n_shards:
+            res = grab_fish_angle_sharded(analyzed, fish_length, frame_rate, n_shards, index_offset=offsets['row'] if offsets else 0)
+        else:
+            res = grab_fish_angle(analyzed, fish_length, frame_rate, index_offset=offsets['row'] if offsets else 0)
+        if type(res) == str:
+            analyzed_carry, fish_length_carry = analyzed, fish_length
+            continue
+        analyzed_carry, fish_length_carry = pd.DataFrame(), pd.DataFrame()
+        if offsets:
+            res = shift_res(res, offsets)
+        offsets = get_res_offsets(res, offsets)
+        yield res, fish_length, analyze_dlm_ver
+    if len(analyzed_carry):
+        logger.warning(f"> no bout aligned in the last {analyzed_carry['epochNum'].nunique()} epochs > epochs skipped")
+
+def read_exp_parameters(filenames, folder):
+    """read .ini files of .dlm files, if there's any, and save them as dlm metadata.csv
+
+    Args:
+        filenames (list): .dlm directories
+        folder (string): root directory
+
+    Returns:
+        DataFrame: experiment parameters, one row per .ini file. Empty if no .ini file is found
+    """
+    packed_files = [name for name in filenames if get_pack(name)]
+    # next to each .dlm file, which may be outside the folder if arranged by a data manifest. read in threads
+    exp_parameters = read_dlm_parameters([name for name in filenames if not get_pack(name)])
+    # parameters.ini of packed .dlm files are saved in the container
+    packed_rows = []
+    for name in packed_files:
+        this_par = read_packed_parameters(name)
+        if this_par is None:
+            continue
+        packed_rows.append({
+            **this_par.iloc[0].to_dict(),
+            'dlm_loc':name,
+            'dlm_size':get_dlm_size(name),
+            'ini_loc':os.path.join(get_pack(name), get_dlm_name(name)+" parameters.ini"),
+        })
+    if packed_rows:
+        exp_parameters = pd.concat([exp_parameters, to_parameter_frame(packed_rows, ['dlm_loc', 'dlm_size', 'ini_loc'])], ignore_index=True)
+    if not exp_parameters.empty:
+        exp_parameters = exp_parameters.sort_values(by=['filename']).reset_index(drop=True)
+        exp_parameters.to_csv(f"{folder}/dlm metadata.csv")
+    return exp_parameters
+
+def analyze_file(i, file, folder, frame_rate, epoch_dir=None, epoch_h5_name='all_data.h5', if_new_epoch_file=True, if_epoch_float32=False, chunk_rows=None, n_shards=None, raw=None, write_queue=None):
+    """run analyze_dlm() and grab_fish_angle() on one .dlm file. Epoch data are appended to epoch_dir/epoch_h5_name
+
+    Args:
+        i (int): index of the file in the folder
+        file (string): .dlm directory
+        folder (string): directory of folder containing the current dlm
+        frame_rate (int): frame rate
+        epoch_dir (string, optional): folder to save epoch data. Defaults to None (epoch data not saved).
+        epoch_h5_name (string, optional): name of the h5 file to save epoch data. Defaults to 'all_data.h5'.
+        if_new_epoch_file (bool, optional): whether to overwrite the h5 file of epoch data. Defaults to True.
+        if_epoch_float32 (bool, optional): whether to save float columns of epoch data as float32. Defaults to False.
+        chunk_rows (int, optional): see run(). Defaults to None.
+        n_shards (int, optional): see run(). Defaults to None.
+        raw (DataFrame, optional): output of read_dlm(), e.g. read ahead by prefetch(). Modified by the analysis. Defaults to None (read the file).
+        write_queue (Queue, optional): writer of epoch data, see prefetch.py. Defaults to None (written here).
+
+    Returns:
+        dict: bout and IEI data. A message (string) if the file is skipped
+        DataFrame: estimated fish length
+        string: analyze_dlm version
+        dict: column names of each key of epoch data
+    """
+    epoch_data_columns = dict.fromkeys(EPOCH_DATA_KEYS, [])
+    if chunk_rows:
+        # streaming mode. save epoch data chunk by chunk, stitch bout and IEI data
+        res_chunks = []
+        fish_length = pd.DataFrame()
+        analyze_dlm_ver = None
+        for res, fish_length_chunk, analyze_dlm_ver in grab_fish_angle_chunks(i, file, folder, frame_rate, chunk_rows, n_shards):
+            if epoch_dir:
+                tic = start_stage()
+                write(write_queue, folder, file, append_epoch_data, epoch_dir, res, file, if_new_epoch_file and not res_chunks, if_epoch_float32, epoch_h5_name)
+                end_stage(tic, 'write_epoch_data', frames=len(res['grabbed_all']))
+            epoch_data_columns = {key:res[key].columns.to_list() for key in EPOCH_DATA_KEYS}
+            res_chunks.append({key:res[key] for key in BOUT_IEI_DATA_KEYS})
+            fish_length = pd.concat([fish_length, fish_length_chunk], ignore_index=True)
+        if not res_chunks:
+            return "> no bout aligned > dlm file skipped", fish_length, analyze_dlm_ver, epoch_data_columns
+        return merge_res(res_chunks, BOUT_IEI_DATA_KEYS), fish_length, analyze_dlm_ver, epoch_data_columns
+    if raw is None:
+        tic = start_stage()
+        raw = read_dlm(i, file)
+        end_stage(tic, 'read_dlm', frames=len(raw))
+    analyzed, fish_length, analyze_dlm_ver = analyze_dlm_resliced(raw, i, file, folder, frame_rate)
+    del raw
+    if type(analyzed) == str:
+        return analyzed, pd.DataFrame(), analyze_dlm_ver, epoch_data_columns
+    if n_shards:
+        # stages in shard processes are not recorded
+        tic = start_stage()
+        res = grab_fish_angle_sharded(analyzed, fish_length, frame_rate, n_shards)
+        end_stage(tic, 'grab_fish_angle_sharded', frames=len(analyzed))
+    else:
+        res = grab_fish_angle(analyzed, fish_length,frame_rate)
+    if type(res) == str:
+        return res, fish_length, analyze_dlm_ver, epoch_data_columns
+    if epoch_dir:
+        tic = start_stage()
+        write(write_queue, folder, file, append_epoch_data, epoch_dir, res, file, if_new_epoch_file, if_epoch_float32, epoch_h5_name)
+        end_stage(tic, 'write_epoch_data', frames=len(res['grabbed_all']))
+    epoch_data_columns = {key:res[key].columns.to_list() for key in EPOCH_DATA_KEYS}
+    return {key:res[key] for key in BOUT_IEI_DATA_KEYS}, fish_length, analyze_dlm_ver, epoch_data_columns
+
+def run(filenames, folder, frame_rate:int, if_epoch_data:bool, if_epoch_float32:bool=False, chunk_rows=None, n_shards=None, if_telemetry:bool=False):
     """    Loop through all .dlm, run analyze_dlm() and grab_fish_angle() functions. Concatinate results from different .dlm files
 
     Args:
@@ -945,88 +1151,112 @@ def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
         folder (string): root directory
         frame_rate (int): frame rate
         if_epoch_data (bool): whether to save epoch data
+        if_epoch_float32 (bool, optional): whether to save float columns of epoch data as float32. Defaults to False.
+        chunk_rows (int, optional): if given, read and analyze each .dlm in chunks of about chunk_rows rows to limit memory use. Defaults to None (whole file).
+        n_shards (int, optional): if given, split epochs of each .dlm into n_shards and analyze them in parallel. Only works when run() is called from the main process. Defaults to None.
+        if_telemetry (bool, optional): whether to record time and memory use of each stage, saved as analysis telemetry.csv/.json. Defaults to False.
     """
     
     logger = log_SAMPL_ana('SAMPL_ana_log')
     logger.info(f'Folder analyzed: {folder}')
+    telemetry.enable(if_telemetry)
 
     # initialize output vars
-    grabbed_all = pd.DataFrame()
-    baseline_angVel = pd.DataFrame()
-    bout_attributes = pd.DataFrame()
-    prop_bout_aligned = pd.DataFrame()
-    prop_bout2 = pd.DataFrame()
-    prop_bout_aligned_long = pd.DataFrame()
-    prop_bout_aligned_long2 = pd.DataFrame()
-    IEI_attributes = pd.DataFrame()
-    prop_bout_IEI_aligned = pd.DataFrame()
-    prop_bout_IEI2 = pd.DataFrame()
-    prop_bout_IEI_timed = pd.DataFrame()
-    wolpert_IEI = pd.DataFrame()
-    epoch_attributes = pd.DataFrame()
-    heading_matched = pd.DataFrame()
-    epoch_pitch_heading_RMS = pd.DataFrame()
-
-    total_bouts_aligned = 0
+    # epoch data are appended to all_data.h5 file by file, keep column names for catalog only
+    epoch_data_columns = dict.fromkeys(EPOCH_DATA_KEYS, [])
+    if_epoch_data_saved = False
+    res_list = []
     metadata_from_bouts = pd.DataFrame()
+    fish_length = pd.DataFrame()
+    analyze_dlm_ver = None
 
-    # read ini files of dlm files, if there's any
-    par_files = [name.split(".dlm")[0]+" parameters.ini" for name in filenames]
-    all_ini_files = glob.glob(f"{folder}/*.ini")
-    ini_files_to_read = list(set(par_files).intersection(all_ini_files))
-    exp_parameters = pd.DataFrame()
-    if ini_files_to_read:
-        for i, this_par_file in enumerate(ini_files_to_read):
-            this_par = read_parameters(this_par_file)
-            this_par = this_par.assign(
-                dlm_loc = filenames[i],
-                dlm_size = os.path.getsize(filenames[i]),
-                ini_loc = this_par_file,
-                )
-            exp_parameters = pd.concat([exp_parameters, this_par],ignore_index=True)
-        exp_parameters = exp_parameters.sort_values(by=['filename']).reset_index(drop=True)
-        exp_parameters.to_csv(f"{folder}/dlm metadata.csv")
-
+    exp_parameters = read_exp_parameters(filenames, folder)
 
     # analyze dlm
     for i, file in enumerate(filenames):
         logger.info(f"File {i}: {file[-19:]}")
-        raw = read_dlm(i, file)
-        analyzed, fish_length, analyze_dlm_ver = analyze_dlm_resliced(raw, i, file, folder, frame_rate)
-        if type(analyzed) == str:
-            # print(analyzed)
-            logger.warning(analyzed)
-            continue
-        res = grab_fish_angle(analyzed, fish_length,frame_rate)
+        telemetry.set_context(folder=folder, file=file)
+        res, fish_length_file, analyze_dlm_ver, epoch_data_columns_file = analyze_file(
+            i, file, folder, frame_rate, epoch_dir=folder if if_epoch_data else None, if_new_epoch_file=not if_epoch_data_saved,
+            if_epoch_float32=if_epoch_float32, chunk_rows=chunk_rows, n_shards=n_shards)
         if type(res) == str:
             # print(res)
             logger.warning(res)
-            continue 
-        this_metadata = {
-            'filename':os.path.basename(file)[0:15],
-            'aligned_bout':len(res['prop_bout2']),
-            'mean_fish_len':fish_length['fishLenEst'].mean(),
-        }
-        this_metadata = pd.DataFrame(data=this_metadata,index=[0])
-        metadata_from_bouts = pd.concat([metadata_from_bouts,this_metadata])
-        # transfer values to final var
-        grabbed_all = pd.concat([grabbed_all, res['grabbed_all']], ignore_index=True)
-        baseline_angVel = pd.concat([baseline_angVel, res['baseline_angVel']], ignore_index=True)
-        bout_attributes = pd.concat([bout_attributes, res['bout_attributes']], ignore_index=True)
-        prop_bout_aligned = pd.concat([prop_bout_aligned, res['prop_bout_aligned']], ignore_index=True)
-        prop_bout2 = pd.concat([prop_bout2, res['prop_bout2']], ignore_index=True)
-        prop_bout_aligned_long = pd.concat([prop_bout_aligned_long, res['prop_bout_aligned_long']], ignore_index=True)
-        prop_bout_aligned_long2 = pd.concat([prop_bout_aligned_long2, res['prop_bout_aligned_long2']], ignore_index=True)
-        IEI_attributes = pd.concat([IEI_attributes, res['IEI_attributes']], ignore_index=True)
-        prop_bout_IEI_aligned = pd.concat([prop_bout_IEI_aligned, res['prop_bout_IEI_aligned']], ignore_index=True)
-        prop_bout_IEI2 = pd.concat([prop_bout_IEI2, res['prop_bout_IEI2']], ignore_index=True)
-        prop_bout_IEI_timed = pd.concat([prop_bout_IEI_timed, res['prop_bout_IEI_timed']], ignore_index=True)
-        wolpert_IEI = pd.concat([wolpert_IEI, res['wolpert_IEI']], ignore_index=True)
-        epoch_attributes = pd.concat([epoch_attributes, res['epoch_attributes']], ignore_index=True)
-        heading_matched = pd.concat([heading_matched, res['heading_matched']], ignore_index=True)
-        epoch_pitch_heading_RMS = pd.concat([epoch_pitch_heading_RMS, res['epoch_pitch_heading_RMS']], ignore_index=True)
-        logger.info(f"Bouts aligned: {this_metadata.loc[0,'aligned_bout']}")
+            continue
+        if_epoch_data_saved = if_epoch_data_saved or if_epoch_data
+        epoch_data_columns, fish_length = epoch_data_columns_file, fish_length_file
+        metadata_from_bouts = pd.concat([metadata_from_bouts, get_file_metadata(file, res, fish_length)])
+        res_list.append(res)
+        logger.info(f"Bouts aligned: {len(res['prop_bout2'])}")
+
+    telemetry.set_context(folder=folder)
+    tic = start_stage()
+    save_folder_res(folder, frame_rate, res_list, metadata_from_bouts, exp_parameters, fish_length, analyze_dlm_ver, epoch_data_columns, if_epoch_data_saved)
+    end_stage(tic, 'write_folder_results')
+    if if_telemetry:
+        telemetry.save_run_report(telemetry.pop_records(), folder)
+
+def get_file_metadata(file, res=None, fish_length=None, file_info=None):
+    """get metadata of one .dlm file from its bouts, or from file_info saved by run_file()
+
+    Args:
+        file (string): .dlm directory
+        res (dict, optional): bout and IEI data of the file
+        fish_length (DataFrame, optional): estimated fish length of the file
+        file_info (Series, optional): file info of the file, used instead of res and fish_length
+
+    Returns:
+        DataFrame: one row
+    """
+    if file_info is not None:
+        aligned_bout, mean_fish_len = file_info['aligned_bout'], file_info['mean_fish_len']
+    else:
+        aligned_bout, mean_fish_len = len(res['prop_bout2']), fish_length['fishLenEst'].mean()
+    this_metadata = {
+        'filename':os.path.basename(file)[0:15],
+        'aligned_bout':aligned_bout,
+        'mean_fish_len':mean_fish_len,
+    }
+    return pd.DataFrame(data=this_metadata,index=[0])
+
+def append_bout_IEI_data(output_dir, res):
+    """append bout and IEI data of new .dlm files to bout_data.h5 and IEI_data.h5. Row indices continue from saved rows
+
+    Args:
+        output_dir (string): folder containing bout_data.h5 and IEI_data.h5
+        res (dict): bout and IEI data of new .dlm files
 
+    Returns:
+        dict: empty tables with columns of saved tables, for catalogs
+    """
+    saved_columns = {}
+    for h5_name, keys in [('bout_data.h5', BOUT_IEI_DATA_KEYS[:5]), ('IEI_data.h5', BOUT_IEI_DATA_KEYS[5:])]:
+        with pd.HDFStore(f'{output_dir}/{h5_name}', mode='a') as store:
+            for key in keys:
+                offset = store.get_storer(key).nrows if key in store else 0
+                if len(res[key]):
+                    store.append(key, res[key].set_axis(np.arange(offset, offset+len(res[key]))))
+                saved_columns[key] = store.select(key, stop=0) if key in store else res[key]
+    return saved_columns
+
+def save_folder_res(folder, frame_rate, res_list, metadata_from_bouts, exp_parameters, fish_length, analyze_dlm_ver, epoch_data_columns, if_epoch_data_saved, if_append=False):
+    """concatenate bout and IEI data of .dlm files in a folder, save them with metadata, catalogs and analysis info
+
+    Args:
+        folder (string): root directory
+        frame_rate (int): frame rate
+        res_list (list): bout and IEI data of each .dlm file, in the order of file names
+        metadata_from_bouts (DataFrame): output of get_file_metadata() of each .dlm file
+        exp_parameters (DataFrame): output of read_exp_parameters()
+        fish_length (DataFrame): estimated fish length of the last .dlm file
+        analyze_dlm_ver (string): analyze_dlm version
+        epoch_data_columns (dict): column names of each key of epoch data
+        if_epoch_data_saved (bool): whether epoch data are saved to all_data.h5
+        if_append (bool, optional): whether to append res_list to saved bout and IEI data, for new .dlm files only.
+            metadata_from_bouts should still include all .dlm files. Defaults to False.
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    res = {key:pd.concat([this_res[key] for this_res in res_list], ignore_index=True) if res_list else pd.DataFrame() for key in BOUT_IEI_DATA_KEYS}
 
     logger.info(f"dlm analysis program ver: {analyze_dlm_ver}")
     logger.info(f"grab fish angle program ver: {grab_fish_angle_ver}")
@@ -1035,7 +1265,7 @@ def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
     metadata_from_bouts.reset_index(drop=True, inplace=True)
     metadata_from_bouts = metadata_from_bouts.sort_values(by=['filename']).reset_index(drop=True)
     if_exp_metadata_arrScript = glob.glob(f"{folder}/*metadata.csv")
-    if not ini_files_to_read:   # if no ini file detected
+    if exp_parameters.empty:   # if no ini file detected
         if if_exp_metadata_arrScript:   # pull metadata from metadata.csv if possible
             if_exp_metadata_arrScript = if_exp_metadata_arrScript[0]
             exp_metadata_arrScript = pd.read_csv(if_exp_metadata_arrScript, index_col=0)
@@ -1044,7 +1274,7 @@ def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
             metadata_merged = metadata_from_bouts.merge(exp_metadata_arrScript, on='filename')
         else:  # there's nothing. user must have manually transferred dlm files to this folder
             metadata_merged = pd.DataFrame()
-            logger.warning("No metadata detected!")
+            logger.warning("No metadata detected!", extra={'folder':folder, 'stage':'save_folder_res'})
     else:   # if metadata detected, exp_parameters should have values
         metadata_merged = metadata_from_bouts.merge(exp_parameters, on='filename')
 
@@ -1055,40 +1285,49 @@ def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
     metadata_merged.to_csv(os.path.join(condition_folder,f"{exp_name} metadata.csv"))
 
     total_bouts_aligned = metadata_from_bouts['aligned_bout'].sum()
-    logger.info(f"Total bout number: {total_bouts_aligned}")
+    logger.info(f"Total bout number: {total_bouts_aligned}", extra={'folder':folder, 'stage':'save_folder_res', 'bouts_aligned':total_bouts_aligned})
     # %%
     output_dir = folder
-    if if_epoch_data:
-        grabbed_all.to_hdf(f'{output_dir}/all_data.h5', key='grabbed_all', mode='w', format='table')
-        baseline_angVel.to_hdf(f'{output_dir}/all_data.h5', key='baseline_angVel', format='table')
-        epoch_attributes.to_hdf(f'{output_dir}/all_data.h5', key='epoch_attributes', format='table')
-        heading_matched.to_hdf(f'{output_dir}/all_data.h5', key='heading_matched', format='table')
-        epoch_pitch_heading_RMS.to_hdf(f'{output_dir}/all_data.h5', key='epoch_pitch_heading_RMS', format='table')
-    else:
+    if not if_epoch_data_saved:
         pd.DataFrame().to_hdf(f'{output_dir}/all_data.h5', key='grabbed_all', mode='w', format='table')
         
-    bout_attributes.to_hdf(f'{output_dir}/bout_data.h5', key='bout_attributes', mode='w', format='table')
-    prop_bout_aligned.to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout_aligned', format='table')
-    prop_bout2.to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout2', format='table')
-    prop_bout_aligned_long.to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout_aligned_long', format='table')
-    prop_bout_aligned_long2.to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout_aligned_long2', format='table')
-    IEI_attributes.to_hdf(f'{output_dir}/IEI_data.h5', key='IEI_attributes', mode='w', format='table')
-    prop_bout_IEI_aligned.to_hdf(f'{output_dir}/IEI_data.h5', key='prop_bout_IEI_aligned', format='table')
-    prop_bout_IEI2.to_hdf(f'{output_dir}/IEI_data.h5', key='prop_bout_IEI2', format='table')
-    prop_bout_IEI_timed.to_hdf(f'{output_dir}/IEI_data.h5', key='prop_bout_IEI_timed', format='table')
-    wolpert_IEI.to_hdf(f'{output_dir}/IEI_data.h5', key='wolpert_IEI', format='table')
+    if if_append:
+        res = append_bout_IEI_data(output_dir, res)
+    else:
+        res['bout_attributes'].to_hdf(f'{output_dir}/bout_data.h5', key='bout_attributes', mode='w', format='table')
+        res['prop_bout_aligned'].to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout_aligned', format='table')
+        res['prop_bout2'].to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout2', format='table')
+        res['prop_bout_aligned_long'].to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout_aligned_long', format='table')
+        res['prop_bout_aligned_long2'].to_hdf(f'{output_dir}/bout_data.h5', key='prop_bout_aligned_long2', format='table')
+        res['IEI_attributes'].to_hdf(f'{output_dir}/IEI_data.h5', key='IEI_attributes', mode='w', format='table')
+        res['prop_bout_IEI_aligned'].to_hdf(f'{output_dir}/IEI_data.h5', key='prop_bout_IEI_aligned', format='table')
+        res['prop_bout_IEI2'].to_hdf(f'{output_dir}/IEI_data.h5', key='prop_bout_IEI2', format='table')
+        res['prop_bout_IEI_timed'].to_hdf(f'{output_dir}/IEI_data.h5', key='prop_bout_IEI_timed', format='table')
+        res['wolpert_IEI'].to_hdf(f'{output_dir}/IEI_data.h5', key='wolpert_IEI', format='table')
+    bout_attributes = res['bout_attributes']
+    prop_bout_aligned = res['prop_bout_aligned']
+    prop_bout2 = res['prop_bout2']
+    prop_bout_aligned_long = res['prop_bout_aligned_long']
+    prop_bout_aligned_long2 = res['prop_bout_aligned_long2']
+    IEI_attributes = res['IEI_attributes']
+    prop_bout_IEI_aligned = res['prop_bout_IEI_aligned']
+    prop_bout_IEI2 = res['prop_bout_IEI2']
+    prop_bout_IEI_timed = res['prop_bout_IEI_timed']
+    wolpert_IEI = res['wolpert_IEI']
 
     # %%
     data_file_explained = pd.DataFrame.from_dict(
         {'all_data.h5':[
             'Contains following keys',
             'grabbed_all',
+            'epoch_index',
             'epoch_attributes',
             'baseline_angVel',
             'heading_matched',
             'epoch_pitch_heading_RMS',
             ],
          'grabbed_all':['Contains raw data from dlm files, excluding Epochs with no bout detected.'],
+         'epoch_index':['One row per epoch. row_start:row_stop locate the epoch in grabbed_all. Also includes start/end time, duration and number of bouts'],
          'epoch_attributes':['Attributes for epochs'],
          'baseline_angVel':['all baseline angular velocity'],
          'heading_matched':['heading directions'],
@@ -1124,11 +1363,12 @@ def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
     data_file_explained.to_csv(f'{output_dir}/data_file_explained.csv')
 
     catalog_all_data = pd.DataFrame.from_dict(
-        {'grabbed_all':grabbed_all.columns.to_list(),
-         'epoch_attributes':epoch_attributes.columns.to_list(),
-         'baseline_angVel':baseline_angVel.columns.to_list(),
-         'heading_matched':heading_matched.columns.to_list(),
-         'epoch_pitch_heading_RMS':epoch_pitch_heading_RMS.columns.to_list(),
+        {'grabbed_all':epoch_data_columns['grabbed_all'],
+         'epoch_index':EPOCH_INDEX_COLUMNS,
+         'epoch_attributes':epoch_data_columns['epoch_attributes'],
+         'baseline_angVel':epoch_data_columns['baseline_angVel'],
+         'heading_matched':epoch_data_columns['heading_matched'],
+         'epoch_pitch_heading_RMS':epoch_data_columns['epoch_pitch_heading_RMS'],
             }
     , orient='index')
     catalog_all_data.to_csv(f'{output_dir}/catalog all_data.csv')
@@ -1167,6 +1407,283 @@ def run(filenames, folder, frame_rate:int, if_epoch_data:bool):
     
     print(f"{folder}: total bouts aligned = {total_bouts_aligned}")
 
+def get_analysis_settings(frame_rate:int, if_epoch_data:bool, if_epoch_float32:bool=False):
+    """get analyzer versions, settings and constants that results of a .dlm file depend on. Saved results are reused only if all of them match
+
+    Args:
+        frame_rate (int): frame rate
+        if_epoch_data (bool): whether to save epoch data
+        if_epoch_float32 (bool, optional): whether to save float columns of epoch data as float32. Defaults to False.
+
+    Returns:
+        dict: settings
+    """
+    return {
+        'analyze_dlm_ver':analyze_dlm_ver,
+        'grab_fish_angle_ver':grab_fish_angle_ver,
+        'frame_rate':frame_rate,
+        'if_epoch_data':if_epoch_data,
+        'if_epoch_float32':if_epoch_float32 and if_epoch_data,
+        'PROPULSION_THRESHOLD':PROPULSION_THRESHOLD,
+        'BASELINE_THRESHOLD':BASELINE_THRESHOLD,
+        'MIN_SWIM_INTERVAL':MIN_SWIM_INTERVAL,
+    }
+
+def run_file(i, file, folder, frame_rate:int, if_epoch_data:bool, if_epoch_float32:bool=False, chunk_rows=None, n_shards=None, if_telemetry:bool=False, prefetched=None, write_queue=None):
+    """analyze one .dlm file and save results to <folder>/dlm results/, see dlm_cache.py. Task of runMP and runSP
+
+    Args:
+        i (int): index of the file in the folder
+        file (string): .dlm directory
+        folder (string): directory of folder containing the current dlm
+        frame_rate (int): frame rate
+        if_epoch_data (bool): whether to save epoch data
+        if_epoch_float32 (bool, optional): whether to save float columns of epoch data as float32. Defaults to False.
+        chunk_rows (int, optional): see run(). Defaults to None.
+        n_shards (int, optional): see run(). Not used in runMP workers. Defaults to None.
+        if_telemetry (bool, optional): see run(). Records are saved with results of the .dlm file. Defaults to False.
+        prefetched (dict, optional): outputs of read_dlm() by .dlm directory, see prefetch.py. The file is removed from it when used, so a retry reads it again. Defaults to None.
+        write_queue (Queue, optional): writer of results, see prefetch.py. Defaults to None (written here).
+
+    Returns:
+        dict: timing and memory use of the task, for scheduler.get_schedule_report() and memory_budget.py
+    """
+    start = time.time()
+    rss_start, peak_rss_start = get_rss(if_pss=False), telemetry.get_peak_rss() * 2**20
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    logger.info(f"File {i}: {file}", extra={'folder':folder, 'file':file, 'stage':'run_file'})
+    telemetry.enable(if_telemetry)
+    telemetry.set_context(folder=folder, file=file)
+    cache_file = get_cache_file(file)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # state of the .dlm file before it is read, so that results are not reused if it changes while analyzed.
+    # not hashed, which would read the file again. results are reused after copying only if the modification time is kept
+    dlm_state = get_dlm_state(file, if_hash=False)
+    # through the writer, so that it runs before epoch data of this attempt are written
+    write(write_queue, folder, file, remove_file_res, cache_file)
+    res, fish_length, _, _ = analyze_file(
+        i, file, folder, frame_rate, epoch_dir=os.path.dirname(cache_file) if if_epoch_data else None,
+        epoch_h5_name=os.path.basename(cache_file), if_epoch_float32=if_epoch_float32, chunk_rows=chunk_rows, n_shards=n_shards,
+        raw=prefetched.pop(file, None) if prefetched else None, write_queue=write_queue)
+    if get_dlm_state(file, if_hash=False) != dlm_state:
+        logger.warning(f"{file} changed while analyzed > analyzed again in the next run", extra={'folder':folder, 'file':file, 'stage':'run_file'})
+    file_info = {
+        **dlm_state,
+        'dlm_hash':dlm_state['dlm_hash'] or '',
+        **get_analysis_settings(frame_rate, if_epoch_data, if_epoch_float32),
+        'aligned_bout':0,
+        'mean_fish_len':np.nan,
+        'message':'',
+        'analyzed_at':datetime.now().isoformat(),
+    }
+    log_fields = {'folder':folder, 'file':file, 'stage':'run_file'}
+    if type(res) == str:
+        logger.warning(res, extra=log_fields)
+        file_info['message'] = res
+        res = None
+    else:
+        file_info['aligned_bout'] = len(res['prop_bout2'])
+        file_info['mean_fish_len'] = fish_length['fishLenEst'].mean()
+    logger.info(f"Bouts aligned: {file_info['aligned_bout']}", extra={**log_fields, 'duration':time.time()-start, 'bouts_aligned':file_info['aligned_bout']})
+    tic = start_stage()
+    write(write_queue, folder, file, save_file_res, cache_file, res, fish_length, file_info)
+    end_stage(tic, 'write_file_results')
+    if if_telemetry:
+        write(write_queue, folder, file, save_telemetry, cache_file, telemetry.pop_records())
+    return {
+        'file':file,
+        'folder':folder,
+        'dlm_size':get_dlm_size(file),
+        'worker':current_process().name,
+        'start':start,
+        'end':time.time(),
+        # for memory_budget.measure_bytes_per_frame()
+        'frames':estimate_frames(file),
+        'rss_start':rss_start,
+        'peak_rss_start':peak_rss_start,
+        'peak_rss':telemetry.get_peak_rss() * 2**20,
+    }
+
+def get_merged_file_num(filenames, folder, if_epoch_data:bool):
+    """get the number of .dlm files merged before, for appending new .dlm files to saved results.
+    Files listed in the manifest must be the first files in the order of file names and must not be analyzed again since merging
+
+    Args:
+        filenames (list): .dlm directories
+        folder (string): root directory
+        if_epoch_data (bool): whether to save epoch data
+
+    Returns:
+        int: number of .dlm files merged before. 0 if results should be merged again from the first file
+    """
+    manifest = read_manifest(folder)
+    exp_name = os.path.basename(folder)
+    saved_outputs = ['bout_data.h5', 'IEI_data.h5', 'analysis info.csv', f'../{exp_name} metadata.csv'] + (['all_data.h5'] if if_epoch_data else [])
+    if manifest is None or 'analyzed_at' not in manifest or not all(os.path.exists(os.path.join(folder, output)) for output in saved_outputs):
+        return 0
+    if [os.path.basename(file) for file in filenames[:len(manifest)]] != manifest['file'].to_list():
+        # e.g. new files named before merged files
+        return 0
+    for file, analyzed_at in zip(filenames, manifest['analyzed_at']):
+        file_info = read_file_info(get_cache_file(file))
+        if file_info is None or file_info.get('analyzed_at') != analyzed_at:
+            return 0
+    return len(manifest)
+
+def merge_folder(filenames, folder, frame_rate:int, if_epoch_data:bool, if_telemetry:bool=False, if_append=True):
+    """merge results of .dlm files saved by run_file() in the order of file names. Outputs are the same as run()
+    If the folder was merged before and new .dlm files are named after merged files, only results of new files are appended
+
+    Args:
+        filenames (list): .dlm directories
+        folder (string): root directory
+        frame_rate (int): frame rate
+        if_epoch_data (bool): whether to save epoch data
+        if_telemetry (bool, optional): whether to save the run report of the folder with records of each .dlm file, see run(). Defaults to False.
+        if_append (bool, optional): whether to append new .dlm files to results merged before. Defaults to True.
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    telemetry.enable(if_telemetry)
+    telemetry.set_context(folder=folder)
+    tic = start_stage()
+    merged_file_num = get_merged_file_num(filenames, folder, if_epoch_data) if if_append else 0
+    if merged_file_num:
+        logger.info(f'Folder appended: {folder}, {len(filenames) - merged_file_num} new files', extra={'folder':folder, 'stage':'merge_folder'})
+    else:
+        logger.info(f'Folder merged: {folder}', extra={'folder':folder, 'stage':'merge_folder'})
+    # outputs are incomplete until the manifest is saved. merge again from the first file if interrupted
+    remove_manifest(folder)
+    epoch_data_columns = dict.fromkeys(EPOCH_DATA_KEYS, [])
+    if_epoch_data_saved = bool(merged_file_num) and if_epoch_data
+    res_list = []
+    metadata_from_bouts = pd.DataFrame()
+    last_cache_file = None
+    analyze_dlm_ver = None
+
+    exp_parameters = read_exp_parameters(filenames, folder)
+
+    for file_i, file in enumerate(filenames):
+        cache_file = get_cache_file(file)
+        file_info = read_file_info(cache_file)
+        if file_info is None:
+            # failed, see task_guard.py. analyzed again when resumed
+            logger.warning(f"No results of {file}, merged without it", extra={'folder':folder, 'file':file, 'stage':'merge_folder'})
+            continue
+        analyze_dlm_ver = file_info['analyze_dlm_ver']
+        if file_info['message']:
+            continue
+        last_cache_file = cache_file
+        if file_i < merged_file_num and 'mean_fish_len' in file_info:
+            metadata_from_bouts = pd.concat([metadata_from_bouts, get_file_metadata(file, file_info=file_info)])
+            continue
+        if if_epoch_data and file_i >= merged_file_num and not has_epoch_data(cache_file):
+            # pruned after merging another folder, e.g. a .dlm file arranged into two experiments
+            logger.warning(f"No epoch data of {file}, analyzed again", extra={'folder':folder, 'file':file, 'stage':'merge_folder'})
+            run_file(file_i, file, folder, frame_rate, if_epoch_data, bool(file_info['if_epoch_float32']))
+        res, fish_length, file_info = read_file_res(cache_file)
+        metadata_from_bouts = pd.concat([metadata_from_bouts, get_file_metadata(file, res, fish_length)])
+        if file_i < merged_file_num:
+            continue
+        if if_epoch_data:
+            copy_epoch_data(cache_file, folder, if_new_file=not if_epoch_data_saved)
+            if_epoch_data_saved = True
+        res_list.append(res)
+    if analyze_dlm_ver is None:
+        logger.warning(f"No results of any .dlm file, folder not merged: {folder}", extra={'folder':folder, 'stage':'merge_folder'})
+        return
+    if if_epoch_data_saved:
+        epoch_data_columns = get_epoch_data_columns(folder)
+    fish_length = read_file_res(last_cache_file)[1] if last_cache_file else pd.DataFrame()
+
+    save_folder_res(folder, frame_rate, res_list, metadata_from_bouts, exp_parameters, fish_length, analyze_dlm_ver, epoch_data_columns, if_epoch_data_saved, if_append=bool(merged_file_num))
+    save_manifest(folder, filenames)
+    if if_epoch_data:
+        # copied to all_data.h5. merged again from the first file only if needed, see get_file_input()
+        for file in filenames:
+            prune_epoch_data(get_cache_file(file))
+    end_stage(tic, 'merge_folder')
+    if if_telemetry:
+        records = pd.concat([read_telemetry(get_cache_file(file)) for file in filenames] + [telemetry.pop_records()], ignore_index=True)
+        telemetry.save_run_report(records, folder)
+
+def get_file_input(dlm_input, if_resume=True):
+    """get arguments of run_file() for .dlm files to analyze, largest first
+
+    Args:
+        dlm_input (list): arguments of run() for each folder
+        if_resume (bool, optional): whether to skip .dlm files with saved results of the same settings, see dlm_cache.is_cache_current(). Defaults to True.
+
+    Returns:
+        list: arguments of run_file()
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    file_input = [(i, file, folder, frame_rate, if_epoch_data, if_epoch_float32, chunk_rows, n_shards, if_telemetry)
+                  for filenames, folder, frame_rate, if_epoch_data, if_epoch_float32, chunk_rows, n_shards, if_telemetry in dlm_input
+                  for i, file in enumerate(filenames)]
+    if if_resume:
+        total_files = len(file_input)
+        # epoch data are pruned from saved results after merging, so files of folders to be merged again from the first file are analyzed again
+        merged_file_nums = {folder:get_merged_file_num(filenames, folder, if_epoch_data) if if_epoch_data else 0
+                            for filenames, folder, frame_rate, if_epoch_data, *_ in dlm_input}
+        file_input = [task for task in file_input if not is_cache_current(task[1], get_analysis_settings(*task[3:6]))
+                      or (task[4] and task[0] >= merged_file_nums[task[2]] and not has_epoch_data(get_cache_file(task[1])))]
+        logger.info(f"Resume: {total_files - len(file_input)} of {total_files} .dlm files analyzed before with the same settings, skipped")
+    return sort_by_size(file_input, lambda task: [task[1]])
+
+def get_merge_input(dlm_input):
+    """get arguments of merge_folder() for each folder, largest first
+
+    Args:
+        dlm_input (list): arguments of run() for each folder
+
+    Returns:
+        list: arguments of merge_folder()
+    """
+    merge_input = [(filenames, folder, frame_rate, if_epoch_data, if_telemetry)
+                   for filenames, folder, frame_rate, if_epoch_data, *_, if_telemetry in dlm_input]
+    return sort_by_size(merge_input, lambda task: task[0])
+
+def runSP(dlm_input, if_resume=True, report_dir=None, max_retries=1, if_prefetch=False):
+    """analyze .dlm files one by one in the main process, then merge results of each folder. Outputs are the same as runMP()
+    Results of each .dlm file are saved as soon as it is analyzed, so that an interrupted run can be resumed.
+    Failed tasks are retried and skipped, see task_guard.py. There's no timeout in the main process
+
+    Args:
+        dlm_input (list): arguments of run() for each folder
+        if_resume (bool, optional): whether to skip .dlm files analyzed before with the same settings. Defaults to True.
+        report_dir (string, optional): folder to save the failures report. Defaults to None (not saved).
+        max_retries (int, optional): number of retries of a failed task. Defaults to 1.
+        if_prefetch (bool, optional): whether to read the next .dlm files and write results in background threads while the current file is analyzed, see prefetch.py. Files analyzed in chunks (chunk_rows) are not read ahead. Defaults to False.
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    file_input = get_file_input(dlm_input, if_resume)
+    failures = []
+    failed_files = 0
+    if if_prefetch:
+        write_queue, writer = start_writer(failures)
+        # a failed read is logged when run_file() reads the file again
+        file_reads = prefetch(file_input, lambda task: None if task[6] else read_dlm(task[0], task[1]))
+    else:
+        write_queue = None
+        file_reads = ((task, None, None) for task in file_input)
+    for task, raw, _ in tqdm.tqdm(file_reads, total=len(file_input)):
+        prefetched = {task[1]:raw} if raw is not None else None
+        # freed by analyze_file()
+        del raw
+        timing, task_failures = run_with_retries(run_file, task, task[2], task[1], max_retries,
+                                                 kwargs={'prefetched':prefetched, 'write_queue':write_queue})
+        failures.extend(task_failures)
+        failed_files += timing is None
+    if if_prefetch:
+        # results must be saved before merging
+        stop_writer(write_queue, writer)
+    for task in get_merge_input(dlm_input):
+        failures.extend(run_with_retries(merge_folder, task, task[1], max_retries=max_retries)[1])
+    if failures:
+        logger.warning(f"Failures: {failed_files} of {len(file_input)} .dlm files failed after {max_retries} retries, see {FAILURES_REPORT}")
+    if report_dir:
+        save_failures_report(failures, report_dir)
+
 def istarmap(self, func, iterable, chunksize=1):
     """starmap-version of imap
     """
@@ -1190,8 +1707,170 @@ def istarmap(self, func, iterable, chunksize=1):
 mpp.Pool.istarmap = istarmap
 
 # %%
-def runMP(dlm_input):
-    with Pool() as pool:
-        for _ in tqdm.tqdm(pool.istarmap(run, dlm_input), total=len(dlm_input)):
-            pass
-        # pool.starmap(run, dlm_input)
\ No newline at end of file
+def start_pool(log_queue=None):
+    """start a pool of workers for runMP(), to be kept across runs, e.g. by watch.py
+
+    Args:
+        log_queue (Queue, optional): queue from logger.start_log_listener(). Defaults to None.
+
+    Returns:
+        Pool: pool of workers
+        Queue: queue of task starts in workers, see task_guard.init_worker()
+    """
+    # written without a feeder thread, so that a start is received even if the worker exits right after, e.g. out of memory
+    start_queue = multiprocessing.SimpleQueue()
+    return Pool(initializer=init_worker, initargs=(log_queue, start_queue)), start_queue
+
+# %%
+def runMP(dlm_input, report_dir=None, if_resume=True, log_queue=None, memory_budget_MB=None, max_retries=1, task_timeout_s=None, pool=None, start_queue=None):
+    """analyze .dlm files in parallel, then merge results of each folder. Outputs are the same as calling run() on each folder.
+    .dlm files are analyzed as separate tasks, largest first, so that large files don't hold up the run after other workers are idle.
+    Each folder is merged as soon as all its .dlm files are analyzed, while files of other folders are still running,
+    so dlm_input may combine folders of many root directories in one pool (see SAMPL_analysis_batch()).
+    With a memory budget, tasks are only started while their estimated memory fits, and fewer tasks run when RSS nears the budget, see memory_budget.py
+    A failed task doesn't stop the run. It is retried, then skipped and saved to SAMPL failures report.csv, see task_guard.py
+    Predicted and actual time of each task are saved to SAMPL schedule report.csv, see scheduler.py
+
+    Args:
+        dlm_input (list): arguments of run() for each folder
+        report_dir (string, optional): folder to save the schedule and failures reports. Defaults to None (not saved).
+        if_resume (bool, optional): whether to skip .dlm files analyzed before with the same settings, see dlm_cache.py. Defaults to True.
+        log_queue (Queue, optional): queue from logger.start_log_listener(). Workers send log records to the listener instead of writing the log file. Defaults to None.
+        memory_budget_MB (float, optional): memory of all workers, in MB. Defaults to None (all tasks are queued to the pool at once).
+        max_retries (int, optional): number of retries of a failed task. Defaults to 1.
+        task_timeout_s (float, optional): time limit of each task (.dlm file or folder merge) in seconds. The worker is terminated and the task counts as failed. Defaults to None (no limit).
+        pool (Pool, optional): pool from start_pool(), kept open after the run. Defaults to None (a new pool for this run).
+        start_queue (Queue, optional): queue from start_pool(), required with pool. Defaults to None.
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    file_input = get_file_input(dlm_input, if_resume)
+    merge_input = get_merge_input(dlm_input)
+    # number of .dlm files to analyze before each folder can be merged
+    files_left = defaultdict(int)
+    for task in file_input:
+        files_left[task[2]] += 1
+    merge_args = {task[1]:task for task in merge_input}
+    budget = memory_budget_MB * 2**20 if memory_budget_MB else np.inf
+    bytes_per_frame = DEFAULT_BYTES_PER_FRAME
+    measured_bytes_per_frame = []
+    task_frames = [estimate_frames(task[1]) for task in file_input]
+    waiting = [(task_i, 1) for task_i in range(len(file_input))]  # task and attempt
+    running = {}  # estimated memory of running tasks
+    started = {}  # process id and start time of running tasks, reported by workers
+    dispatched = []  # tasks may be started out of order to fit the budget
+    failures = []
+    finished = queue.Queue()
+    if pool is None:
+        pool, start_queue = start_pool(log_queue)
+        pool_context = pool
+    else:
+        pool_context = contextlib.nullcontext(pool)
+        # starts of tasks of previous runs, e.g. stopped by the timeout
+        while not start_queue.empty():
+            start_queue.get()
+    with pool_context:
+        n_workers = pool._processes
+        max_running = n_workers if memory_budget_MB else len(file_input)
+        timings = {}
+
+        def dispatch(task_key, func, args, task_bytes):
+            running[task_key] = task_bytes
+            pool.apply_async(run_guarded, (task_key, func, args),
+                             callback=lambda output, task_key=task_key: finished.put((task_key, *output)),
+                             error_callback=lambda error, task_key=task_key: finished.put((task_key, None, {'error':type(error).__name__, 'message':str(error), 'traceback':''})))
+
+        def merge_when_ready(folder, attempt=1):
+            if not files_left[folder]:
+                # memory of merging is not estimated
+                dispatch(('merge_folder', folder, attempt), merge_folder, merge_args[folder], 0)
+
+        def retry_or_skip(task_key, error):
+            if task_key[0] == 'merge_folder':
+                _, folder, attempt = task_key
+                failures.append(get_failure('merge_folder', folder, None, attempt, error))
+                log_failure(failures[-1], max_retries)
+                if attempt <= max_retries:
+                    merge_when_ready(folder, attempt + 1)
+                return False
+            task_i, attempt = task_key
+            file, folder = file_input[task_i][1:3]
+            failures.append(get_failure('run_file', folder, file, attempt, error))
+            log_failure(failures[-1], max_retries)
+            if attempt <= max_retries:
+                waiting.append((task_i, attempt + 1))
+                return False
+            files_left[folder] -= 1
+            merge_when_ready(folder)
+            return True
+
+        # folders with all .dlm files analyzed before
+        for task in merge_input:
+            merge_when_ready(task[1])
+        merged_folders = 0
+        progress = tqdm.tqdm(total=len(file_input))
+        # merge tasks are running tasks too, so they are stopped by the timeout and checked for exited workers
+        while waiting or running:
+            while waiting and len(running) < max_running:
+                next_i = select_task([task_frames[task_i] * bytes_per_frame for task_i, _ in waiting], sum(running.values()), budget) if memory_budget_MB else 0
+                if next_i is None:
+                    break
+                task_key = waiting.pop(next_i)
+                dispatched.append(task_key)
+                dispatch(task_key, run_file, file_input[task_key[0]], task_frames[task_key[0]] * bytes_per_frame)
+            try:
+                task_key, timing, error = finished.get(timeout=MONITOR_INTERVAL)
+            except queue.Empty:
+                task_key = None
+            while not start_queue.empty():
+                start_key, pid, start = start_queue.get()
+                started[start_key] = (pid, start)
+            if memory_budget_MB:
+                new_max_running = adjust_concurrency(max_running, len(running), get_pool_rss(pool), budget, n_workers)
+                if new_max_running < max_running:
+                    logger.warning(f"Memory: RSS near the budget of {memory_budget_MB:.0f}MB, at most {new_max_running} tasks running")
+                max_running = new_max_running
+            if task_key in running:
+                del running[task_key]
+                started.pop(task_key, None)
+                if error is not None:
+                    progress.update(retry_or_skip(task_key, error))
+                elif task_key[0] == 'merge_folder':
+                    merged_folders += 1
+                else:
+                    progress.update()
+                    timings[task_key] = timing
+                    measured = measure_bytes_per_frame(timing)
+                    if not np.isnan(measured):
+                        measured_bytes_per_frame.append(measured)
+                        bytes_per_frame = max(measured_bytes_per_frame)
+                    files_left[timing['folder']] -= 1
+                    merge_when_ready(timing['folder'])
+            # tasks still running on terminated or exited workers
+            alive_pids = {process.pid for process in pool._pool if process.exitcode is None}
+            for task_key, (pid, start) in list(started.items()):
+                if task_key not in running or not finished.empty():
+                    continue
+                if task_timeout_s and time.time() - start > task_timeout_s:
+                    stop_worker(pid)
+                    error = {'error':'TimeoutError', 'message':f'no result after {task_timeout_s}s, worker terminated', 'traceback':''}
+                elif pid not in alive_pids:
+                    error = {'error':'WorkerExited', 'message':'worker exited while running the task, e.g. out of memory', 'traceback':''}
+                else:
+                    continue
+                del running[task_key]
+                del started[task_key]
+                progress.update(retry_or_skip(task_key, error))
+        progress.close()
+    failed_files = len(file_input) - len(timings)
+    if failures:
+        logger.warning(f"Failures: {failed_files} of {len(file_input)} .dlm files and {len(merge_input) - merged_folders} of {len(merge_input)} folders failed after {max_retries} retries, see {FAILURES_REPORT}")
+    if report_dir:
+        save_failures_report(failures, report_dir)
+    if not timings:
+        return
+    report, summary = get_schedule_report([timings[task_key] for task_key in dispatched if task_key in timings], n_workers)
+    logger.info(f"Schedule: {summary['tasks']:.0f} files on {summary['workers']:.0f} workers. Makespan predicted {summary['predicted_makespan_s']:.1f}s, actual {summary['actual_makespan_s']:.1f}s")
+    if memory_budget_MB:
+        logger.info(f"Memory: {bytes_per_frame:.0f} bytes per frame, budget {memory_budget_MB:.0f}MB")
+    if report_dir:
+        report.to_csv(os.path.join(report_dir, SCHEDULE_REPORT))
@@ -1,4 +1,27 @@
+import os
+import json
 import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+
+# structured fields of log records, passed as logger.info(msg, extra={...})
+LOG_FIELDS = ['folder','file','stage','duration','bouts_aligned']
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# queue of the log listener. when set, records are sent to the listener in the main process instead of written by each process
+_log_queue = None
+
+class JsonFormatter(logging.Formatter):
+    """format log records as one json object per line, with structured fields
+    """
+    def format(self, record):
+        return json.dumps({
+            'time':self.formatTime(record),
+            'level':record.levelname,
+            'process':record.processName,
+            'message':record.getMessage(),
+            **{field:getattr(record, field, None) for field in LOG_FIELDS},
+        }, default=lambda value: value.item() if hasattr(value, 'item') else str(value))  # numpy numbers
 
 def log_SAMPL_ana(log_name):
     """log analysis results
@@ -6,9 +29,108 @@ def log_SAMPL_ana(log_name):
     logger = logging.getLogger(f'{log_name}')
     logger.setLevel(logging.INFO)
     if not len(logger.handlers):
-        fh = logging.FileHandler(f'{log_name}.log')
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
-    return logger
\ No newline at end of file
+        if _log_queue is not None:
+            logger.addHandler(QueueHandler(_log_queue))
+        else:
+            fh = logging.FileHandler(f'{log_name}.log')
+            fh.setLevel(logging.INFO)
+            formatter = logging.Formatter(LOG_FORMAT)
+            fh.setFormatter(formatter)
+            logger.addHandler(fh)
+    return logger
+
+def init_log_queue(log_queue, log_name='SAMPL_ana_log'):
+    """send log records of the current process to log_queue. Used as the initializer of pool workers
+
+    Args:
+        log_queue (Queue): queue of the log listener, None to write to the log file directly again
+        log_name (str, optional): name of the logger. Defaults to 'SAMPL_ana_log'.
+    """
+    global _log_queue
+    _log_queue = log_queue
+    logger = logging.getLogger(log_name)
+    # forked workers inherit the file handler of the main process
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    log_SAMPL_ana(log_name)
+
+def get_root_filter(root):
+    """filter of log records of folders under a root, by their folder field
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        function: True for records to keep
+    """
+    root = os.path.normpath(root)
+    def root_filter(record):
+        folder = getattr(record, 'folder', None)
+        if not folder:
+            return False
+        folder = os.path.normpath(folder)
+        return folder == root or folder.startswith(root.rstrip(os.sep) + os.sep)
+    return root_filter
+
+def get_log_handlers(log_dir, log_name):
+    """text and json file handlers of a log folder, which is created if missing
+
+    Args:
+        log_dir (string): folder to save log files
+        log_name (str): name of the logger
+
+    Returns:
+        list: handlers of <log_name>.log and <log_name>.jsonl
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    text_handler = logging.FileHandler(os.path.join(log_dir, f'{log_name}.log'))
+    text_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    json_handler = logging.FileHandler(os.path.join(log_dir, f'{log_name}.jsonl'))
+    json_handler.setFormatter(JsonFormatter())
+    return [text_handler, json_handler]
+
+def start_log_listener(log_dir=None, log_name='SAMPL_ana_log', root_log_dirs=None):
+    """write log records of all processes from one listener thread in the main process.
+    Saves <log_name>.log (text) and <log_name>.jsonl (one json record per line, with structured fields) to log_dir
+
+    Args:
+        log_dir (string, optional): folder to save log files of all records. Defaults to None (current directory).
+        log_name (str, optional): name of the logger. Defaults to 'SAMPL_ana_log'.
+        root_log_dirs (dict, optional): root: folder to also save log files of the root, with records of folders under the root (records with a folder field). Defaults to None.
+
+    Returns:
+        Queue: pass to init_log_queue() of pool workers
+        QueueListener: pass to stop_log_listener()
+    """
+    log_dir = log_dir or os.getcwd()
+    handlers = get_log_handlers(log_dir, log_name)
+    for root, root_log_dir in (root_log_dirs or {}).items():
+        if os.path.normpath(root_log_dir) == os.path.normpath(log_dir):
+            # already in the log of all records
+            continue
+        root_handlers = get_log_handlers(root_log_dir, log_name)
+        for handler in root_handlers:
+            handler.addFilter(get_root_filter(root))
+        handlers.extend(root_handlers)
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    init_log_queue(log_queue, log_name)
+    return log_queue, listener
+
+def stop_log_listener(listener, log_name='SAMPL_ana_log'):
+    """write remaining records, close log files and go back to logging without a listener
+
+    Args:
+        listener (QueueListener): output of start_log_listener()
+        log_name (str, optional): name of the logger. Defaults to 'SAMPL_ana_log'.
+    """
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    global _log_queue
+    _log_queue = None
+    logger = logging.getLogger(log_name)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
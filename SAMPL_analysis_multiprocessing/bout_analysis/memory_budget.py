@@ -0,0 +1,127 @@
+'''
+Memory-budget admission control for runMP
+Functions:
+    1. Estimate memory of a task from the number of frames of its .dlm file, using measured bytes per frame
+    2. Admit tasks, largest first, only while estimated memory of running tasks stays within the budget
+    3. Lower the number of running tasks when RSS of the pool nears the budget, raise it again when RSS drops
+
+Memory of a task scales with the number of frames (rows) of its .dlm file. Frames are estimated from the file size and the length of the first rows.
+For compressed .dlm files, rows are counted in the data decompressed from the first SAMPLE_BYTES bytes of the file.
+Bytes per frame start at DEFAULT_BYTES_PER_FRAME and are replaced by the largest value measured on finished tasks.
+A task is measured only if it raised the peak RSS of its worker, since the peak of a worker doesn't drop after a large task.
+RSS is read from /proc (Linux), as PSS where available. On other systems tasks are admitted by estimates only.
+'''
+import os
+import numpy as np
+from preprocessing.read_dlm import iter_dlm_bytes, get_pack, get_packed_info
+
+DEFAULT_BYTES_PER_FRAME = 4096  # ~2.3 KB measured on a 56k-frame .dlm, rounded up
+SAMPLE_BYTES = 2**16  # bytes of the file to read for the length of rows
+RSS_HIGH = 0.9  # lower concurrency when pool RSS is above this fraction of the budget
+RSS_LOW = 0.7  # raise concurrency again when pool RSS is below this fraction of the budget
+MONITOR_INTERVAL = 5  # seconds between RSS checks while waiting for tasks
+
+def estimate_frames(file):
+    """estimate the number of frames of a .dlm file from its size and the length of the first rows
+
+    Args:
+        file (string): .dlm directory, plain, compressed or packed
+
+    Returns:
+        int: estimated number of frames
+    """
+    if get_pack(file):
+        return int(get_packed_info(file)['frames'])
+    dlm_size = os.path.getsize(file)
+    sample, read_size = next(iter_dlm_bytes(file, SAMPLE_BYTES), (b'', 0))
+    rows = sample.count(b'\n')
+    if not rows:
+        return 1
+    return max(1, int(dlm_size * rows / read_size))
+
+def get_rss(pid=None, if_pss=True):
+    """current memory of a process in bytes. Proportional set size (PSS) if available, so that pages shared by forked workers are not counted twice
+
+    Args:
+        pid (int, optional): process id. Defaults to None (current process).
+        if_pss (bool, optional): whether to read PSS. Set to False to compare with the peak RSS. Defaults to True.
+
+    Returns:
+        float: RSS. NaN if not available
+    """
+    try:
+        if if_pss:
+            with open(f"/proc/{pid or 'self'}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        return int(line.split()[1]) * 1024  # kB
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return np.nan
+
+def get_pool_rss(pool):
+    """total RSS of the main process and pool workers in bytes
+
+    Args:
+        pool (Pool): process pool
+
+    Returns:
+        float: RSS. NaN if not available
+    """
+    return get_rss() + sum(get_rss(process.pid) for process in pool._pool)
+
+def measure_bytes_per_frame(timing):
+    """bytes per frame of a finished task
+
+    Args:
+        timing (dict): output of run_file(), with frames, rss_start, peak_rss_start and peak_rss (bytes)
+
+    Returns:
+        float: bytes per frame. NaN if the task didn't raise the peak RSS of its worker
+    """
+    if not timing['peak_rss'] > timing['peak_rss_start']:
+        return np.nan
+    return (timing['peak_rss'] - timing['rss_start']) / timing['frames']
+
+def select_task(task_memory, running_memory, budget):
+    """select the first (largest) waiting task that fits in the budget
+
+    Args:
+        task_memory (list): estimated memory of waiting tasks, largest first
+        running_memory (float): estimated memory of running tasks
+        budget (float): memory budget in bytes
+
+    Returns:
+        int: index of the task to run. 0 if nothing is running, so that tasks larger than the budget still run one at a time. None if no task fits
+    """
+    if not running_memory:
+        return 0 if task_memory else None
+    for task_i, memory in enumerate(task_memory):
+        if running_memory + memory <= budget:
+            return task_i
+    return None
+
+def adjust_concurrency(max_running, n_running, pool_rss, budget, n_workers):
+    """lower the number of running tasks when RSS nears the budget, raise it when RSS drops
+
+    Args:
+        max_running (int): current maximum number of running tasks
+        n_running (int): number of running tasks
+        pool_rss (float): output of get_pool_rss()
+        budget (float): memory budget in bytes
+        n_workers (int): number of pool workers
+
+    Returns:
+        int: new maximum number of running tasks
+    """
+    if np.isnan(pool_rss):
+        return max_running
+    if pool_rss > RSS_HIGH * budget:
+        return max(1, min(max_running, n_running - 1))
+    if pool_rss < RSS_LOW * budget:
+        return min(n_workers, max_running + 1)
+    return max_running
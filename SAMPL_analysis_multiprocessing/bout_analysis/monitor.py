@@ -0,0 +1,355 @@
+'''
+Monitor boxes while they record, see SAMPL_monitor.py
+Functions:
+    1. Find the .dlm file each box is recording: the last .dlm file of each folder, if it is not closed (see watch.is_closed()).
+       Box folders are listed again when they change, and all folders of a root every FULL_SCAN_S seconds
+    2. Read only rows appended since the last poll (read_dlm.read_dlm_tail()) and count them by minute of recording time:
+       epochs, frames with one fish, frames where speed crosses PROPULSION_THRESHOLD, and aligned bouts.
+       Aligned bouts are provisional bouts of stream_bouts.py, corrected when their epochs end
+    3. Save counts of the last window_h hours and of each hour of the last history_h hours of each box as a status .json file, replaced in one step
+    4. Flag boxes with few frames with one fish (e.g. dirty cuvette, fish out of view) or few aligned bouts (e.g. dead or sick fish) compared to other boxes
+
+Errors of a root or a box, e.g. a root on a network volume that is not reachable, are logged with their traceback and it is read again at the next poll. Only Ctrl+C stops the monitor.
+Each row is read and analyzed once, and unchanged folders are not listed, so the time of each poll is proportional to rows appended since the last poll.
+Counts are estimates for monitoring. Results of the analysis are saved by SAMPL_analysis.py or SAMPL_watch.py after files are closed.
+'''
+import os
+import json
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from preprocessing.data_manifest import get_dlm_folders
+from preprocessing.read_dlm import get_pack, get_decompressor, get_dlm_files, get_time_stamp, new_dlm_tail, read_dlm_tail
+from bout_analysis.logger import log_SAMPL_ana, start_log_listener, stop_log_listener
+from bout_analysis.stream_bouts import new_bout_stream, update_bout_stream, close_bout_stream
+from bout_analysis.watch import DEFAULT_SETTLE_S, is_closed
+
+MONITOR_STATUS = 'SAMPL monitor status.json'
+COUNT_COLUMNS = ['epochs','one_fish_frames','swim_crossings','aligned_bouts']
+DEFAULT_POLL_S = 60
+DEFAULT_WINDOW_H = 1
+DEFAULT_HISTORY_H = 24
+LOW_FRACTION = 0.25  # boxes with frames with one fish or aligned bouts per hour less than this fraction of the median of boxes recording are flagged
+MIN_BOXES_TO_COMPARE = 3  # boxes are compared if at least this number of boxes are recording
+FULL_SCAN_S = 600  # s, between listings of all folders of a root for new box folders
+
+def new_root_scan():
+    """state of listing the .dlm files of a root, see get_recording_files()
+
+    Returns:
+        dict: time of the last full scan, and modification time and latest .dlm file of each box folder
+    """
+    return {'last_full_scan':None, 'boxes':{}}  # box folder: (modification time, latest .dlm file or None)
+
+def get_latest_file(filenames):
+    """get the latest .dlm file being recorded of a box folder
+
+    Args:
+        filenames (list): .dlm files of the folder
+
+    Returns:
+        string: latest .dlm file by time stamp. None if there are only archived files
+    """
+    # packed and compressed files are archived
+    recorded = [file for file in filenames if not get_pack(file) and get_decompressor(file) is None]
+    return max(recorded, key=get_time_stamp) if recorded else None
+
+def scan_root(root, scan, now):
+    """update the latest .dlm file of each box folder of a root.
+    Every FULL_SCAN_S seconds, all folders of root are listed (data_manifest.get_dlm_folders()) to find new box folders.
+    Between full scans, only box folders whose modification time changed, i.e. files were created or removed, are listed again
+
+    Args:
+        root (string): directory of behavior data
+        scan (dict): output of new_root_scan(). Updated in place
+        now (float): time of this poll
+    """
+    if scan['last_full_scan'] is None or now - scan['last_full_scan'] >= FULL_SCAN_S:
+        box_files = {}
+        folders, _ = get_dlm_folders(root)
+        for _, filenames in folders:
+            for file in filenames:
+                box_files.setdefault(os.path.dirname(file), []).append(file)
+        # modification times are not known before the folders were listed, so each box folder is listed again at the next poll
+        scan['boxes'] = {box:(None, get_latest_file(filenames)) for box, filenames in box_files.items()}
+        scan['last_full_scan'] = now
+        return
+    for box, (mtime, latest) in list(scan['boxes'].items()):
+        try:
+            # before listing, so that files created while listing are found at the next poll
+            box_mtime = os.stat(box).st_mtime
+            if box_mtime == mtime:
+                continue
+            filenames = get_dlm_files([entry.path for entry in os.scandir(box) if entry.is_file()])
+        except OSError:
+            # removed, found again by the next full scan if it comes back
+            del scan['boxes'][box]
+            continue
+        scan['boxes'][box] = (box_mtime, get_latest_file(filenames))
+
+def get_recording_files(root, now, settle_s=DEFAULT_SETTLE_S, scan=None):
+    """get the .dlm file each box is recording
+
+    Args:
+        root (string): directory of behavior data
+        now (float): time of this poll
+        settle_s (float, optional): seconds a .dlm file without parameters.ini must not be modified to be closed. Defaults to DEFAULT_SETTLE_S (300).
+        scan (dict, optional): output of new_root_scan(), kept between polls of root, see scan_root(). Defaults to None (all folders of root are listed).
+
+    Returns:
+        dict: box folder: .dlm file being recorded, the latest file of the folder if it is not closed
+    """
+    scan = new_root_scan() if scan is None else scan
+    scan_root(root, scan, now)
+    recording = {}
+    for box, (_, file) in scan['boxes'].items():
+        if file is None:
+            continue
+        try:
+            if not is_closed(file, os.path.getmtime(file), now, settle_s):
+                recording[box] = file
+        except OSError:
+            # removed since listed
+            continue
+    return recording
+
+def new_box(file, frame_rate):
+    """state of monitoring one box
+
+    Args:
+        file (string): .dlm file being recorded
+        frame_rate (int): frame rate
+
+    Returns:
+        dict: reading and bout detection state of the file, last epoch read, aligned provisional bouts counted and counts by minute
+    """
+    return {
+        'file':file,
+        'frame_rate':frame_rate,
+        'dlm_tail':new_dlm_tail(file),
+        'stream':new_bout_stream(file, frame_rate),
+        'last_epochNum':None,
+        'last_time':None,
+        'n_rows':0,
+        'if_recording':True,
+        'counted':set(),
+        'counts':{},  # minute (since 1970): COUNT_COLUMNS
+    }
+
+def get_minutes(times):
+    """minutes since 1970 of times, to count by minute
+
+    Args:
+        times (array): datetime64[ns]
+
+    Returns:
+        array: int64
+    """
+    return times.astype('datetime64[m]').astype('int64')
+
+def add_counts(box, times, column):
+    """count times by minute
+
+    Args:
+        box (dict): output of new_box(). Updated in place
+        times (array): datetime64[ns]
+        column (string): one of COUNT_COLUMNS
+    """
+    minutes, n = np.unique(get_minutes(times), return_counts=True)
+    for minute, n_minute in zip(minutes.tolist(), n.tolist()):
+        box['counts'].setdefault(minute, [0]*len(COUNT_COLUMNS))[COUNT_COLUMNS.index(column)] += n_minute
+
+def count_bouts(box, events):
+    """count aligned bouts. Provisional bouts are counted when emitted, and corrected when their epochs end
+
+    Args:
+        box (dict): output of new_box(). Updated in place
+        events (list): output of stream_bouts.update_bout_stream() or close_bout_stream()
+    """
+    for status, bout in events:
+        key = (bout['epochNum'], bout['propBout_time'])
+        if status == 'provisional':
+            if not bout['if_align']:
+                continue
+            box['counted'].add(key)
+            change = 1
+        elif status == 'retracted':
+            if key not in box['counted']:
+                continue
+            box['counted'].remove(key)
+            change = -1
+        else:
+            if key in box['counted']:
+                # counted when emitted as provisional
+                box['counted'].remove(key)
+                continue
+            if not bout['if_align']:
+                continue
+            change = 1
+        minute = int(get_minutes(bout['propBout_time'].to_datetime64()))
+        box['counts'].setdefault(minute, [0]*len(COUNT_COLUMNS))[COUNT_COLUMNS.index('aligned_bouts')] += change
+
+def update_box(box, idle_s=DEFAULT_SETTLE_S):
+    """read rows appended to the .dlm file of a box since the last poll and count them
+
+    Args:
+        box (dict): output of new_box(). Updated in place
+        idle_s (float, optional): seconds without modification after which a .dlm file without parameters.ini is closed. Defaults to DEFAULT_SETTLE_S (300).
+    """
+    raw, if_closed = read_dlm_tail(box['dlm_tail'], idle_s)
+    if raw is not None and len(raw):
+        times = np.datetime64(box['stream']['start_time'], 'ns') + pd.to_timedelta(raw['time'].values, unit='s').values
+        epochNum = raw['epochNum'].values
+        epoch_starts = np.concatenate([[epochNum[0] != box['last_epochNum']], epochNum[1:] != epochNum[:-1]])
+        add_counts(box, times[epoch_starts], 'epochs')
+        add_counts(box, times[raw['fishNum'].values == 0], 'one_fish_frames')
+        events, crossings = update_bout_stream(box['stream'], raw)
+        add_counts(box, crossings, 'swim_crossings')
+        count_bouts(box, events)
+        box['last_epochNum'] = epochNum[-1]
+        box['last_time'] = times.max() if box['last_time'] is None else max(box['last_time'], times.max())
+        box['n_rows'] += len(raw)
+    if if_closed:
+        count_bouts(box, close_bout_stream(box['stream']))
+        box['if_recording'] = False
+
+def follow_box(box, box_state, idle_s):
+    """update a box, see update_box(). A file that can't be read is not followed anymore, so other boxes are still monitored
+
+    Args:
+        box (string): box folder
+        box_state (dict): output of new_box(). Updated in place
+        idle_s (float): see update_box()
+    """
+    try:
+        update_box(box_state, idle_s)
+    except (OSError, ValueError) as error:
+        box_state['if_recording'] = False
+        log_SAMPL_ana('SAMPL_ana_log').warning(f"Monitor: {os.path.basename(box_state['file'])} of {box} can't be read, not followed anymore: {error}")
+
+def get_box_status(box, window_h=DEFAULT_WINDOW_H, history_h=DEFAULT_HISTORY_H):
+    """summarize counts of a box. Counts older than history_h hours are removed
+
+    Args:
+        box (dict): output of new_box()
+        window_h (float, optional): hours of the rolling window. Defaults to DEFAULT_WINDOW_H (1).
+        history_h (float, optional): hours of hourly counts kept. Defaults to DEFAULT_HISTORY_H (24).
+
+    Returns:
+        dict: counts and counts per hour of the last window_h hours of recording time, hourly counts
+    """
+    status = {'file':os.path.basename(box['file']), 'frame_rate':box['frame_rate'], 'recording':box['if_recording'], 'rows':box['n_rows']}
+    if box['last_time'] is None:
+        return status
+    last_minute = int(get_minutes(box['last_time']))
+    for minute in [minute for minute in box['counts'] if minute <= last_minute - history_h*60]:
+        del box['counts'][minute]
+    counts = pd.DataFrame.from_dict(box['counts'], orient='index', columns=COUNT_COLUMNS).sort_index()
+    window = counts.loc[counts.index > last_minute - window_h*60]
+    # hours of recording in the window, shorter after a file starts
+    window_hours = (last_minute - max(window.index.min(), last_minute - window_h*60 + 1) + 1)/60
+    hourly = counts.groupby(counts.index // 60 * 60).sum()
+    status.update({
+        'last_frame_time':str(pd.Timestamp(box['last_time'])),
+        'window_h':round(window_hours, 3),
+        'window':{column:int(n) for column, n in window.sum().items()},
+        'per_hour':{column:round(n/window_hours, 1) for column, n in window.sum().items()},
+        'hourly':{str(pd.Timestamp(hour, unit='m')):{column:int(n) for column, n in row.items()} for hour, row in hourly.iterrows()},
+    })
+    return status
+
+def flag_boxes(statuses, window_h=DEFAULT_WINDOW_H):
+    """flag boxes recording for at least window_h hours with no frames with one fish, or with few frames with one fish or few aligned bouts compared to other boxes.
+    Boxes are compared to the median of boxes recording, so that all boxes are not flagged when fish are less active, e.g. at night
+
+    Args:
+        statuses (dict): output of get_box_status() of each box. Updated in place
+        window_h (float, optional): hours of the rolling window. Defaults to DEFAULT_WINDOW_H (1).
+    """
+    full = {box:status for box, status in statuses.items() if status['recording'] and status.get('window_h', 0) >= window_h}
+    medians = {}
+    if len(full) >= MIN_BOXES_TO_COMPARE:
+        medians = {column:np.median([status['per_hour'][column] for status in full.values()]) for column in ['one_fish_frames','aligned_bouts']}
+    for box, status in statuses.items():
+        status['flags'] = []
+        if box not in full:
+            continue
+        if status['window']['one_fish_frames'] == 0:
+            status['flags'].append('no frames with one fish')
+        elif medians and status['per_hour']['one_fish_frames'] < LOW_FRACTION * medians['one_fish_frames']:
+            status['flags'].append('few frames with one fish')
+        if medians and status['per_hour']['aligned_bouts'] < LOW_FRACTION * medians['aligned_bouts']:
+            status['flags'].append('few aligned bouts')
+
+def save_status(status_file, status):
+    """save the monitor status. Replaced in one step, so readers never see a partial file
+
+    Args:
+        status_file (string): directory of the .json file
+        status (dict): status of all boxes
+    """
+    with open(status_file + '.part', 'w') as f:
+        json.dump(status, f, indent=1)
+    os.replace(status_file + '.part', status_file)
+
+def monitor(jobs, status_file=MONITOR_STATUS, poll_s=DEFAULT_POLL_S, window_h=DEFAULT_WINDOW_H, history_h=DEFAULT_HISTORY_H, settle_s=DEFAULT_SETTLE_S, max_polls=None, log_dir=None):
+    """monitor boxes of root directories while they record, until interrupted (Ctrl+C)
+
+    Args:
+        jobs (list): tuples of (root, frame_rate)
+        status_file (string, optional): directory of the status .json file. Defaults to MONITOR_STATUS in the current directory.
+        poll_s (float, optional): seconds between polls. Defaults to DEFAULT_POLL_S (60).
+        window_h (float, optional): hours of recording time of rolling counts. Defaults to DEFAULT_WINDOW_H (1).
+        history_h (float, optional): hours of hourly counts saved. Defaults to DEFAULT_HISTORY_H (24).
+        settle_s (float, optional): seconds a .dlm file without parameters.ini must not be modified to be closed. Defaults to DEFAULT_SETTLE_S (300).
+        max_polls (int, optional): stop after max_polls polls. Defaults to None (until interrupted).
+        log_dir (string, optional): folder to save log files. Defaults to None (current directory).
+    """
+    _, log_listener = start_log_listener(log_dir)
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    boxes = {}
+    flags = {}
+    scans = {root:new_root_scan() for root, _ in jobs}
+    logger.info(f"Monitor started: {', '.join(root for root, _ in jobs)}. Poll every {poll_s}s, status saved to {status_file}")
+    n_polls = 0
+    try:
+        while max_polls is None or n_polls < max_polls:
+            tic = time.time()
+            n_polls += 1
+            for root, frame_rate in jobs:
+                try:
+                    for box, file in get_recording_files(root, tic, settle_s, scans[root]).items():
+                        if box in boxes and boxes[box]['file'] != file and boxes[box]['if_recording']:
+                            # a new recording started, read the rest of the last one
+                            follow_box(box, boxes[box], 0)
+                        if box not in boxes or boxes[box]['file'] != file:
+                            counts = boxes[box]['counts'] if box in boxes else {}
+                            boxes[box] = new_box(file, frame_rate)
+                            boxes[box]['counts'] = counts
+                            logger.info(f"Monitor: {box} recording {os.path.basename(file)}")
+                except Exception as error:
+                    logger.exception(f"Monitor: {root} not polled, polled again at the next poll. {type(error).__name__}: {error}")
+            for box, box_state in boxes.items():
+                if box_state['if_recording']:
+                    try:
+                        follow_box(box, box_state, settle_s)
+                    except Exception as error:
+                        logger.exception(f"Monitor: {box} not read, read again at the next poll. {type(error).__name__}: {error}")
+            statuses = {box:get_box_status(boxes[box], window_h, history_h) for box in boxes}
+            flag_boxes(statuses, window_h)
+            for box, status in statuses.items():
+                if status['flags'] and status['flags'] != flags.get(box):
+                    logger.warning(f"Monitor: {box} {', '.join(status['flags'])}")
+                flags[box] = status['flags']
+            try:
+                save_status(status_file, {'updated':str(datetime.now().replace(microsecond=0)), 'boxes':statuses})
+            except OSError as error:
+                logger.exception(f"Monitor: status not saved, saved again at the next poll. {type(error).__name__}: {error}")
+            if max_polls is not None and n_polls >= max_polls:
+                break
+            time.sleep(max(0, poll_s - (time.time() - tic)))
+    except KeyboardInterrupt:
+        logger.info("Monitor stopped")
+    finally:
+        stop_log_listener(log_listener)
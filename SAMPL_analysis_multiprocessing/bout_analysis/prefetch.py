@@ -0,0 +1,123 @@
+'''
+Overlapped I/O for analyzing .dlm files one by one (runSP and run())
+Functions:
+    1. Read the next .dlm files in a background thread while the current file is analyzed (prefetch)
+    2. Write results in a background thread while the next file is analyzed (writer)
+
+Both use bounded queues. At most PREFETCH_DEPTH files wait in memory after the file being analyzed, and analysis waits if writing falls behind by WRITE_DEPTH writes.
+Reading .dlm files from network volumes and writing hdf5 files mostly wait on I/O, which releases the GIL, so they overlap with analysis in the main thread.
+All writes to a file must go through the writer, in order, and the file must not be read before stop_writer(), since hdf5 files are not thread safe.
+HDF5 is not thread safe across files either, so each write holds read_dlm.HDF5_LOCK, which reads of packed .dlm files (.dlmpack, hdf5) in any thread hold too.
+Plain and compressed .dlm files are text and are read without the lock.
+Reads in the background thread are not recorded by telemetry, and write stages record only the time waiting for the writer.
+'''
+import threading
+import queue
+from preprocessing.read_dlm import HDF5_LOCK
+from bout_analysis.task_guard import get_failure, log_failure
+
+PREFETCH_DEPTH = 2  # files read ahead
+WRITE_DEPTH = 4  # writes waiting
+QUEUE_TIMEOUT = 1  # s, to check whether the consumer stopped
+
+def prefetch(items, load, depth=PREFETCH_DEPTH):
+    """load items in a background thread, up to depth items ahead of the consumer
+
+    Args:
+        items (list): items to load
+        load (function): loads one item
+        depth (int, optional): number of loaded items waiting. Defaults to PREFETCH_DEPTH.
+
+    Yields:
+        item
+        output of load(item). None if failed
+        Exception: error of load(item). None if succeeded
+    """
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(output):
+        while not stop.is_set():
+            try:
+                loaded.put(output, timeout=QUEUE_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def read_ahead():
+        for item in items:
+            if stop.is_set():
+                return
+            try:
+                put((item, load(item), None))
+            except Exception as error:
+                put((item, None, error))
+        put(None)
+
+    threading.Thread(target=read_ahead, daemon=True).start()
+    try:
+        # not bound to a local, so that the consumer can free each output
+        yield from iter(loaded.get, None)
+    finally:
+        # e.g. the consumer raised
+        stop.set()
+
+def write_all(write_queue, failures):
+    """run writes from write_queue until None is received. Target of the writer thread
+
+    Args:
+        write_queue (Queue): see write()
+        failures (list): failed writes are appended, see task_guard.get_failure()
+    """
+    while (job := write_queue.get()) is not None:
+        folder, file, func, args = job
+        try:
+            # all writes are to hdf5 files
+            with HDF5_LOCK:
+                func(*args)
+        except Exception as error:
+            failures.append(get_failure(func.__name__, folder, file, 1, {'error':type(error).__name__, 'message':str(error), 'traceback':''}))
+            log_failure(failures[-1], max_retries=0)
+        finally:
+            write_queue.task_done()
+
+def start_writer(failures, depth=WRITE_DEPTH):
+    """start the writer thread
+
+    Args:
+        failures (list): failed writes are appended, see task_guard.get_failure(). Failed writes are not retried
+        depth (int, optional): number of writes waiting. Defaults to WRITE_DEPTH.
+
+    Returns:
+        Queue: pass to write()
+        Thread: pass to stop_writer()
+    """
+    write_queue = queue.Queue(maxsize=depth)
+    writer = threading.Thread(target=write_all, args=(write_queue, failures), daemon=True)
+    writer.start()
+    return write_queue, writer
+
+def write(write_queue, folder, file, func, *args):
+    """queue func(*args) to the writer thread. Waits if depth writes are waiting
+
+    Args:
+        write_queue (Queue): output of start_writer(). None to write in the current thread
+        folder (string): root directory, for the failures report
+        file (string): .dlm directory, for the failures report
+        func (function): write function
+        args: arguments of func
+    """
+    if write_queue is None:
+        func(*args)
+        return
+    write_queue.put((folder, file, func, args))
+
+def stop_writer(write_queue, writer):
+    """finish queued writes and stop the writer thread
+
+    Args:
+        write_queue (Queue): output of start_writer()
+        writer (Thread): output of start_writer()
+    """
+    write_queue.put(None)
+    writer.join()
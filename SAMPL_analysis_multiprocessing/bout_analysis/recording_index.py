@@ -0,0 +1,202 @@
+'''
+Index of the recordings under a root directory, saved as <root>/SAMPL recordings.sqlite
+Functions:
+    1. One row per .dlm file: parameters.ini fields, size, modification time and hash, start time from the file name, estimated frames,
+       bouts aligned, analyzer versions and status of the analysis
+    2. Update incrementally. Only rows of .dlm files whose .dlm file, .ini file or results (dlm results/) changed are read again, and rows of removed files are deleted
+    3. Query recordings without opening any data file, e.g.
+        query_recordings(root, "age = 7 AND genotype = 'tau' AND start_time LIKE '2023-03%' AND aligned_bout > 500")
+
+The index is updated by SAMPL_analysis_mp() / SAMPL_analysis_batch() after analysis, or by update_recording_index(root).
+Paths are relative to root, so the index stays valid when the dataset is moved. Folders are those of the data manifest if root has one, and folders with .dlm files copied under root, see preprocessing/data_manifest.py.
+dlm_hash is the hash saved when the .dlm file was analyzed (packed files only, empty otherwise), None if not analyzed since it changed.
+est_frames is exact for packed .dlm files and estimated from the first block otherwise, see memory_budget.estimate_frames().
+status: analyzed, skipped (no alignable bout, see message), not analyzed, or changed (the .dlm file changed since analyzed).
+The index is a plain SQLite file and can be read by any SQLite client.
+'''
+import os
+import sqlite3
+from contextlib import closing
+import configparser
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from preprocessing.read_dlm import get_dlm_name, get_time_stamp, get_pack, read_packed_parameters
+from preprocessing.data_manifest import get_dlm_folders
+from preprocessing.read_ini import read_ini, read_ini_files
+from preprocessing.analyze_dlm_v5 import DATETIME_FRMT
+from bout_analysis.dlm_cache import get_cache_file, get_dlm_state, read_file_info
+from bout_analysis.memory_budget import estimate_frames
+
+INDEX_FILE = 'SAMPL recordings.sqlite'
+INDEX_TABLE = 'recordings'
+INI_COLUMNS = {'box_number':'INTEGER', 'genotype':'TEXT', 'age':'INTEGER', 'notes':'TEXT', 'initials':'TEXT', 'light_cycle':'INTEGER', 'dir':'TEXT',
+               'line_1':'INTEGER', 'line_2':'INTEGER', 'cross_id':'TEXT', 'num_fish':'INTEGER', 'filename':'TEXT'}  # see preprocessing/read_ini.py
+INDEX_COLUMNS = {
+    'file':'TEXT PRIMARY KEY', 'folder':'TEXT', 'condition':'TEXT', 'exp':'TEXT', 'dlm_name':'TEXT', 'start_time':'TEXT',
+    'dlm_size':'INTEGER', 'dlm_mtime':'REAL', 'dlm_hash':'TEXT', 'ini_mtime':'REAL', 'cache_mtime':'REAL', 'est_frames':'INTEGER',
+    **INI_COLUMNS,
+    'status':'TEXT', 'aligned_bout':'INTEGER', 'mean_fish_len':'REAL', 'message':'TEXT', 'analyzed_at':'TEXT',
+    'analyze_dlm_ver':'TEXT', 'grab_fish_angle_ver':'TEXT', 'frame_rate':'INTEGER', 'indexed_at':'TEXT',
+}
+STATE_COLUMNS = ['dlm_size', 'dlm_mtime', 'ini_mtime', 'cache_mtime']  # a row is read again if any of them changed
+
+def to_sql_value(value):
+    """convert a value for sqlite3
+
+    Args:
+        value: value of a row
+
+    Returns:
+        value as a Python type. None if missing
+    """
+    if value is None or (np.isscalar(value) and pd.isna(value)):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+def get_mtime(file):
+    """modification time of a file
+
+    Args:
+        file (string): directory
+
+    Returns:
+        float: modification time. None if the file does not exist
+    """
+    return os.path.getmtime(file) if os.path.exists(file) else None
+
+def get_ini_file(file):
+    """get parameters.ini of a .dlm file. That of the container for packed .dlm files, in which it's saved
+
+    Args:
+        file (string): .dlm directory
+
+    Returns:
+        string: directory of the .ini file or the container
+    """
+    if get_pack(file):
+        return get_pack(file)
+    return os.path.join(os.path.dirname(file), get_dlm_name(file) + " parameters.ini")
+
+def read_ini_fields(file):
+    """read parameters.ini of a .dlm file
+
+    Args:
+        file (string): .dlm directory
+
+    Returns:
+        dict: INI_COLUMNS. Empty if there's no readable .ini file
+    """
+    if get_pack(file):
+        parameters = read_packed_parameters(file)
+        parameters = None if parameters is None else parameters.iloc[0].to_dict()
+    else:
+        try:
+            parameters = read_ini(get_ini_file(file))
+        except (configparser.Error, ValueError):
+            return {}
+    if parameters is None:
+        return {}
+    return {column:value for column, value in parameters.items() if column in INI_COLUMNS}
+
+def get_start_time(file):
+    """get the start time in the name of a .dlm file
+
+    Args:
+        file (string): .dlm directory
+
+    Returns:
+        string: yyyy-mm-dd HH:MM:SS, which sorts and compares as time. None if the name has no time stamp
+    """
+    try:
+        return datetime.strptime(get_time_stamp(file), DATETIME_FRMT).isoformat(sep=' ')
+    except ValueError:
+        return None
+
+def get_recording_row(file, folder, root, state):
+    """read the index row of a .dlm file
+
+    Args:
+        file (string): .dlm directory
+        folder (string): folder the .dlm file is analyzed in
+        root (string): directory of behavior data
+        state (dict): STATE_COLUMNS of the file
+
+    Returns:
+        dict: INDEX_COLUMNS
+    """
+    file_info = read_file_info(get_cache_file(file))
+    row = {
+        'file':os.path.relpath(file, root),
+        'folder':os.path.relpath(folder, root),
+        'condition':os.path.basename(os.path.dirname(folder)),
+        'exp':os.path.basename(folder),
+        'dlm_name':get_dlm_name(file),
+        'start_time':get_start_time(file),
+        **state,
+        'est_frames':estimate_frames(file),
+        **read_ini_fields(file),
+        'status':'not analyzed',
+        'indexed_at':datetime.now().isoformat(),
+    }
+    if file_info is not None:
+        row.update({column:file_info.get(column) for column in ['aligned_bout', 'mean_fish_len', 'message', 'analyzed_at', 'analyze_dlm_ver', 'grab_fish_angle_ver', 'frame_rate']})
+        if (file_info['dlm_size'], file_info['dlm_mtime']) == (state['dlm_size'], state['dlm_mtime']):
+            row['dlm_hash'] = file_info['dlm_hash']
+            row['status'] = 'skipped' if file_info['message'] else 'analyzed'
+        else:
+            row['status'] = 'changed'
+    return row
+
+def update_recording_index(root):
+    """add new and changed .dlm files under root to <root>/SAMPL recordings.sqlite and remove rows of removed files
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        int: number of rows read again
+        int: number of rows removed
+    """
+    folders, _ = get_dlm_folders(root)
+    with closing(sqlite3.connect(os.path.join(root, INDEX_FILE))) as connection, connection:
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {INDEX_TABLE} ({', '.join(f'{column} {sql_type}' for column, sql_type in INDEX_COLUMNS.items())})")
+        indexed = {row[0]:row[1:] for row in connection.execute(f"SELECT file, {', '.join(STATE_COLUMNS)} FROM {INDEX_TABLE}")}
+        pending = []
+        files = set()
+        for folder, filenames in folders:
+            for file in filenames:
+                dlm_state = get_dlm_state(file, if_hash=False)
+                state = {
+                    'dlm_size':dlm_state['dlm_size'],
+                    'dlm_mtime':dlm_state['dlm_mtime'],
+                    'ini_mtime':get_mtime(get_ini_file(file)),
+                    'cache_mtime':get_mtime(get_cache_file(file)),
+                }
+                files.add(os.path.relpath(file, root))
+                if indexed.get(os.path.relpath(file, root)) == tuple(state.values()):
+                    continue
+                pending.append((file, folder, state))
+        # .ini files of new and changed recordings are read in threads first, then from the cache of read_ini()
+        read_ini_files([get_ini_file(file) for file, _, _ in pending if not get_pack(file)], errors='skip')
+        rows = [get_recording_row(file, folder, root, state) for file, folder, state in pending]
+        removed = [(file,) for file in indexed if file not in files]
+        connection.executemany(f"DELETE FROM {INDEX_TABLE} WHERE file = ?", removed)
+        connection.executemany(f"INSERT OR REPLACE INTO {INDEX_TABLE} ({', '.join(INDEX_COLUMNS)}) VALUES ({', '.join('?' * len(INDEX_COLUMNS))})",
+                               [tuple(to_sql_value(row.get(column)) for column in INDEX_COLUMNS) for row in rows])
+    return len(rows), len(removed)
+
+def query_recordings(root, where=None, params=()):
+    """query the index of root
+
+    Args:
+        root (string): directory of behavior data
+        where (string, optional): SQL condition on INDEX_COLUMNS. Defaults to None (all recordings).
+        params (tuple, optional): values of ? in where. Defaults to ().
+
+    Returns:
+        DataFrame: matching rows, sorted by start time
+    """
+    query = f"SELECT * FROM {INDEX_TABLE}" + (f" WHERE {where}" if where else "") + " ORDER BY start_time, file"
+    with closing(sqlite3.connect(os.path.join(root, INDEX_FILE))) as connection:
+        return pd.read_sql(query, connection, params=params)
@@ -0,0 +1,86 @@
+'''
+Size-aware scheduling for runMP
+Functions:
+    1. Order tasks by .dlm file size, largest first (longest processing time first, LPT)
+    2. Predict when each task starts and ends on a pool of workers, assuming time is proportional to .dlm size
+    3. Compare predicted and actual time of each task
+
+Analysis time of a .dlm file scales with its number of rows, thus with its size.
+Dispatching large files first keeps a large file from starting last and running long after other workers are idle.
+The time per byte is fitted on each run, so the report shows how well file size predicts time, not a guessed constant.
+'''
+import heapq
+import numpy as np
+import pandas as pd
+from preprocessing.read_dlm import get_dlm_size
+
+SCHEDULE_REPORT = 'SAMPL schedule report.csv'
+
+def sort_by_size(tasks, get_files):
+    """sort tasks by total size of .dlm files, largest first
+
+    Args:
+        tasks (list): task arguments
+        get_files (function): returns a list of .dlm files of a task
+
+    Returns:
+        list: sorted tasks
+    """
+    return sorted(tasks, key=lambda task: sum(get_dlm_size(file) for file in get_files(task)), reverse=True)
+
+def simulate_lpt(costs, n_workers):
+    """predict start and end time of tasks dispatched in order to the first idle worker
+
+    Args:
+        costs (array-like): predicted time of each task, in the order of dispatch
+        n_workers (int): number of workers
+
+    Returns:
+        ndarray: start time of each task
+        ndarray: end time of each task
+    """
+    idle_at = [0.0] * n_workers
+    start = np.zeros(len(costs))
+    for task_i, cost in enumerate(costs):
+        start[task_i] = heapq.heappop(idle_at)
+        heapq.heappush(idle_at, start[task_i] + cost)
+    return start, start + np.asarray(costs, dtype=float)
+
+def get_schedule_report(timings, n_workers):
+    """compare predicted and actual time of tasks
+
+    Args:
+        timings (list): one dict per task in the order of dispatch. keys: file, folder, dlm_size, worker, start, end (time.time())
+        n_workers (int): number of workers
+
+    Returns:
+        DataFrame: one row per task. Time in seconds since the first task started
+        Series: summary of the run
+    """
+    report = pd.DataFrame(timings)
+    report = report.assign(
+        order = np.arange(len(report)),
+        actual_s = report['end'] - report['start'],
+        actual_start_s = report['start'] - report['start'].min(),
+    )
+    report = report.assign(actual_end_s = report['actual_start_s'] + report['actual_s'])
+    # time per byte fitted on all tasks
+    s_per_byte = report['actual_s'].sum() / max(report['dlm_size'].sum(), 1)
+    predicted_start, predicted_end = simulate_lpt(report['dlm_size'].values * s_per_byte, n_workers)
+    report = report.assign(
+        predicted_s = report['dlm_size'] * s_per_byte,
+        predicted_start_s = predicted_start,
+        predicted_end_s = predicted_end,
+    )
+    summary = pd.Series({
+        'tasks':len(report),
+        'workers':n_workers,
+        's_per_MB':s_per_byte * 1e6,
+        'predicted_makespan_s':report['predicted_end_s'].max(),
+        'actual_makespan_s':report['actual_end_s'].max(),
+        # undefined for one task or equal sizes or times
+        'size_time_corr':report['dlm_size'].corr(report['actual_s']) if len(report) > 1 and report['dlm_size'].nunique() > 1 and report['actual_s'].nunique() > 1 else np.nan,
+    })
+    report = report[['order','folder','file','dlm_size','worker','predicted_s','actual_s',
+                     'predicted_start_s','actual_start_s','predicted_end_s','actual_end_s']]
+    return report, summary
@@ -0,0 +1,355 @@
+'''
+Local scratch staging of .dlm folders on network volumes
+Functions:
+    1. Split folders into waves, largest first, of at most half of the byte budget each
+    2. Copy the next wave to local scratch in a thread pool while the current wave is analyzed, so that workers read and write local files
+    3. Sync outputs of each analyzed wave back to the network volume in bulk, then free its scratch space
+
+Folders are mirrored as <scratch_dir>/SAMPL staging*/<wave>/<id of the condition folder>/<condition folder>/<folder>, so that outputs keep their names,
+including <exp_name> metadata.csv in the condition folder. All files of a folder and its dlm results/ are copied with their modification times,
+so that resume and append work as without staging. Folders are copied STAGE_THREADS at a time, each file in one read, as reads from network volumes are latency bound.
+Files that changed are synced back, and staged files removed by the analysis (e.g. an outdated manifest) are removed. .dlm and .ini files are never written back.
+At most two waves of .dlm files are in scratch at a time, plus outputs. A folder larger than half of the budget is a wave of its own.
+.dlm files arranged by a data manifest outside their experiment folder are read in place, with their dlm results/, and only outputs of the folder are staged.
+Paths in the schedule and failures reports are mapped back to the network volume. Paths in logs, telemetry and dlm results/manifest.csv are scratch paths.
+If the analysis of a wave is interrupted or fails, complete results of its .dlm files are synced back before scratch is removed, so that they are reused when resumed.
+If they can't be synced, the staging directory is kept and its path is logged.
+READ_LATENCY_S adds a delay to each file copied, so that staging can be checked against a local directory standing in for a network volume (see SAMPL_check_staging.py).
+'''
+import os
+import shutil
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from bout_analysis.logger import log_SAMPL_ana
+from preprocessing.read_dlm import get_dlm_size, get_dlm_folder
+from bout_analysis.dlm_cache import CACHE_FOLDER, MANIFEST_NAME, read_file_info
+from bout_analysis.scheduler import SCHEDULE_REPORT
+from bout_analysis.task_guard import FAILURES_REPORT, get_failure, log_failure, save_failures_report
+
+STAGE_THREADS = 8  # folders copied at a time
+DEFAULT_STAGE_BUDGET_MB = 4096  # scratch space for .dlm files of two waves
+READ_LATENCY_S = 0  # s added to each file copied, to simulate a network volume
+
+def is_in_folder(file, folder):
+    """check whether a .dlm file is staged with its folder. .dlm files arranged by a data manifest (see preprocessing/data_manifest.py) may be elsewhere and are read in place
+
+    Args:
+        file (string): .dlm directory
+        folder (string): root directory
+
+    Returns:
+        bool: True if the file is under the folder
+    """
+    return os.path.commonpath([os.path.abspath(file), os.path.abspath(folder)]) == os.path.abspath(folder)
+
+def get_waves(dlm_input, budget):
+    """split folders into waves, largest first, of at most half of the budget each, so that the next wave fits while the current one is analyzed
+
+    Args:
+        dlm_input (list): arguments of run() for each folder
+        budget (float): scratch space for .dlm files in bytes
+
+    Returns:
+        list: dlm_input of each wave
+    """
+    folder_sizes = [(sum(get_dlm_size(file) for file in folder_input[0] if is_in_folder(file, folder_input[1])), folder_input) for folder_input in dlm_input]
+    waves = []
+    wave_size = 0
+    for folder_size, folder_input in sorted(folder_sizes, key=lambda item: item[0], reverse=True):
+        if not waves or wave_size + folder_size > budget / 2:
+            waves.append([])
+            wave_size = 0
+        waves[-1].append(folder_input)
+        wave_size += folder_size
+    return waves
+
+def get_scratch_folder(folder, wave_dir):
+    """get the scratch directory of a folder
+
+    Args:
+        folder (string): root directory
+        wave_dir (string): scratch directory of the wave
+
+    Returns:
+        string: scratch directory of the folder
+    """
+    condition_folder = os.path.dirname(folder)
+    # condition folders of the same name under different roots
+    folder_id = hashlib.md5(condition_folder.encode()).hexdigest()[:8]
+    return os.path.join(wave_dir, folder_id, os.path.basename(condition_folder), os.path.basename(folder))
+
+def list_folder(folder):
+    """list files to stage: files in the folder, results of .dlm files and <exp_name> metadata.csv in the condition folder
+
+    Args:
+        folder (string): root directory
+
+    Returns:
+        list: paths relative to the condition folder
+    """
+    exp_name = os.path.basename(folder)
+    files = [os.path.join(exp_name, entry.name) for entry in os.scandir(folder) if entry.is_file()]
+    cache_folder = os.path.join(folder, CACHE_FOLDER)
+    if os.path.isdir(cache_folder):
+        files += [os.path.join(exp_name, CACHE_FOLDER, entry.name) for entry in os.scandir(cache_folder) if entry.is_file()]
+    if os.path.exists(os.path.join(os.path.dirname(folder), f"{exp_name} metadata.csv")):
+        files.append(f"{exp_name} metadata.csv")
+    return files
+
+def copy_file(source, target):
+    """copy a file with its modification time, after READ_LATENCY_S
+
+    Args:
+        source (string): file to copy
+        target (string): copy
+    """
+    if READ_LATENCY_S:
+        time.sleep(READ_LATENCY_S)
+    shutil.copy2(source, target)
+
+def stage_folder(folder, scratch_folder):
+    """copy a folder to scratch, see list_folder()
+
+    Args:
+        folder (string): root directory
+        scratch_folder (string): output of get_scratch_folder()
+
+    Returns:
+        list: staged files, relative to the condition folder
+        int: bytes copied
+    """
+    condition_folder, scratch_condition_folder = os.path.dirname(folder), os.path.dirname(scratch_folder)
+    files = list_folder(folder)
+    os.makedirs(os.path.join(scratch_folder, CACHE_FOLDER), exist_ok=True)
+    for file in files:
+        copy_file(os.path.join(condition_folder, file), os.path.join(scratch_condition_folder, file))
+    return files, sum(os.path.getsize(os.path.join(scratch_condition_folder, file)) for file in files)
+
+def sync_folder(scratch_folder, folder, staged_files):
+    """copy outputs that changed in scratch back to the folder, remove staged files removed in scratch
+
+    Args:
+        scratch_folder (string): output of get_scratch_folder()
+        folder (string): root directory
+        staged_files (list): output of stage_folder()
+
+    Returns:
+        int: bytes copied
+    """
+    condition_folder, scratch_condition_folder = os.path.dirname(folder), os.path.dirname(scratch_folder)
+    files = list_folder(scratch_folder)
+    synced_bytes = 0
+    for file in files:
+        if '.dlm' in file or file.endswith('.ini'):
+            continue
+        source, target = os.path.join(scratch_condition_folder, file), os.path.join(condition_folder, file)
+        source_stat = os.stat(source)
+        if os.path.exists(target):
+            target_stat = os.stat(target)
+            if (source_stat.st_size, source_stat.st_mtime) == (target_stat.st_size, target_stat.st_mtime):
+                continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        copy_file(source, target)
+        synced_bytes += source_stat.st_size
+    for file in set(staged_files) - set(files):
+        if '.dlm' in file or file.endswith('.ini'):
+            continue
+        if os.path.exists(os.path.join(condition_folder, file)):
+            os.remove(os.path.join(condition_folder, file))
+    return synced_bytes
+
+def sync_results(scratch_folder, folder):
+    """copy complete results of .dlm files (dlm results/*.h5 with file_info) that changed in scratch back to the folder, e.g. when the analysis is interrupted.
+    Merged outputs and the manifest are not synced, so the folder is merged again when the run is resumed, see grab_fish_angle_v5.get_merged_file_num()
+
+    Args:
+        scratch_folder (string): output of get_scratch_folder()
+        folder (string): root directory
+
+    Returns:
+        int: number of results copied
+    """
+    scratch_cache_folder = os.path.join(scratch_folder, CACHE_FOLDER)
+    if not os.path.isdir(scratch_cache_folder):
+        return 0
+    synced = 0
+    for entry in os.scandir(scratch_cache_folder):
+        if not entry.is_file() or entry.name == MANIFEST_NAME or read_file_info(entry.path) is None:
+            continue
+        target = os.path.join(folder, CACHE_FOLDER, entry.name)
+        if os.path.exists(target) and os.path.getmtime(target) == entry.stat().st_mtime:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        copy_file(entry.path, target)
+        synced += 1
+    return synced
+
+def stage_wave(wave_input, wave_dir, executor):
+    """start copying folders of a wave to scratch
+
+    Args:
+        wave_input (list): output of get_waves() for one wave
+        wave_dir (string): scratch directory of the wave
+        executor (ThreadPoolExecutor): copies folders
+
+    Returns:
+        list: dlm_input of the wave with scratch paths
+        dict: folder on the network volume of each scratch folder
+        dict: Future of stage_folder() of each scratch folder
+    """
+    os.makedirs(wave_dir, exist_ok=True)
+    scratch_input = []
+    folder_map = {}
+    copies = {}
+    for filenames, folder, *settings in wave_input:
+        scratch_folder = get_scratch_folder(folder, wave_dir)
+        folder_map[scratch_folder] = folder
+        copies[scratch_folder] = executor.submit(stage_folder, folder, scratch_folder)
+        # relative paths, as packed .dlm files are under their container
+        scratch_input.append(([os.path.join(scratch_folder, os.path.relpath(file, folder)) if is_in_folder(file, folder) else file for file in filenames], scratch_folder, *settings))
+    return scratch_input, folder_map, copies
+
+def wait_staged(scratch_input, folder_map, copies, failures):
+    """wait for copies of a wave. Folders that failed to copy are left out and added to failures
+
+    Args:
+        scratch_input, folder_map, copies: outputs of stage_wave()
+        failures (list): see task_guard.get_failure()
+
+    Returns:
+        list: dlm_input of staged folders
+        dict: staged files of each staged folder, see stage_folder()
+        int: bytes copied
+    """
+    staged_files = {}
+    staged_bytes = 0
+    for scratch_folder, copy in copies.items():
+        error = copy.exception()
+        if error is not None:
+            failures.append(get_failure('stage_folder', folder_map[scratch_folder], None, 1, {'error':type(error).__name__, 'message':str(error), 'traceback':''}))
+            log_failure(failures[-1], max_retries=0)
+            continue
+        staged_files[scratch_folder], folder_bytes = copy.result()
+        staged_bytes += folder_bytes
+    return [folder_input for folder_input in scratch_input if folder_input[1] in staged_files], staged_files, staged_bytes
+
+def sync_wave(folder_map, staged_files, executor, failures):
+    """sync outputs of staged folders back to the network volume
+
+    Args:
+        folder_map (dict): output of stage_wave()
+        staged_files (dict): output of wait_staged()
+        executor (ThreadPoolExecutor): copies folders
+        failures (list): see task_guard.get_failure()
+
+    Returns:
+        int: bytes copied
+    """
+    syncs = {scratch_folder:executor.submit(sync_folder, scratch_folder, folder_map[scratch_folder], files) for scratch_folder, files in staged_files.items()}
+    synced_bytes = 0
+    for scratch_folder, sync in syncs.items():
+        error = sync.exception()
+        if error is not None:
+            failures.append(get_failure('sync_folder', folder_map[scratch_folder], None, 1, {'error':type(error).__name__, 'message':str(error), 'traceback':''}))
+            log_failure(failures[-1], max_retries=0)
+            continue
+        synced_bytes += sync.result()
+    return synced_bytes
+
+def to_source_path(path, folder_map):
+    """map a scratch path of a folder or a .dlm file to the network volume
+
+    Args:
+        path (string): scratch path. Other values are returned as is
+        folder_map (dict): output of stage_wave()
+
+    Returns:
+        string: path on the network volume
+    """
+    if not isinstance(path, str):
+        return path
+    if path in folder_map:
+        return folder_map[path]
+    if get_dlm_folder(path) in folder_map:
+        return os.path.join(folder_map[get_dlm_folder(path)], os.path.relpath(path, get_dlm_folder(path)))
+    return path
+
+def read_wave_report(report_file, folder_map):
+    """read a report saved in the scratch directory of a wave, with paths on the network volume
+
+    Args:
+        report_file (string): schedule or failures report
+        folder_map (dict): output of stage_wave()
+
+    Returns:
+        DataFrame: report. Empty if not saved
+    """
+    if not os.path.exists(report_file):
+        return pd.DataFrame()
+    report = pd.read_csv(report_file, index_col=0)
+    for column in ['folder', 'file']:
+        if column in report:
+            report[column] = report[column].map(lambda path: to_source_path(path, folder_map))
+    return report
+
+def run_staged(dlm_input, run_wave, scratch_dir, budget_MB=DEFAULT_STAGE_BUDGET_MB, report_dir=None):
+    """analyze folders in waves staged to local scratch, see module docstring
+
+    Args:
+        dlm_input (list): arguments of run() for each folder
+        run_wave (function): analyzes a wave, called with dlm_input of the wave (scratch paths) and the directory to save reports
+        scratch_dir (string): local directory for staging, e.g. on a local SSD
+        budget_MB (float, optional): scratch space for .dlm files of two waves, in MB. Defaults to DEFAULT_STAGE_BUDGET_MB.
+        report_dir (string, optional): folder to save the schedule and failures reports of all waves. Defaults to None (not saved).
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    waves = get_waves(dlm_input, budget_MB * 2**20)
+    os.makedirs(scratch_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix='SAMPL staging ', dir=scratch_dir)
+    logger.info(f"Staging: {len(dlm_input)} folders in {len(waves)} waves to {staging_dir}")
+    failures = []
+    schedules = []
+    executor = ThreadPoolExecutor(STAGE_THREADS)
+    # folder map of the wave being analyzed, until it is synced back
+    analyzing = None
+    try:
+        staged = stage_wave(waves[0], os.path.join(staging_dir, '0'), executor) if waves else None
+        for wave_i in range(len(waves)):
+            wave_dir = os.path.join(staging_dir, str(wave_i))
+            scratch_input, folder_map, copies = staged
+            tic = time.time()
+            scratch_input, staged_files, staged_bytes = wait_staged(scratch_input, folder_map, copies, failures)
+            logger.info(f"Staging: wave {wave_i + 1} of {len(waves)}, {len(scratch_input)} folders, {staged_bytes / 2**20:.0f}MB staged. Waited {time.time() - tic:.1f}s")
+            # copy the next wave while this one is analyzed
+            if wave_i + 1 < len(waves):
+                staged = stage_wave(waves[wave_i + 1], os.path.join(staging_dir, str(wave_i + 1)), executor)
+            analyzing = {scratch_folder:folder_map[scratch_folder] for scratch_folder in staged_files}
+            if scratch_input:
+                run_wave(scratch_input, wave_dir)
+            tic = time.time()
+            synced_bytes = sync_wave(folder_map, staged_files, executor, failures)
+            analyzing = None
+            logger.info(f"Staging: wave {wave_i + 1} of {len(waves)}, {synced_bytes / 2**20:.0f}MB synced back in {time.time() - tic:.1f}s")
+            failures.extend(read_wave_report(os.path.join(wave_dir, FAILURES_REPORT), folder_map).to_dict('records'))
+            schedules.append(read_wave_report(os.path.join(wave_dir, SCHEDULE_REPORT), folder_map).assign(wave=wave_i))
+            shutil.rmtree(wave_dir)
+    finally:
+        # e.g. interrupted. copies not started are cancelled
+        executor.shutdown(cancel_futures=True)
+        if_keep = False
+        if analyzing:
+            try:
+                synced = sum(sync_results(scratch_folder, folder) for scratch_folder, folder in analyzing.items())
+                logger.warning(f"Staging: analysis stopped, results of {synced} .dlm files synced back")
+            except OSError as error:
+                if_keep = True
+                logger.error(f"Staging: analysis stopped and results not synced back ({error}). Scratch kept in {staging_dir}")
+        if not if_keep:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    if report_dir:
+        save_failures_report(failures, report_dir)
+        if any(len(schedule) for schedule in schedules):
+            pd.concat(schedules, ignore_index=True).to_csv(os.path.join(report_dir, SCHEDULE_REPORT))
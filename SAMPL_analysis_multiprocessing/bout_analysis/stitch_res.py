@@ -0,0 +1,120 @@
+'''
+Stitch results of grab_fish_angle() from chunks of the same .dlm file
+Functions:
+    1. Shift index-like columns of a chunk so that bout numbers, IEI numbers, epoch numbers and frame indices continue from previous chunks
+    2. Concatenate shifted chunks and recalculate IEI pairs (wolpert_IEI) across chunk boundaries
+
+Chunks must contain complete epochs. Since bouts and IEIs never cross epochs, stitched results are the same as analyzing the whole file,
+except for xvel_sm and yvel_sm of the last frame of a chunk, which are smoothed with the first frame of the next epoch when analyzing the whole file.
+'''
+import pandas as pd
+
+# bout and IEI outputs of grab_fish_angle(), which are concatenated for each .dlm file. Epoch data are saved chunk by chunk
+BOUT_IEI_DATA_KEYS = ['bout_attributes','prop_bout_aligned','prop_bout2','prop_bout_aligned_long','prop_bout_aligned_long2',
+                      'IEI_attributes','prop_bout_IEI_aligned','prop_bout_IEI2','prop_bout_IEI_timed','wolpert_IEI']
+# columns containing indices of grabbed_all (row of df in grab_fish_angle), which are shifted by the number of rows in previous chunks
+ROW_INDEX_COLUMNS = {
+    'bout_attributes':['peak_idx','swim_start_idx','swim_end_idx','bout_start_idx','bout_end_idx','boutInflectAlign','boutAccAlign'],
+    'prop_bout2':['epochBouts_indices'],
+    'prop_bout_aligned_long2':['boutAlignLong'],
+    'IEI_attributes':['swim_start_idx','swim_end_idx','swim_end_shift'],
+    'heading_matched':['dfIdx'],
+}
+# columns containing bout numbers
+BOUT_NUM_COLUMNS = {
+    'bout_attributes':['boutNum'],
+    'prop_bout2':['propBout_matchIndex'],
+    'prop_bout_aligned_long2':['bout_matchIndex'],
+    'IEI_attributes':['boutNum'],
+    'prop_bout_IEI2':['boutNum'],
+}
+# columns containing IEI numbers
+IEI_NUM_COLUMNS = {
+    'prop_bout_IEI2':['IEI_matchIndex'],
+}
+# columns containing epoch numbers (order of epochs in grabbed_all)
+EPOCH_NUM_COLUMNS = {
+    'epoch_attributes':['index'],
+}
+
+def get_wolpert_IEI(IEI_res2):
+    """find matching IEI, pre-IEI pitch and post-IEI net rotation of consecutive IEIs
+
+    Args:
+        IEI_res2 (DataFrame): prop_bout_IEI2 with index reset
+
+    Returns:
+        DataFrame: wolpert_IEI
+    """
+    IEI_wolpert = pd.DataFrame({
+        # wolpert values starts from the second IEI, thus exclude the first IEI match index
+        'IEI_matchIndex': IEI_res2.loc[1:,'IEI_matchIndex'].tolist(),
+        # only get the pre IEI value, exclude the last speed_window_start.diff(). Be aware that df.loc[a:b] includes both a and b
+        'wolpert_IEI': IEI_res2.loc[:len(IEI_res2)-2,'propBoutIEI'].tolist(),
+        # same as above, exclude the last pitch
+        'wolpert_preIEI_pitch': IEI_res2.loc[:len(IEI_res2)-2,'propBoutIEI_pitchFirst'].tolist(),
+        'wolpert_postIEI_netRot': (IEI_res2.loc[1:,'propBoutIEI_pitchFirst'].values - IEI_res2.loc[:len(IEI_res2)-2,'propBoutIEI_pitchLast'].values).tolist(),
+        'wolpert_Time': IEI_res2.loc[1:,'propBoutIEItime'].tolist()
+        })
+    return IEI_wolpert
+
+def get_res_offsets(res, offsets=None):
+    """get offsets for the next chunk
+
+    Args:
+        res (dict): shifted output of grab_fish_angle()
+        offsets (dict, optional): offsets used to shift res. Defaults to None (res is the first chunk).
+
+    Returns:
+        dict: offsets of rows, bouts, IEIs, epochs and swim windows
+    """
+    if offsets is None:
+        offsets = dict.fromkeys(['row','bout','IEI','epoch','swimWindow'], 0)
+    last_swim_window = res['grabbed_all']['swimWindow'].iloc[-1]
+    return {
+        'row':offsets['row'] + len(res['grabbed_all']),
+        'bout':offsets['bout'] + len(res['bout_attributes']),
+        'IEI':offsets['IEI'] + len(res['prop_bout_IEI2']),
+        'epoch':offsets['epoch'] + len(res['epoch_attributes']),
+        # swim windows have odd numbers. the next chunk starts with a new window with an even number
+        'swimWindow':int(last_swim_window + last_swim_window % 2),
+    }
+
+def shift_res(res, offsets):
+    """shift index-like columns of a chunk by offsets from get_res_offsets()
+
+    Args:
+        res (dict): output of grab_fish_angle() for one chunk
+        offsets (dict): offsets of previous chunks
+
+    Returns:
+        dict: shifted output
+    """
+    res = res.copy()
+    for shift_columns, offset in [(ROW_INDEX_COLUMNS, offsets['row']),
+                                  (BOUT_NUM_COLUMNS, offsets['bout']),
+                                  (IEI_NUM_COLUMNS, offsets['IEI']),
+                                  (EPOCH_NUM_COLUMNS, offsets['epoch'])]:
+        for key, columns in shift_columns.items():
+            res[key] = res[key].assign(**{col:res[key][col] + offset for col in columns})
+    # swim window indices start from NaN in each chunk
+    if offsets['swimWindow']:
+        res['grabbed_all'] = res['grabbed_all'].assign(
+            swimWindow = res['grabbed_all']['swimWindow'].fillna(0) + offsets['swimWindow']
+        )
+    return res
+
+def merge_res(res_list, keys):
+    """concatenate shifted chunks of one .dlm file. wolpert_IEI is recalculated to include IEI pairs across chunks
+
+    Args:
+        res_list (list): shifted outputs of grab_fish_angle()
+        keys (list): keys of res to concatenate
+
+    Returns:
+        dict: output for the whole .dlm file
+    """
+    res = {key:pd.concat([this_res[key] for this_res in res_list], ignore_index=True) for key in keys}
+    if 'wolpert_IEI' in keys:
+        res['wolpert_IEI'] = get_wolpert_IEI(res['prop_bout_IEI2'])
+    return res
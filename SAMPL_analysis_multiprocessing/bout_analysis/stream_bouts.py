@@ -0,0 +1,334 @@
+'''
+Detect bouts of a .dlm file while it is being recorded, for live monitoring of each box
+Functions:
+    1. Read rows appended to a growing .dlm file (read_dlm.read_dlm_tail()) and split them into epochs
+    2. Calculate swim speed of frames of the open epoch as in analyze_dlm_resliced() (epoch truncation, x y smoothing, deltaT, centered coordinates),
+       once EPOCH_BUF frames after them are read. These frames are kept when the epoch is truncated and are not changed by later frames
+    3. Detect bouts frame by frame with a state machine: a swim window starts when speed crosses PROPULSION_THRESHOLD, windows closer than MIN_SWIM_INTERVAL
+       are linked, and the peak is the frame of max speed. Alignment is decided as in grab_fish_angle() once POST_PEAK_FRAMES frames after the peak are read.
+       Bouts are emitted as provisional, about POST_PEAK_FRAMES + EPOCH_BUF frames after the peak, or MIN_SWIM_INTERVAL after the end of longer swim windows
+    4. When an epoch ends, analyze it by analyze_dlm_resliced() and detect bouts again with the same state machine (confirmed).
+       Provisional bouts of epochs dropped by epoch filters are retracted. Duration, heading direction, displacement, angular velocity and acceleration
+       filters need the whole epoch, so they can't be applied to provisional bouts
+
+Only new rows are calculated at each read, and each epoch is analyzed once when it ends, so the time to follow a file is proportional to new data.
+Use stream_bouts() to follow one file, or new_bout_stream(), update_bout_stream() and close_bout_stream() to follow many files in one loop (monitor.py).
+
+Confirmed bouts are the same as bout_attributes of grab_fish_angle() when the file is analyzed after it is closed (BOUT_COLUMNS),
+except that grab_fish_angle() skips files with less than 3 frames of epochs with propulsion or without any aligned bout.
+Swim windows don't cross epochs, as epochs are truncated by more than MIN_SWIM_INTERVAL in total.
+'''
+import os
+import math
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from preprocessing.read_dlm import read_dlm_growing, get_time_stamp
+from preprocessing.analyze_dlm_v5 import analyze_dlm_resliced, epoch_reslice, SCALE, XY_SM_WSZ, DATETIME_FRMT
+from bout_analysis.grab_fish_angle_v5 import PROPULSION_THRESHOLD, MIN_SWIM_INTERVAL
+
+BOUT_COLUMNS = ['epochNum','propBout_time','propBout_maxSpd','propBoutDur','if_align']  # columns of bout_attributes saved by grab_fish_angle()
+ALIGN_BASELINE_SPEED = 3  # mm/s, aligned bouts drop below this speed before and after the peak, see grab_fish_angle()
+DEFAULT_POLL_S = 1
+
+def get_bout_frames(sample_rate):
+    """numbers of frames used for bout detection, same as grab_fish_angle()
+
+    Args:
+        sample_rate (int): frame rate
+
+    Returns:
+        dict: PRE_PEAK_FRAMES, POST_PEAK_FRAMES, BOUT_WINDOW_HALF and frame_number250
+    """
+    return {
+        'PRE_PEAK_FRAMES':math.ceil(sample_rate * 0.5),
+        'POST_PEAK_FRAMES':math.ceil(sample_rate * 0.3),
+        'BOUT_WINDOW_HALF':math.ceil(0.3 * sample_rate),
+        'frame_number250':int(0.25 * sample_rate),
+    }
+
+def new_detector(epochNum):
+    """state of bout detection in one epoch
+
+    Args:
+        epochNum (float): epoch number, resliced for 40 Hz data
+
+    Returns:
+        dict: recent frames (speed and absTime from frame offset on), number of frames read, the open swim window and closed swim windows waiting to be emitted
+    """
+    return {
+        'epochNum':epochNum,
+        'speed':np.empty(0),
+        'absTime':np.empty(0, dtype='datetime64[ns]'),
+        'offset':0,
+        'n_frames':0,
+        'window':None,  # [start, last frame above threshold, peak]
+        'windows':[],
+    }
+
+def detect_frames(detector, speed, abs_time):
+    """add frames to an epoch and update its swim windows
+
+    Args:
+        detector (dict): output of new_detector(). Updated in place
+        speed (array): swim speed of new frames, NaN for the first frame of the epoch
+        abs_time (array): absTime of new frames, datetime64[ns]
+
+    Returns:
+        array: absTime of frames where speed crosses PROPULSION_THRESHOLD, before swim windows are linked
+    """
+    n_read = detector['n_frames']
+    offset = detector['offset']
+    detector['speed'] = np.concatenate([detector['speed'], speed])
+    detector['absTime'] = np.concatenate([detector['absTime'], abs_time])
+    detector['n_frames'] += len(speed)
+    speeds = detector['speed']
+    times = detector['absTime'].view('int64')
+    min_interval = pd.Timedelta(seconds=MIN_SWIM_INTERVAL).value
+    window = detector['window']
+    crossings = []
+    for k in range(n_read, detector['n_frames']):
+        if speeds[k-offset] >= PROPULSION_THRESHOLD:
+            if k == 0 or not speeds[k-offset-1] >= PROPULSION_THRESHOLD:
+                crossings.append(k-offset)
+            if window is None:
+                window = [k, k, k]
+            else:
+                # same window, or linked to the last window if the interval is shorter than MIN_SWIM_INTERVAL
+                window[1] = k
+                if speeds[k-offset] > speeds[window[2]-offset]:
+                    window[2] = k
+        elif window is not None and times[k-offset] - times[window[1]-offset] >= min_interval:
+            # any later frame above threshold is a new swim window
+            detector['windows'].append(window)
+            window = None
+    detector['window'] = window
+    return detector['absTime'][crossings]
+
+def get_bouts(detector, sample_rate, if_epoch_end=False):
+    """get bouts of closed swim windows with enough frames after the peak to decide alignment.
+    Bouts returned are removed from the detector, and so are frames no longer needed
+
+    Args:
+        detector (dict): output of new_detector()
+        sample_rate (int): frame rate
+        if_epoch_end (bool, optional): True if all frames of the epoch are read, in which case all swim windows are closed. Defaults to False.
+
+    Returns:
+        list: dict of BOUT_COLUMNS for each bout, in the order of peaks
+    """
+    frames = get_bout_frames(sample_rate)
+    speeds = detector['speed']
+    offset = detector['offset']
+    last = detector['n_frames'] - 1
+    if if_epoch_end and detector['window'] is not None:
+        detector['windows'].append(detector['window'])
+        detector['window'] = None
+    bouts = []
+    while detector['windows']:
+        start, end, peak = detector['windows'][0]
+        if not if_epoch_end and peak + max(frames['POST_PEAK_FRAMES'], frames['BOUT_WINDOW_HALF']) > last:
+            break
+        detector['windows'].pop(0)
+        bout_end = min(peak + frames['BOUT_WINDOW_HALF'], last)
+        # if window is far enough from epoch edge to allow alignment & spd during pre/post peak window are sufficiently low
+        if_align = peak >= frames['PRE_PEAK_FRAMES'] and\
+            np.nanmin(speeds[peak-frames['frame_number250']-offset:peak+1-offset]) < ALIGN_BASELINE_SPEED and\
+            np.nanmin(speeds[peak-offset:bout_end+1-offset]) < ALIGN_BASELINE_SPEED and\
+            peak <= last - frames['POST_PEAK_FRAMES']
+        bouts.append({
+            'epochNum':detector['epochNum'],
+            'propBout_time':pd.Timestamp(detector['absTime'][peak-offset]),
+            'propBout_maxSpd':speeds[peak-offset],
+            'propBoutDur':(end - start + 1)/sample_rate,
+            'if_align':bool(if_align),
+        })
+    # keep frames from frame_number250 before the earliest peak to come, which is at the last frame at the earliest
+    peaks = [window[2] for window in detector['windows']] + ([detector['window'][2]] if detector['window'] else [])
+    keep_from = max(min(peaks + [last]) - frames['frame_number250'], offset)
+    detector['speed'] = speeds[keep_from-offset:]
+    detector['absTime'] = detector['absTime'][keep_from-offset:]
+    detector['offset'] = keep_from
+    return bouts
+
+def new_epoch(epochNum, fishNum_offset, frame_rate):
+    """state of an epoch being read
+
+    Args:
+        epochNum (float): epoch number, resliced for 40 Hz data
+        fishNum_offset (int): sum of fishNum before the epoch, see analyze_dlm_resliced()
+        frame_rate (int): frame rate
+
+    Returns:
+        dict: rows of the epoch, recent rows for smoothing, state of calculated frames, detector and provisional bouts
+    """
+    return {
+        'raw':[],
+        'n_rows':0,
+        'fishNum_offset':fishNum_offset,
+        'recent':np.empty((0, 3)),  # absx, absy and time of the last rows, for smoothing and deltaT of the next frames
+        'xy0':None,  # centered coordinates of the first frame
+        'last_xy':None,  # centered coordinates of the last frame
+        'detector':new_detector(epochNum),
+        'provisional':[],
+    }
+
+def get_settled_frames(epoch, raw, frame_rate, start_time):
+    """add rows to an epoch and calculate swim speed of frames followed by EPOCH_BUF rows, as in analyze_dlm_resliced().
+    These frames are kept when the epoch is truncated and are smoothed by rows already read. Only new frames are calculated
+
+    Args:
+        epoch (dict): output of new_epoch(). Updated in place
+        raw (DataFrame): new rows of the epoch
+        frame_rate (int): frame rate
+        start_time (datetime): start time of the .dlm file
+
+    Returns:
+        array: swim speed of new frames, NaN for the first frame of the epoch
+        array: absTime of new frames, datetime64[ns]
+    """
+    EPOCH_BUF = math.ceil(frame_rate/20)
+    # frames kept are smoothed by rows of the same epoch, as EPOCH_BUF > XY_SM_WSZ//2
+    half = XY_SM_WSZ//2 if frame_rate > 100 else 0
+    epoch['raw'].append(raw)
+    rows = np.concatenate([epoch['recent'], raw[['absx','absy','time']].values])
+    rows_offset = epoch['n_rows'] - len(epoch['recent'])  # row of the epoch at rows[0]
+    start = max(epoch['n_rows'] - EPOCH_BUF, EPOCH_BUF)
+    epoch['n_rows'] += len(raw)
+    end = epoch['n_rows'] - EPOCH_BUF
+    epoch['recent'] = rows[-(EPOCH_BUF + half + 1):]
+    if end <= start:
+        return np.empty(0), np.empty(0, dtype='datetime64[ns]')
+    if half:
+        xy = np.column_stack([
+            np.convolve(rows[start-half-rows_offset:end+half-rows_offset, i], np.ones(XY_SM_WSZ,dtype=int), 'valid')/XY_SM_WSZ for i in (0, 1)
+        ])
+    else:
+        xy = rows[start-rows_offset:end-rows_offset, :2]
+    time = rows[start-rows_offset:end-rows_offset, 2]
+    # deltaT of the first row of the truncated epoch is NA
+    deltaT = np.diff(time, prepend=rows[start-1-rows_offset, 2] if start > EPOCH_BUF else np.nan)
+    kept = deltaT > 0
+    if not kept.any():
+        return np.empty(0), np.empty(0, dtype='datetime64[ns]')
+    if epoch['xy0'] is None:
+        epoch['xy0'] = xy[kept][0]
+    xy = xy[kept] - epoch['xy0']
+    dist = np.linalg.norm(np.diff(xy, axis=0, prepend=[epoch['last_xy'] if epoch['last_xy'] is not None else [np.nan, np.nan]]), axis=1)
+    epoch['last_xy'] = xy[-1]
+    speed = np.divide(dist / SCALE, deltaT[kept])
+    abs_time = np.datetime64(start_time, 'ns') + pd.to_timedelta(time[kept], unit='s').values
+    return speed, abs_time
+
+def close_epoch(epoch, file, frame_rate):
+    """analyze an epoch that ended and confirm its bouts
+
+    Args:
+        epoch (dict): output of new_epoch()
+        file (string): .dlm directory
+        frame_rate (int): frame rate
+
+    Returns:
+        list: ('retracted' or 'confirmed', bout) of provisional bouts not confirmed and of all bouts of the epoch, see get_bouts()
+    """
+    EPOCH_BUF = math.ceil(frame_rate/20)
+    MIN_DUR = 2.5 * frame_rate
+    confirmed = []
+    # epochs too short to be kept are not analyzed
+    if epoch['n_rows'] - 2*EPOCH_BUF >= MIN_DUR:
+        analyzed, _, _ = analyze_dlm_resliced(pd.concat(epoch['raw']), 0, file, os.path.dirname(file), frame_rate, epoch['fishNum_offset'])
+        if type(analyzed) != str:
+            detector = new_detector(epoch['detector']['epochNum'])
+            detect_frames(detector, analyzed['swimSpeed'].values, analyzed['absTime'].values)
+            confirmed = get_bouts(detector, frame_rate, if_epoch_end=True)
+    return [('retracted', bout) for bout in epoch['provisional'] if bout not in confirmed] + [('confirmed', bout) for bout in confirmed]
+
+def new_bout_stream(file, frame_rate):
+    """state of bout detection of a .dlm file being recorded
+
+    Args:
+        file (string): .dlm directory
+        frame_rate (int): frame rate
+
+    Returns:
+        dict: start time of the file, sum of fishNum read and the open epoch
+    """
+    return {
+        'file':file,
+        'frame_rate':frame_rate,
+        'start_time':datetime.strptime(get_time_stamp(file), DATETIME_FRMT),
+        'fishNum_offset':0,
+        'epoch':None,
+    }
+
+def update_bout_stream(stream, raw):
+    """detect bouts of new rows of a .dlm file. Epochs that ended are confirmed
+
+    Args:
+        stream (dict): output of new_bout_stream(). Updated in place
+        raw (DataFrame): new rows, e.g. from read_dlm.read_dlm_tail()
+
+    Returns:
+        list: ('provisional', 'confirmed' or 'retracted', bout), see get_bouts()
+        array: absTime of frames where speed crosses PROPULSION_THRESHOLD, see detect_frames()
+    """
+    file, frame_rate = stream['file'], stream['frame_rate']
+    if frame_rate == 40:
+        # epochs are resliced at frames with more than 1 fish, as in analyze_dlm_resliced()
+        resliced = epoch_reslice(raw, stream['fishNum_offset'])
+        stream['fishNum_offset'] += raw['fishNum'].sum()
+        epoch_keys = resliced['epochNum'].values
+        epoch_offsets = resliced['cumsum_fishNum'].values
+        raw = raw.loc[resliced.index]
+    else:
+        epoch_keys = raw['epochNum'].values
+        epoch_offsets = np.zeros(len(raw))
+    events = []
+    crossings = []
+    # split rows at changes of epochs
+    epoch_starts = np.flatnonzero(np.concatenate([[True], epoch_keys[1:] != epoch_keys[:-1]]))
+    for start, end in zip(epoch_starts, np.append(epoch_starts[1:], len(raw))):
+        epoch = stream['epoch']
+        if epoch is None or epoch_keys[start] != epoch['detector']['epochNum']:
+            if epoch is not None:
+                events.extend(close_epoch(epoch, file, frame_rate))
+            epoch = stream['epoch'] = new_epoch(epoch_keys[start], epoch_offsets[start], frame_rate)
+        speed, abs_time = get_settled_frames(epoch, raw.iloc[start:end], frame_rate, stream['start_time'])
+        crossings.append(detect_frames(epoch['detector'], speed, abs_time))
+        bouts = get_bouts(epoch['detector'], frame_rate)
+        epoch['provisional'].extend(bouts)
+        events.extend(('provisional', bout) for bout in bouts)
+    return events, np.concatenate(crossings) if crossings else np.empty(0, dtype='datetime64[ns]')
+
+def close_bout_stream(stream):
+    """confirm bouts of the last epoch when the recording ended
+
+    Args:
+        stream (dict): output of new_bout_stream(). Updated in place
+
+    Returns:
+        list: ('confirmed' or 'retracted', bout), see get_bouts()
+    """
+    epoch, stream['epoch'] = stream['epoch'], None
+    return close_epoch(epoch, stream['file'], stream['frame_rate']) if epoch is not None else []
+
+def stream_bouts(file, frame_rate, poll_s=DEFAULT_POLL_S, idle_s=300):
+    """detect bouts of a .dlm file while it is being recorded. Ends when the recording ends, see read_dlm.read_dlm_tail().
+    Each bout is emitted as provisional with bounded latency, then confirmed or retracted when its epoch ends.
+    Bouts of an epoch are all confirmed at the end of the epoch, including bouts emitted as provisional before
+
+    Args:
+        file (string): .dlm directory
+        frame_rate (int): frame rate
+        poll_s (float, optional): seconds between checks for new lines. Defaults to DEFAULT_POLL_S (1).
+        idle_s (float, optional): seconds without modification after which a .dlm file without parameters.ini is closed. Defaults to 300.
+
+    Yields:
+        string: 'provisional', 'confirmed' or 'retracted'
+        dict: bout, see get_bouts()
+    """
+    stream = new_bout_stream(file, frame_rate)
+    for raw in read_dlm_growing(0, file, poll_s, idle_s):
+        events, _ = update_bout_stream(stream, raw)
+        yield from events
+    yield from close_bout_stream(stream)
@@ -0,0 +1,139 @@
+'''
+Fault isolation of analysis tasks
+Functions:
+    1. Run a task and return the error with its traceback instead of raising it, so that one .dlm file doesn't stop the run
+    2. Report the start of each task in pool workers, so that runMP can stop tasks running longer than the timeout
+    3. Save failed tasks as SAMPL failures report.csv
+
+A task fails if it raises, runs longer than the timeout, or its worker exits (e.g. killed when out of memory). Failed tasks are retried up to max_retries times.
+The worker of a task that timed out is terminated and replaced by the pool.
+Results of failed .dlm files are not saved, so their folders are merged without them and they are analyzed again when the run is resumed.
+'''
+import os
+import signal
+import time
+import traceback
+from datetime import datetime
+import pandas as pd
+from bout_analysis.logger import log_SAMPL_ana, init_log_queue
+
+FAILURES_REPORT = 'SAMPL failures report.csv'
+FAILURE_COLUMNS = ['folder','file','task','attempt','error','message','failed_at','traceback']
+
+# queue of task starts in the main process. set in pool workers by init_worker()
+_start_queue = None
+
+def init_worker(log_queue, start_queue=None):
+    """initializer of pool workers
+
+    Args:
+        log_queue (Queue): see logger.init_log_queue()
+        start_queue (Queue, optional): queue to report the start of each task. Defaults to None.
+    """
+    init_log_queue(log_queue)
+    global _start_queue
+    _start_queue = start_queue
+
+def run_guarded(task_key, func, args, kwargs=None):
+    """run func(*args, **kwargs), return the error instead of raising it
+
+    Args:
+        task_key (tuple): id of the task, reported with the process id when the task starts
+        func (function): task function
+        args (tuple): arguments of func
+        kwargs (dict, optional): keyword arguments of func. Defaults to None.
+
+    Returns:
+        output of func. None if failed
+        dict: error, message and traceback. None if succeeded
+    """
+    if _start_queue is not None:
+        _start_queue.put((task_key, os.getpid(), time.time()))
+    try:
+        return func(*args, **(kwargs or {})), None
+    except Exception as error:
+        return None, {'error':type(error).__name__, 'message':str(error), 'traceback':traceback.format_exc()}
+
+def stop_worker(pid):
+    """terminate a pool worker, e.g. running a task longer than the timeout. The pool starts a new worker
+
+    Args:
+        pid (int): process id of the worker
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        # worker exited already
+        pass
+
+def get_failure(task, folder, file, attempt, error):
+    """get a row of the failures report
+
+    Args:
+        task (string): name of the task function
+        folder (string): root directory
+        file (string): .dlm directory. None for folder tasks
+        attempt (int): attempt number, starting from 1
+        error (dict): output of run_guarded()
+
+    Returns:
+        dict: row of the failures report
+    """
+    return {
+        'folder':folder,
+        'file':file,
+        'task':task,
+        'attempt':attempt,
+        'failed_at':datetime.now().isoformat(),
+        **error,
+    }
+
+def log_failure(failure, max_retries):
+    """log a failed attempt with its traceback
+
+    Args:
+        failure (dict): output of get_failure()
+        max_retries (int): number of retries of each task
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    next_step = 'retrying' if failure['attempt'] <= max_retries else 'skipped'
+    logger.error(f"{failure['task']} failed on attempt {failure['attempt']}, {next_step}: {failure['file'] or failure['folder']}. {failure['error']}: {failure['message']}\n{failure['traceback']}",
+                 extra={'folder':failure['folder'], 'file':failure['file'], 'stage':failure['task']})
+
+def run_with_retries(func, args, folder, file=None, max_retries=1, kwargs=None):
+    """run a task in the current process until it succeeds or max_retries retries fail. No timeout
+
+    Args:
+        func (function): task function
+        args (tuple): arguments of func
+        folder (string): root directory
+        file (string, optional): .dlm directory. Defaults to None.
+        max_retries (int, optional): number of retries. Defaults to 1.
+        kwargs (dict, optional): keyword arguments of func. Defaults to None.
+
+    Returns:
+        output of func. None if all attempts failed
+        list: failed attempts, see get_failure()
+    """
+    failures = []
+    for attempt in range(1, max_retries + 2):
+        output, error = run_guarded(None, func, args, kwargs)
+        if error is None:
+            return output, failures
+        failures.append(get_failure(func.__name__, folder, file, attempt, error))
+        log_failure(failures[-1], max_retries)
+    return None, failures
+
+def save_failures_report(failures, report_dir):
+    """save failed attempts of all tasks as SAMPL failures report.csv. Removes the report of a previous run if nothing failed
+
+    Args:
+        failures (list): outputs of get_failure()
+        report_dir (string): folder to save the report
+    """
+    report_file = os.path.join(report_dir, FAILURES_REPORT)
+    if not failures:
+        if os.path.exists(report_file):
+            os.remove(report_file)
+        return
+    pd.DataFrame(failures, columns=FAILURE_COLUMNS).to_csv(report_file)
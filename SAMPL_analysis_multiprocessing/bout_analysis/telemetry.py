@@ -0,0 +1,138 @@
+'''
+Opt-in performance telemetry of the analysis pipeline
+Functions:
+    1. Record wall time, CPU time and peak memory (RSS) of each stage, e.g. read_dlm, each filter in analyze_dlm, bout detection, alignment, IEI extraction and hdf5 writes
+    2. Save a run report of each folder next to analysis info.csv:
+        analysis telemetry.csv: one row per stage per .dlm file, with the worker process and throughput (frames/s, bouts/s)
+        analysis telemetry.json: time per stage and per worker, and the slowest .dlm files
+
+To record a stage:
+    tic = start_stage()
+    ...
+    tic = end_stage(tic, 'stage name', frames=len(df))  # returns the start of the next stage
+Nothing is recorded until enable() is called in the process, so instrumented code runs as before when telemetry is off.
+Records are kept in the process that runs the stage. Workers save them with the results of each .dlm file (see dlm_cache.py).
+Peak RSS is the peak of the process up to the end of the stage. It is not available on Windows.
+'''
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from multiprocessing import current_process
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TELEMETRY_COLUMNS = ['folder','file','worker','stage','wall_s','cpu_s','peak_rss_MB','frames','bouts']
+TOP_N_FILES = 5  # number of slowest files in the summary
+
+_enabled = False
+_context = {'folder':None, 'file':None}
+_records = []
+
+def enable(if_enabled=True):
+    """turn telemetry on or off in the current process"""
+    global _enabled
+    _enabled = if_enabled
+
+def set_context(folder=None, file=None):
+    """set folder and .dlm file of following records"""
+    _context.update(folder=folder, file=file)
+
+def get_peak_rss():
+    """peak RSS of the current process in MB"""
+    if resource is None:
+        return np.nan
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on linux
+
+def start_stage():
+    """get the start of a stage
+
+    Returns:
+        tuple: wall time and CPU time. None if telemetry is off
+    """
+    if not _enabled:
+        return None
+    return time.perf_counter(), time.process_time()
+
+def end_stage(start, stage, frames=np.nan, bouts=np.nan):
+    """record a stage started by start_stage()
+
+    Args:
+        start (tuple): output of start_stage()
+        stage (string): name of the stage
+        frames (int, optional): number of frames processed, for throughput. Defaults to NaN.
+        bouts (int, optional): number of bouts processed, for throughput. Defaults to NaN.
+
+    Returns:
+        tuple: start of the next stage. None if telemetry is off
+    """
+    if not _enabled or start is None:
+        return None
+    wall, cpu = time.perf_counter(), time.process_time()
+    _records.append({
+        **_context,
+        'worker':current_process().name,
+        'stage':stage,
+        'wall_s':wall - start[0],
+        'cpu_s':cpu - start[1],
+        'peak_rss_MB':get_peak_rss(),
+        'frames':frames,
+        'bouts':bouts,
+    })
+    return time.perf_counter(), time.process_time()
+
+def pop_records():
+    """get and clear records of the current process
+
+    Returns:
+        DataFrame: one row per stage
+    """
+    records = pd.DataFrame(_records, columns=TELEMETRY_COLUMNS)
+    _records.clear()
+    return records
+
+def save_run_report(records, output_dir):
+    """save records of a folder and the summary
+
+    Args:
+        records (DataFrame): records of all .dlm files in the folder
+        output_dir (string): folder to save the report
+    """
+    records = records.reset_index(drop=True)
+    records = records.assign(
+        frames_per_s = records['frames'] / records['wall_s'],
+        bouts_per_s = records['bouts'] / records['wall_s'],
+    )
+    records.to_csv(os.path.join(output_dir, 'analysis telemetry.csv'))
+    by_stage = records.groupby('stage', sort=False).agg(
+        wall_s = ('wall_s','sum'),
+        cpu_s = ('cpu_s','sum'),
+        peak_rss_MB = ('peak_rss_MB','max'),
+        # NaN if not counted in the stage
+        frames = ('frames', lambda x: x.sum(min_count=1)),
+        bouts = ('bouts', lambda x: x.sum(min_count=1)),
+    )
+    by_stage = by_stage.assign(
+        frames_per_s = by_stage['frames'] / by_stage['wall_s'],
+        bouts_per_s = by_stage['bouts'] / by_stage['wall_s'],
+    )
+    by_file = records.dropna(subset=['file']).groupby('file').agg(
+        wall_s = ('wall_s','sum'),
+        cpu_s = ('cpu_s','sum'),
+        peak_rss_MB = ('peak_rss_MB','max'),
+    ).sort_values('wall_s', ascending=False)
+    # NaN (e.g. peak RSS on Windows) is not valid json, save as null
+    by_stage = by_stage.astype(object).where(by_stage.notna(), None)
+    by_file = by_file.astype(object).where(by_file.notna(), None)
+    summary = {
+        'total_wall_s':records['wall_s'].sum(),
+        'total_cpu_s':records['cpu_s'].sum(),
+        'stages':by_stage.to_dict(orient='index'),
+        'workers':records.groupby('worker')['wall_s'].sum().to_dict(),
+        'slowest_files':by_file.head(TOP_N_FILES).reset_index().to_dict(orient='records'),
+    }
+    with open(os.path.join(output_dir, 'analysis telemetry.json'), 'w') as f:
+        json.dump(summary, f, indent=2, default=float)
@@ -0,0 +1,235 @@
+'''
+Watch root directories and analyze .dlm files as they are recorded, see SAMPL_watch.py
+Functions:
+    1. Poll roots every poll_s seconds for .dlm files that are closed: either unchanged since the last poll and with parameters.ini saved next to it,
+       or not modified for settle_s seconds. Packed .dlm files are closed
+    2. Analyze closed files that are not analyzed yet in one persistent pool of workers, through runMP(), and merge their folders.
+       New files named after merged files are appended to bout_data.h5 etc. without merging the folder again
+    3. Backpressure: at most max_batch_files new files are analyzed per poll. Other files wait for the next poll, and roots are not polled while a batch runs
+    4. Restart-safe: the state of each root is saved as <root>/SAMPL watch state.json after each poll. Results of each .dlm file are saved when analyzed (dlm results/),
+       so a restarted watch doesn't analyze them again and merges folders left unmerged
+
+Files that failed are not analyzed again, nor merged, until they change. See SAMPL failures report.csv in report_dir.
+Errors of a poll, e.g. a root on a network volume that is not reachable or a manifest that can't be read, are logged with their traceback and the root is polled again at the next poll.
+Errors of a batch are logged the same way. Only Ctrl+C stops the watch.
+'''
+import os
+import json
+import time
+from preprocessing.data_manifest import get_dlm_folders
+from preprocessing.read_dlm import get_pack
+from preprocessing.read_ini import get_ini_file
+from bout_analysis.logger import log_SAMPL_ana, start_log_listener, stop_log_listener
+from bout_analysis.dlm_cache import get_dlm_state, is_cache_current, read_manifest
+from bout_analysis.grab_fish_angle_v5 import get_analysis_settings, start_pool, runMP
+from bout_analysis.recording_index import update_recording_index
+
+WATCH_STATE = 'SAMPL watch state.json'
+DEFAULT_POLL_S = 60
+DEFAULT_SETTLE_S = 300
+DEFAULT_MAX_BATCH_FILES = 64
+
+def read_watch_state(root):
+    """read the state of a watched root
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        dict: file: {'dlm_size', 'dlm_mtime', 'status'}. status is new, analyzed or failed
+    """
+    state_file = os.path.join(root, WATCH_STATE)
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+def save_watch_state(root, state):
+    """save the state of a watched root. Replaced in one step, so an interrupted save leaves the previous state
+
+    Args:
+        root (string): directory of behavior data
+        state (dict): output of read_watch_state()
+    """
+    state_file = os.path.join(root, WATCH_STATE)
+    with open(state_file + '.part', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_file + '.part', state_file)
+
+def is_closed(file, dlm_mtime, now, settle_s):
+    """check whether a .dlm file is closed by the acquisition, if unchanged since the last poll
+
+    Args:
+        file (string): .dlm directory
+        dlm_mtime (float): modification time of the .dlm file
+        now (float): time of this poll
+        settle_s (float): seconds a .dlm file without parameters.ini must not be modified
+
+    Returns:
+        bool: True if closed
+    """
+    return bool(get_pack(file)) or now - dlm_mtime >= settle_s or os.path.exists(get_ini_file(file))
+
+def folder_is_merged(folder, file):
+    """check whether a .dlm file is in the merged results of its folder
+
+    Args:
+        folder (string): root directory
+        file (string): .dlm directory
+
+    Returns:
+        bool: True if merged
+    """
+    manifest = read_manifest(folder)
+    return manifest is not None and os.path.basename(file) in manifest['file'].to_list()
+
+def poll_root(root, state, settle_s, settings, now):
+    """update the state of a root and get its folders with closed .dlm files not analyzed yet
+
+    Args:
+        root (string): directory of behavior data
+        state (dict): output of read_watch_state(). Updated in place
+        settle_s (float): see is_closed()
+        settings (dict): output of grab_fish_angle_v5.get_analysis_settings()
+        now (float): time of this poll
+
+    Returns:
+        list: (root, folder, closed .dlm files in the order of file names, new .dlm files) of each folder with new files. Failed files are not included
+    """
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    folders, _ = get_dlm_folders(root)
+    polled = []
+    files = set()
+    for folder, filenames in folders:
+        closed = []
+        new = []
+        for file in filenames:
+            files.add(file)
+            try:
+                dlm_state = get_dlm_state(file, if_hash=False)
+            except OSError:
+                # removed since listed
+                continue
+            file_state = state.get(file)
+            if file_state is None or (file_state['dlm_size'], file_state['dlm_mtime']) != (dlm_state['dlm_size'], dlm_state['dlm_mtime']):
+                file_state = state[file] = {'dlm_size':dlm_state['dlm_size'], 'dlm_mtime':dlm_state['dlm_mtime'], 'status':'new'}
+                if not get_pack(file) and now - dlm_state['dlm_mtime'] < settle_s:
+                    # may be still being written, closed if unchanged at the next poll
+                    continue
+            if file_state['status'] == 'failed' or not is_closed(file, dlm_state['dlm_mtime'], now, settle_s):
+                # failed files are not analyzed again with new files of their folder
+                continue
+            closed.append(file)
+            if file_state['status'] != 'new':
+                continue
+            if is_cache_current(file, settings) and folder_is_merged(folder, file):
+                # analyzed before the watch started
+                file_state['status'] = 'analyzed'
+                continue
+            new.append(file)
+        if new:
+            polled.append((root, folder, closed, new))
+    for file in [file for file in state if file not in files]:
+        logger.info(f"Watch: {file} removed")
+        del state[file]
+    return polled
+
+def get_watch_input(polled, states, frame_rates, max_batch_files, if_epoch_data=False, if_epoch_float32=False, chunk_rows=None, if_telemetry=False):
+    """get arguments of run() for folders to analyze in this batch, folders with the oldest new files first
+
+    Args:
+        polled (list): outputs of poll_root() of all roots
+        states (dict): state of each root
+        frame_rates (dict): frame rate of each root
+        max_batch_files (int): number of new files to analyze at most. Folders are not split, at least one folder is analyzed
+        other args: see SAMPL_analysis_mp()
+
+    Returns:
+        list: arguments of run() for each folder
+        list: outputs of poll_root() of the folders
+    """
+    polled = sorted(polled, key=lambda folder_poll: min(states[folder_poll[0]][file]['dlm_mtime'] for file in folder_poll[3]))
+    dlm_input = []
+    batch = []
+    n_files = 0
+    for root, folder, closed, new in polled:
+        if dlm_input and n_files + len(new) > max_batch_files:
+            break
+        n_files += len(new)
+        dlm_input.append((closed, folder, frame_rates[root], if_epoch_data, if_epoch_float32, chunk_rows, None, if_telemetry))
+        batch.append((root, folder, closed, new))
+    return dlm_input, batch
+
+def watch(jobs, poll_s=DEFAULT_POLL_S, settle_s=DEFAULT_SETTLE_S, max_batch_files=DEFAULT_MAX_BATCH_FILES, if_epoch_data=False, if_epoch_float32=False, chunk_rows=None, if_telemetry=False,
+          log_dir=None, report_dir=None, memory_budget_MB=None, max_retries=1, task_timeout_s=None, max_polls=None, root_log_dirs=None):
+    """watch root directories and analyze .dlm files as they are recorded, until interrupted (Ctrl+C)
+
+    Args:
+        jobs (list): tuples of (root, frame_rate)
+        poll_s (float, optional): seconds between polls. Defaults to DEFAULT_POLL_S (60).
+        settle_s (float, optional): seconds a .dlm file without parameters.ini must not be modified to be analyzed. Defaults to DEFAULT_SETTLE_S (300).
+        max_batch_files (int, optional): number of new .dlm files analyzed at most per poll. Defaults to DEFAULT_MAX_BATCH_FILES (64).
+        report_dir (string, optional): folder to save the schedule and failures reports of the last batch. Defaults to None (log_dir or the current directory).
+        max_polls (int, optional): stop after max_polls polls. Defaults to None (until interrupted).
+        root_log_dirs (dict, optional): see SAMPL_analysis_batch(). Defaults to None.
+        other args: see SAMPL_analysis_mp()
+    """
+    log_queue, log_listener = start_log_listener(log_dir, root_log_dirs=root_log_dirs)
+    logger = log_SAMPL_ana('SAMPL_ana_log')
+    report_dir = report_dir or log_dir or os.getcwd()
+    frame_rates = dict(jobs)
+    states = {root:read_watch_state(root) for root in frame_rates}
+    # one pool for all batches, so workers are not started again for each batch
+    pool, start_queue = start_pool(log_queue)
+    logger.info(f"Watch started: {', '.join(states)}. Poll every {poll_s}s, settle {settle_s}s, at most {max_batch_files} files per batch")
+    n_polls = 0
+    try:
+        while max_polls is None or n_polls < max_polls:
+            tic = time.time()
+            n_polls += 1
+            polled = []
+            for root, frame_rate in frame_rates.items():
+                settings = get_analysis_settings(frame_rate, if_epoch_data, if_epoch_float32)
+                try:
+                    polled.extend(poll_root(root, states[root], settle_s, settings, tic))
+                except Exception as error:
+                    logger.exception(f"Watch: {root} not polled, polled again at the next poll. {type(error).__name__}: {error}")
+            try:
+                dlm_input, batch = get_watch_input(polled, states, frame_rates, max_batch_files, if_epoch_data, if_epoch_float32, chunk_rows, if_telemetry)
+                if dlm_input:
+                    n_new = sum(len(new) for *_, new in batch)
+                    n_waiting = sum(len(new) for *_, new in polled) - n_new
+                    logger.info(f"Watch: {n_new} new .dlm files in {len(batch)} folders" + (f", {n_waiting} waiting for the next batch" if n_waiting else ""))
+                    runMP(dlm_input, report_dir=report_dir, if_resume=True, log_queue=log_queue, memory_budget_MB=memory_budget_MB,
+                          max_retries=max_retries, task_timeout_s=task_timeout_s, pool=pool, start_queue=start_queue)
+                    for root, folder, closed, new in batch:
+                        settings = get_analysis_settings(frame_rates[root], if_epoch_data, if_epoch_float32)
+                        for file in new:
+                            if not is_cache_current(file, settings):
+                                states[root][file]['status'] = 'failed'
+                                logger.warning(f"Watch: {file} failed, not analyzed again until it changes")
+                            elif folder_is_merged(folder, file):
+                                states[root][file]['status'] = 'analyzed'
+                            # otherwise merged again at the next poll
+                    for root in dict.fromkeys(root for root, *_ in batch):
+                        update_recording_index(root)
+                    logger.info(f"Watch: batch analyzed in {time.time() - tic:.0f}s")
+                for root in states:
+                    save_watch_state(root, states[root])
+            except Exception as error:
+                # files of the batch not marked analyzed are checked again at the next poll, and are not analyzed again if their results are saved (if_resume)
+                logger.exception(f"Watch: poll failed, retried at the next poll. {type(error).__name__}: {error}")
+            if max_polls is not None and n_polls >= max_polls:
+                break
+            time.sleep(max(0, poll_s - (time.time() - tic)))
+    except KeyboardInterrupt:
+        logger.info("Watch stopped")
+    finally:
+        for root in states:
+            try:
+                save_watch_state(root, states[root])
+            except OSError as error:
+                logger.error(f"Watch: state of {root} not saved. {type(error).__name__}: {error}")
+        pool.terminate()
+        pool.join()
+        stop_log_listener(log_listener)
@@ -5,10 +5,12 @@ import numpy as np
 from datetime import datetime
 from datetime import timedelta
 import math
+from bout_analysis.telemetry import start_stage, end_stage
+from preprocessing.read_dlm import get_time_stamp
 
 # %%
 # Constants
-analyze_dlm_ver = 'v5.1.20230621'
+analyze_dlm_ver = 'v5.2.20261019'
 # MAX_FISH = 1         # all epochs that have more than one fish
 MAX_INST_DISPL = 35  # in mm epochs where fish# > 1 but appear as 1 fish will have improbably large instantaneous displacement.
 MAX_ANG_VEL = 250  # initial angular velocity filter
@@ -19,6 +21,7 @@ MIN_VERTICLE_VEL = -7 # (mm/s) max verdical displacement difference. Used to exc
 
 # Other parameters
 SCALE = 60           #(pix/mm) 
+DATETIME_FRMT = '%y%m%d %H.%M.%S'  # start time in .dlm file names
 SM_WINDOW_FOR_FILTER = 9     # smoothing
 SM_WINDOW_FOR_ANGVEL = 5
 
@@ -42,12 +45,13 @@ def smooth_series_ML(a,WSZ):
     res = np.concatenate((  start , out0, stop  ))
     return pd.Series(data=res, index=a.index)
 
-def epoch_reslice(df):
+def epoch_reslice(df, fishNum_offset=0):
     '''
     generate new epoch numbers by truncating each epoch at timepoints with more than 1 fish
     Frames with more than 1 fish are deletted
+    fishNum_offset: sum of fishNum in previous chunks of the same .dlm, if df is a chunk
     '''
-    df = df.assign(cumsum_fishNum = np.cumsum(df['fishNum']))
+    df = df.assign(cumsum_fishNum = np.cumsum(df['fishNum']) + fishNum_offset)
     # get rid of frames with more than one fish 
     df = df[df.fishNum == 0]  # fishNum == 0 for 1 fish
     # calculate new epoch number using cumsum_fishNum and epoch Num
@@ -115,7 +119,7 @@ def displ_dist_vel_filter(df,MAX_DIST_TRAVEL):
 
 # %%
 # Main function
-def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
+def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate, fishNum_offset=0):
     """
     Analyze Free Vertical (YZ 2021.06.18)
     1. Truncate epochs
@@ -129,6 +133,7 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
         file (string): .dlm directory
         folder (string): directory of folder containing the current dlm
         frame_rate (int): frame rate
+        fishNum_offset (int, optional): sum of fishNum in previous chunks if raw is a chunk from read_dlm_chunks(). Defaults to 0.
 
     Returns:
         DataFrame: scaled epochs contain quality bouts
@@ -142,18 +147,21 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
     # However, in analyzeFreeVerticalGrouped2, line epochDex:epochStop(i):epochStop(i+1) incorrectly truncated the beginning of the epoch by 1 and the end by 3. 
 
     
+    tic = start_stage()
     # resliced = epoch_reslice(raw) 
     if frame_rate == 40:
-        resliced = epoch_reslice(raw) # reslice epochs if more than one fish in FOV, generating new epoch numbers
+        resliced = epoch_reslice(raw, fishNum_offset) # reslice epochs if more than one fish in FOV, generating new epoch numbers
     else:
         resliced = raw  # disabled, gen 2 boxes only include fish num == 0
     # Smooth x and y coordinates
     if frame_rate > 100:  # if not data from gen 1 boxes
         resliced['absx'] = smooth_series_ML(resliced.loc[:,'absx'],XY_SM_WSZ)
         resliced['absy'] = smooth_series_ML(resliced.loc[:,'absy'],XY_SM_WSZ)
+    tic = end_stage(tic, 'epoch_reslice', frames=len(resliced))
         
     # truncate epochs
     raw_truncate = raw_filter(resliced.reset_index().rename(columns={'index': 'oriIndex'}),EPOCH_BUF,MIN_DUR)
+    tic = end_stage(tic, 'raw_filter', frames=len(resliced))
 
     raw_truncate.reset_index(inplace=True, drop=True)
 
@@ -170,9 +178,8 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
         deltaT = grp_by_epoch(raw_truncate).time.diff()
     )
     # Get the start time from file name
-    datetime_frmt = '%y%m%d %H.%M.%S'
-    time_stamp = file[-19:-4]
-    start_time = datetime.strptime(time_stamp, datetime_frmt)
+    time_stamp = get_time_stamp(file)
+    start_time = datetime.strptime(time_stamp, DATETIME_FRMT)
     # Calculate absolute datetime for each timepoint. DataFrame calculation is faster than using .apply()
     ana.insert(1,
         'absTime', start_time + pd.to_timedelta(raw_truncate['time'].values, unit=('s'))
@@ -192,8 +199,9 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
     
     # Apply filters
     ana_f = dur_y_x_filter(ana,MAX_DELTA_T)
+    tic = end_stage(tic, 'dur_y_x_filter', frames=len(raw_truncate))
     if ana_f.empty:
-        return "> no usable epoch detected > dlm file skipped", 0
+        return "> no usable epoch detected > dlm file skipped", 0, analyze_dlm_ver
     # %%
     # Calculate displacement, distance traveled, angular velocity, angular acceleration and filter epochs
 
@@ -205,9 +213,8 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
         # use numpy function np.linalg.norm() for displacement and distance
         dist = np.linalg.norm(ana_f_g[['x','y']].diff(), axis=1),
         # since beginning coordinates for each epoch has been set to 0, just use (x, y) values for displ
-        displ = ana_f.groupby('epochNum', as_index=False, sort=False).apply(
-            lambda g: pd.Series((np.linalg.norm(g[['x','y']], axis=1)),index = g.index).diff()
-        ).reset_index(level=0, drop=True),
+        # groupby().diff() also works for files/chunks with only one epoch, where groupby().apply() returns a wide dataframe
+        displ = pd.Series(np.linalg.norm(ana_f[['x','y']], axis=1), index=ana_f.index).groupby(ana_f['epochNum'], sort=False).diff(),
         # array calculation is more time effieient
         angVel = np.divide(ana_f_g['ang'].diff().values, ana_f['deltaT'].values)
     )
@@ -223,6 +230,7 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
 
     # Apply filters, drop previous index
     ana_ff = displ_dist_vel_filter(ana_f,MAX_DIST_TRAVEL).reset_index(drop=True)
+    tic = end_stage(tic, 'displ_dist_vel_filter', frames=len(ana_f))
 
     # Acquire fish length from raw data
     ana_ff['fishLen'] = raw.loc[ana_ff['oriIndex'],'fishLen'].values
@@ -242,6 +250,7 @@ def analyze_dlm_resliced(raw, file_i, file, folder, frame_rate):
     fish_length = grp_by_epoch(res)['fishLen'].agg(
         fishLenEst = lambda l: l.quantile(0.7)
     ).reset_index()
+    end_stage(tic, 'scale', frames=len(res))
 
     # %%
     # Save analyzed data!
@@ -0,0 +1,189 @@
+'''
+Data manifest, which arranges .dlm files into conditions without copying them. Used by the SAMPL_dataARR scripts, the analysis and the visualization loaders
+Functions:
+    1. Record .dlm files of an experiment in <root>/SAMPL data manifest.csv (SAMPL_dataARR scripts). One row per .dlm file: condition, exp, filename, dlm_loc, ini_loc, metadata
+    2. Read the manifest and get the experiment folders <root>/<condition>/<exp> and the .dlm files arranged into each
+    3. Get folders with .dlm files under a root: experiment folders of its manifest if there's one, and folders with .dlm files copied under the root
+
+Experiment folders only hold outputs. .dlm files are read where they are, e.g. in the "<date> HC" folder of the experiment or on an archive volume.
+Results of each .dlm file are saved next to it under dlm results/, so they are reused when the dataset is arranged again.
+If the SAMPL_dataARR scripts linked the files (hardlink/symlink), dlm_loc is the link in the experiment folder and everything is saved there.
+Relative paths in dlm_loc are relative to root.
+A root may hold experiments arranged by the manifest and experiments copied into <root>/<condition>/<exp>, as the arrangement mode is chosen on each run.
+
+NOTE
+hardlinks require the root folder on the same volume as the data. symlinks may require permission on Windows
+'''
+import os
+import pandas as pd
+from preprocessing.read_dlm import get_pack, get_dlm_files, get_dlm_name
+
+DATA_MANIFEST = 'SAMPL data manifest.csv'
+MANIFEST_COLUMNS = ['condition','exp','filename','dlm_loc','ini_loc']
+LINK_MODES = ['hardlink','symlink']
+
+def has_data_manifest(root):
+    """check whether root is arranged by a data manifest
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        bool: True if <root>/SAMPL data manifest.csv exists
+    """
+    return os.path.exists(os.path.join(root, DATA_MANIFEST))
+
+def read_manifest_rows(root):
+    """read <root>/SAMPL data manifest.csv as saved
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        DataFrame: one row per .dlm file. Empty if root has no manifest
+    """
+    manifest_file = os.path.join(root, DATA_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return pd.DataFrame(columns=MANIFEST_COLUMNS)
+    return pd.read_csv(manifest_file, index_col=0, dtype={'condition':str, 'exp':str})
+
+def read_data_manifest(root):
+    """read <root>/SAMPL data manifest.csv for analysis
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        DataFrame: one row per .dlm file, dlm_loc as absolute paths
+    """
+    manifest = read_manifest_rows(root)
+    missing_columns = set(MANIFEST_COLUMNS) - set(manifest.columns)
+    if missing_columns:
+        raise ValueError(f"{DATA_MANIFEST} lacks columns {sorted(missing_columns)}")
+    return manifest.assign(dlm_loc=manifest['dlm_loc'].map(lambda path: os.path.normpath(os.path.join(root, path))))
+
+def get_manifest_folders(root):
+    """get experiment folders arranged by the data manifest and their .dlm files
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        list: (experiment folder, .dlm files sorted by name) of each experiment
+        list: .dlm files in the manifest that do not exist
+    """
+    manifest = read_data_manifest(root)
+    folders = []
+    missing = []
+    for (condition, exp), exp_files in manifest.groupby(['condition', 'exp'], sort=True):
+        filenames = []
+        for file in exp_files['dlm_loc']:
+            if os.path.exists(get_pack(file) or file):
+                filenames.append(file)
+            else:
+                missing.append(file)
+        # from different folders. the pipeline analyzes files in order of names (time stamps)
+        filenames = sorted(get_dlm_files(filenames), key=get_dlm_name)
+        if not filenames:
+            continue
+        folders.append((os.path.join(root, condition, exp), filenames))
+    return folders, missing
+
+def get_dlm_folders(root):
+    """get folders with .dlm files under root, and experiment folders of the data manifest of root if there's one.
+    .dlm files of the manifest found under root (links, or originals kept under root) are only analyzed in their experiments of the manifest
+
+    Args:
+        root (string): directory of behavior data
+
+    Returns:
+        list: (folder, .dlm files sorted by name) of each folder
+        list: .dlm files in the manifest that do not exist
+    """
+    manifest_files = set()
+    folders, missing = [], []
+    if has_data_manifest(root):
+        folders, missing = get_manifest_folders(root)
+        manifest = read_data_manifest(root)
+        manifest_files = set(manifest['dlm_loc'])
+        if 'source_loc' in manifest:
+            # originals of linked files
+            manifest_files |= {os.path.normpath(os.path.join(root, file)) for file in manifest['source_loc'].dropna()}
+    folder_files = dict(folders)
+    for parent_path, _, files in os.walk(root):
+        filenames = get_dlm_files([os.path.join(parent_path, name) for name in sorted(files)])
+        # e.g. copied experiments of a root also arranged by a manifest
+        filenames = [file for file in filenames if os.path.normpath(file) not in manifest_files]
+        if filenames:
+            folder_files[parent_path] = sorted(folder_files.get(parent_path, []) + filenames, key=get_dlm_name)
+    return list(folder_files.items()), missing
+
+def link_file(source, dest, link):
+    """link source to dest. An existing dest is kept
+
+    Args:
+        source (string): file to link
+        dest (string): link
+        link (string): 'hardlink' or 'symlink'
+    """
+    if os.path.lexists(dest):
+        return
+    if link == 'hardlink':
+        os.link(source, dest)
+    elif link == 'symlink':
+        os.symlink(os.path.abspath(source), dest)
+
+def arrange_exp(root, cond_metadata, condition, exp, link=None):
+    """record .dlm files of one experiment in one condition in the manifest. Re-arranging an experiment replaces its rows.
+    <root>/<condition>/<exp> is created with "<exp> metadata.csv", as when files are copied
+
+    Args:
+        root (string): organized folder
+        cond_metadata (DataFrame): rows of "<date> dlm metadata.csv" of the condition, with dlm_loc and ini_loc
+        condition (string): name of the condition folder, e.g. "07_1sibs"
+        exp (string): name of the experiment folder, e.g. date
+        link (string, optional): 'hardlink' or 'symlink' to link .dlm and .ini files into the experiment folder. dlm_loc is then the link and the original is kept as source_loc. Defaults to None.
+
+    Returns:
+        DataFrame: rows of the experiment
+    """
+    exp_dir = os.path.join(root, condition, exp)
+    os.makedirs(exp_dir, exist_ok=True)
+    cond_metadata.to_csv(os.path.join(exp_dir, f"{exp} metadata.csv"))
+    rows = cond_metadata.assign(
+        condition = condition,
+        exp = exp,
+        source_loc = cond_metadata['dlm_loc'],
+    )
+    if link in LINK_MODES:
+        dlm_links = []
+        for index, row in rows.iterrows():
+            dlm_link = os.path.join(exp_dir, os.path.basename(row['dlm_loc']))
+            link_file(row['dlm_loc'], dlm_link, link)
+            if os.path.exists(row['ini_loc']):
+                link_file(row['ini_loc'], os.path.join(exp_dir, os.path.basename(row['ini_loc'])), link)
+            dlm_links.append(dlm_link)
+        rows = rows.assign(dlm_loc = dlm_links)
+    manifest = read_manifest_rows(root)
+    # replace rows of this experiment and condition
+    manifest = manifest.loc[~((manifest['condition'] == condition) & (manifest['exp'] == exp))]
+    manifest = pd.concat([manifest, rows], ignore_index=True)
+    manifest = manifest.sort_values(by=['condition','exp','filename']).reset_index(drop=True)
+    front_columns = MANIFEST_COLUMNS + ['source_loc']
+    manifest = manifest[front_columns + [col for col in manifest.columns if col not in front_columns]]
+    manifest_file = os.path.join(root, DATA_MANIFEST)
+    # replaced in one step, so that an interrupted save leaves the previous manifest
+    manifest.to_csv(manifest_file + '.part')
+    os.replace(manifest_file + '.part', manifest_file)
+    return rows
+
+def get_arrange_mode():
+    """ask how to arrange files
+
+    Returns:
+        string: 'copy', 'manifest', 'hardlink' or 'symlink'
+    """
+    mode = input("- Copy files, or record them in SAMPL data manifest.csv without copying? (copy/manifest/hardlink/symlink): ")
+    while mode not in ['copy', 'manifest'] + LINK_MODES:
+        mode = input("- Please type copy, manifest, hardlink or symlink: ")
+    return mode
@@ -0,0 +1,234 @@
+'''
+Pack .dlm files of a folder into one compact container for archiving, <folder>/<exp_name>.dlmpack
+Functions:
+    1. Store values of each .dlm file column by column in the smallest exact type, compressed with zstd (blosc)
+    2. Store an epoch index, parameters.ini (text and read_ini.parse_ini() output) and size, modification time and hash of each .dlm file
+    3. Verify each packed .dlm file against its parsed text, so that .dlm and .ini files can be moved to cold storage
+
+Container (HDF5):
+    recordings: one row per .dlm file, indexed by .dlm name. key, dlm_size, dlm_mtime, dlm_hash, frames, epochs, dtypes, decimals, ini, parameters, packed_at
+    <key>/raw: values of the .dlm file. Float columns are stored as integers scaled by 10**decimals if exact (.dlm text has 6 decimals), as float32 if exact, or as float64
+    <key>/epoch_index: epochNum, row_start, row_stop, start_time and end_time of each epoch, rows as in <key>/raw
+
+Packed .dlm files are analyzed as <folder>/<exp_name>.dlmpack/<dlm name>.dlm, see read_dlm.get_dlm_files(). Values are the same as parsed from the text.
+Results of .dlm files analyzed before packing are reused, as the size, modification time and hash of the original file are kept.
+.dlm files with non-numeric values or the legacy one-column layout are not packed. New .dlm files of a folder are added to its container.
+.dlm files modified after packing (size or modification time changed) are packed again. Until then, they are read from the .dlm file instead of the container.
+'''
+import os
+import json
+import configparser
+import hashlib
+from datetime import datetime
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from preprocessing.read_dlm import (DLM_COLUMNS, PACK_SUFFIX, PACK_INDEX_KEY, is_dlm, get_dlm_name, get_dlm_files,
+                                    read_pack_index, is_stale_pack, unpack_raw)
+from preprocessing.read_ini import parse_ini, to_parameter_frame
+from bout_analysis.dlm_cache import HASH_BLOCK_SIZE
+
+COMPLIB = 'blosc:zstd'
+COMPLEVEL = 5
+MAX_DECIMALS = 9  # of scaled integers
+PACK_REPORT = 'SAMPL pack report.csv'
+PACK_COLUMNS = ['folder','file','status','reason','dlm_size','frames','epochs','if_ini']
+
+def get_pack_file(folder):
+    """get the container of a folder
+
+    Args:
+        folder (string): root directory
+
+    Returns:
+        string: <folder>/<exp_name>.dlmpack
+    """
+    return os.path.join(folder, os.path.basename(folder) + PACK_SUFFIX)
+
+def pack_column(values):
+    """get the smallest exact type of a column
+
+    Args:
+        values (Series): column of the parsed .dlm text
+
+    Returns:
+        Series: packed values
+        int: decimals of values stored as scaled integers. None otherwise
+    """
+    if values.dtype.kind == 'i':
+        return pd.to_numeric(values, downcast='integer'), None
+    if not values.isna().any():
+        for decimals in range(MAX_DECIMALS + 1):
+            scaled = np.round(values.values * 10**decimals)
+            if np.abs(scaled).max() < 2**63 and np.array_equal(scaled / 10**decimals, values.values):
+                return pd.to_numeric(pd.Series(scaled.astype('int64'), index=values.index), downcast='integer'), decimals
+    if np.array_equal(values.values.astype('float32').astype('float64'), values.values, equal_nan=True):
+        return values.astype('float32'), None
+    return values, None
+
+def get_epoch_index(raw):
+    """get rows and time of each epoch
+
+    Args:
+        raw (DataFrame): parsed .dlm text with DLM_COLUMNS
+
+    Returns:
+        DataFrame: one row per epoch. row_start:row_stop are rows of the epoch
+    """
+    named = raw.set_axis(DLM_COLUMNS, axis=1).reset_index(drop=True).dropna(subset=['epochNum'])
+    grouped = named.groupby('epochNum', sort=False)
+    return pd.DataFrame({
+        'epochNum':grouped['epochNum'].first().values,
+        'row_start':grouped.head(1).index.values,
+        'row_stop':grouped.tail(1).index.values + 1,
+        'start_time':grouped['time'].first().values,
+        'end_time':grouped['time'].last().values,
+    })
+
+def get_dlm_hash(file):
+    """md5 hash of a .dlm file, same as dlm_cache.get_dlm_state()
+
+    Args:
+        file (string): .dlm directory
+
+    Returns:
+        string: hex digest
+    """
+    md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def pack_dlm(file, store, key):
+    """pack one .dlm file and verify it against the parsed text
+
+    Args:
+        file (string): .dlm directory, plain or compressed
+        store (HDFStore): container, opened with COMPLIB
+        key (string): key of the .dlm file in the container
+
+    Returns:
+        dict: row of the index of the container
+    """
+    raw = pd.read_csv(file, sep="\t", header=None)
+    if raw.shape[1] != len(DLM_COLUMNS):
+        raise ValueError(f"{raw.shape[1]} columns, expected {len(DLM_COLUMNS)}")
+    if not all(dtype.kind in 'if' for dtype in raw.dtypes):
+        raise ValueError("non-numeric values")
+    packed, decimals = {}, {}
+    for column in raw:
+        packed[column], column_decimals = pack_column(raw[column])
+        if column_decimals is not None:
+            decimals[str(column)] = column_decimals
+    epoch_index = get_epoch_index(raw)
+    ini_file = os.path.join(os.path.dirname(file), get_dlm_name(file) + " parameters.ini")
+    ini, parameters = '', ''
+    if os.path.exists(ini_file):
+        with open(ini_file) as f:
+            ini = f.read()
+        try:
+            parameters = to_parameter_frame([parse_ini(ini_file)]).iloc[0].to_json()
+        except (configparser.Error, ValueError):
+            # kept as text
+            pass
+    info = {
+        'key':key,
+        'dlm_size':os.path.getsize(file),
+        'dlm_mtime':os.path.getmtime(file),
+        'dlm_hash':get_dlm_hash(file),
+        'frames':len(raw),
+        'epochs':len(epoch_index),
+        'dtypes':json.dumps({str(column):str(dtype) for column, dtype in raw.dtypes.items()}),
+        'decimals':json.dumps(decimals),
+        'ini':ini,
+        'parameters':parameters,
+        'source':os.path.basename(file),
+        'packed_at':datetime.now().isoformat(),
+    }
+    store.put(f"{key}/raw", pd.DataFrame(packed), format='fixed')
+    store.put(f"{key}/epoch_index", epoch_index, format='fixed')
+    # read back from the container
+    unpacked = unpack_raw(store.select(f"{key}/raw"), pd.Series(info))
+    pd.testing.assert_frame_equal(unpacked, raw, check_exact=True)
+    return info
+
+def get_new_key(index):
+    """get a key of the container not used by packed .dlm files
+
+    Args:
+        index (DataFrame): index of the container
+
+    Returns:
+        string: e.g. r3
+    """
+    keys = set(index['key']) if 'key' in index else set()
+    i = len(index)
+    while f"r{i}" in keys:
+        i += 1
+    return f"r{i}"
+
+def pack_folder(folder):
+    """pack .dlm files of a folder not yet in its container, and pack again .dlm files modified after packing
+
+    Args:
+        folder (string): root directory
+
+    Returns:
+        DataFrame: one row per .dlm file, see PACK_COLUMNS
+    """
+    pack_file = get_pack_file(folder)
+    index = read_pack_index(pack_file) if os.path.exists(pack_file) else pd.DataFrame()
+    filenames = get_dlm_files([entry.path for entry in os.scandir(folder) if is_dlm(entry.name)])
+    report = []
+    with pd.HDFStore(pack_file, mode='a', complevel=COMPLEVEL, complib=COMPLIB) as store:
+        for file in filenames:
+            name = get_dlm_name(file) + '.dlm'
+            row = {'folder':folder, 'file':file, 'status':'packed', 'reason':'', 'dlm_size':os.path.getsize(file)}
+            if name in index.index:
+                if not is_stale_pack(index.loc[name], file):
+                    report.append({**row, 'status':'skipped', 'reason':'packed before'})
+                    continue
+                # modified after packing
+                key = index.loc[name, 'key']
+                row['reason'] = 'modified after packing'
+                index = index.drop(index=name)
+                store.remove(key)
+                store.put(PACK_INDEX_KEY, index, format='fixed')
+            else:
+                key = get_new_key(index)
+            try:
+                info = pack_dlm(file, store, key)
+            except (ValueError, TypeError, AssertionError) as error:
+                if f"/{key}" in store:
+                    store.remove(key)
+                report.append({**row, 'status':'failed', 'reason':str(error).split('\n')[0]})
+                continue
+            index = pd.concat([index, pd.DataFrame(info, index=[name])])
+            # saved after each file, so that an interrupted run keeps packed files
+            store.put(PACK_INDEX_KEY, index, format='fixed')
+            report.append({**row, 'frames':info['frames'], 'epochs':info['epochs'], 'if_ini':bool(info['ini'])})
+    if index.empty:
+        os.remove(pack_file)
+    return pd.DataFrame(report, columns=PACK_COLUMNS)
+
+def pack_root(root, report_dir=None, if_multiprocessing=True):
+    """pack .dlm files of all folders under root and save SAMPL pack report.csv. .dlm and .ini files are not removed
+
+    Args:
+        root (string): directory of behavior data
+        report_dir (string, optional): folder to save the report. Defaults to None (root).
+        if_multiprocessing (bool, optional): whether to pack folders in parallel. Defaults to True.
+
+    Returns:
+        DataFrame: pack report
+    """
+    folders = [parent_path for parent_path, _, files in os.walk(root) if any(is_dlm(name) for name in files)]
+    if if_multiprocessing and len(folders) > 1:
+        with Pool() as pool:
+            reports = pool.map(pack_folder, folders)
+    else:
+        reports = [pack_folder(folder) for folder in folders]
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=PACK_COLUMNS)
+    report.to_csv(os.path.join(report_dir or root, PACK_REPORT))
+    return report
@@ -4,28 +4,301 @@ Modified from:
 analyzeFreeVerticalGrouped2.m by DEE 1.30.2015
     "the LabView code returns a value to mark an "epoch," which is a continuous series of frames that had at least one identified particle 
 + lines to output head location in addition to body, for detection direction of movement." 
+
+.dlm files may be archived compressed as .dlm.gz, .dlm.xz or .dlm.zst (requires zstandard). They are decompressed as a stream while parsed, without a temporary file.
+.dlm files packed into <folder>/<exp_name>.dlmpack (see pack_dlm.py) are read as <folder>/<exp_name>.dlmpack/<dlm name>.dlm, with the same values as parsed from the text.
+.dlm files being recorded are read line by line as they grow by read_dlm_tail() or read_dlm_growing(), see bout_analysis/stream_bouts.py.
 '''
 
+import os
+import io
+import json
+import time
+import zlib
+import lzma
+import functools
+import threading
 import pandas as pd
 import numpy as np
 # from scipy.signal import savgol_filter
+try:
+    import zstandard
+except ImportError:  # optional, for .dlm.zst
+    zstandard = None
+from preprocessing.read_ini import get_ini_file
+
+
+DLM_COLUMNS = ['time','fishNum','ang','absx','absy','absHeadx','absHeady','col7','epochNum','fishLen']
+CHUNK_ROWS = 2000000  # default number of rows to read at a time in read_dlm_chunks(), ~3.3 hours at 166 Hz
+DLM_SUFFIXES = ['.dlm', '.dlm.gz', '.dlm.xz', '.dlm.zst']  # plain files first, see get_dlm_files()
+TIME_STAMP_LEN = 15  # yymmdd HH.MM.SS at the end of .dlm names
+PACK_SUFFIX = '.dlmpack'  # container of packed .dlm files of a folder, see pack_dlm.py
+PACK_INDEX_KEY = 'recordings'
+FISHNUM_ROWS = 10000  # rows of a .dlm file being recorded read before deciding that fish num starts from 1 (gen2 program), see read_dlm_tail()
+# hdf5 files are not thread safe, even different files. Held by every read of a pack, and by the writer thread of bout_analysis/prefetch.py
+HDF5_LOCK = threading.RLock()
+
+def is_dlm(filename):
+    """check whether a file is a .dlm file, plain or compressed
+
+    Args:
+        filename (string): file name or directory
+
+    Returns:
+        bool: 
+    """
+    return filename.endswith(tuple(DLM_SUFFIXES))
+
+def get_dlm_name(filename):
+    """get the name of a .dlm file without the .dlm or compressed suffix
+
+    Args:
+        filename (string): file name or directory of the .dlm file
+
+    Returns:
+        string: e.g. F1 230101 14.00.00
+    """
+    name = os.path.basename(filename)
+    for suffix in sorted(DLM_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def get_time_stamp(filename):
+    """get the start time stamp in the name of a .dlm file, plain or compressed
+
+    Args:
+        filename (string): file name or directory of the .dlm file
+
+    Returns:
+        string: yymmdd HH.MM.SS, see analyze_dlm_v5.DATETIME_FRMT
+    """
+    return get_dlm_name(filename)[-TIME_STAMP_LEN:]
+
+def get_pack(filename):
+    """get the container of a packed .dlm file
+
+    Args:
+        filename (string): directory of the .dlm file
+
+    Returns:
+        string: directory of the .dlmpack file. None if the .dlm file is not packed
+    """
+    pack = os.path.dirname(filename)
+    return pack if pack.endswith(PACK_SUFFIX) else None
+
+def get_dlm_folder(filename):
+    """get the folder of a .dlm file, packed or not
+
+    Args:
+        filename (string): directory of the .dlm file
+
+    Returns:
+        string: folder directory
+    """
+    pack = get_pack(filename)
+    return os.path.dirname(pack) if pack else os.path.dirname(filename)
+
+@functools.lru_cache(maxsize=64)
+def _read_pack_index(pack, mtime):
+    with HDF5_LOCK:
+        return pd.read_hdf(pack, PACK_INDEX_KEY)
+
+def read_pack_index(pack):
+    """read the index of packed .dlm files. Cached until the container is modified
+
+    Args:
+        pack (string): directory of the .dlmpack file
+
+    Returns:
+        DataFrame: one row per .dlm file, indexed by .dlm name. see pack_dlm.py
+    """
+    return _read_pack_index(pack, os.path.getmtime(pack))
+
+def get_packed_info(filename):
+    """get the row of a packed .dlm file in the index of its container
+
+    Args:
+        filename (string): directory of the packed .dlm file
+
+    Returns:
+        Series: key, dlm_size, dlm_mtime, dlm_hash, frames, epochs, dtypes, decimals, ini, parameters, etc.
+    """
+    return read_pack_index(get_pack(filename)).loc[os.path.basename(filename)]
+
+def get_dlm_size(filename):
+    """get the size of a .dlm file. For packed .dlm files, the size of the original text, so that sizes predict analysis time the same way
+
+    Args:
+        filename (string): directory of the .dlm file
+
+    Returns:
+        int: bytes
+    """
+    if get_pack(filename):
+        return int(get_packed_info(filename)['dlm_size'])
+    return os.path.getsize(filename)
+
+def get_source_rank(filename):
+    """rank of the source of a .dlm file, for recordings saved more than once. Packed files are verified when packed and fastest to read
+
+    Args:
+        filename (string): directory of the .dlm file
+
+    Returns:
+        int: 0 if packed, then plain and compressed files in the order of DLM_SUFFIXES
+    """
+    if get_pack(filename):
+        return 0
+    return 1 + next(i for i, suffix in enumerate(DLM_SUFFIXES) if filename.endswith(suffix))
+
+def is_stale_pack(info, filename):
+    """check whether a .dlm file was modified after it was packed, so that the packed values are out of date
+
+    Args:
+        info (Series): output of get_packed_info()
+        filename (string): directory of a plain or compressed .dlm file of the same recording
+
+    Returns:
+        bool: True if filename is the file that was packed, and its size or modification time changed since
+    """
+    return (os.path.basename(filename) == info.get('source', os.path.basename(filename))
+            and (os.path.getsize(filename) != info['dlm_size'] or os.path.getmtime(filename) != info['dlm_mtime']))
+
+def get_dlm_files(filenames):
+    """select .dlm files, one per recording. .dlmpack files are expanded to the .dlm files packed in them.
+    If a recording is saved more than once, it is read from the pack, the plain file or the compressed file, in this order.
+    A pack is skipped if the file that was packed is modified after packing, see is_stale_pack()
+
+    Args:
+        filenames (list): file names or directories
+
+    Returns:
+        list: .dlm files, sorted by name
+    """
+    recordings = {}
+    for filename in filenames:
+        if filename.endswith(PACK_SUFFIX):
+            saved = [os.path.join(filename, name) for name in read_pack_index(filename).index]
+        else:
+            saved = [filename] if is_dlm(filename) else []
+        for recording in saved:
+            recordings.setdefault(os.path.join(get_dlm_folder(recording), get_dlm_name(recording)), []).append(recording)
+    dlm_files = []
+    for saved in recordings.values():
+        files = [recording for recording in saved if not get_pack(recording)]
+        current = [recording for recording in saved if not get_pack(recording) or not any(is_stale_pack(get_packed_info(recording), file) for file in files)]
+        dlm_files.append(min(current, key=get_source_rank))
+    return sorted(dlm_files, key=lambda filename: (get_dlm_folder(filename), get_dlm_name(filename)))
+
+def unpack_raw(packed, info):
+    """restore values of a .dlm file from packed columns
+
+    Args:
+        packed (DataFrame): rows of <key>/raw in the container
+        info (Series): output of get_packed_info()
+
+    Returns:
+        DataFrame: values and types as parsed from the .dlm text
+    """
+    for column, decimals in json.loads(info['decimals']).items():
+        packed[int(column)] = packed[int(column)] / 10**decimals
+    return packed.astype({int(column):dtype for column, dtype in json.loads(info['dtypes']).items()})
+
+def read_packed(filename, start=None, stop=None):
+    """read rows of a packed .dlm file
+
+    Args:
+        filename (string): directory of the packed .dlm file
+        start (int, optional): first row. Defaults to None (first row of the file).
+        stop (int, optional): row after the last row. Defaults to None (last row of the file).
+
+    Returns:
+        DataFrame: same as pd.read_csv() of the .dlm text, row indices start from start
+    """
+    info = get_packed_info(filename)
+    with HDF5_LOCK:
+        packed = pd.read_hdf(get_pack(filename), f"{info['key']}/raw", start=start, stop=stop)
+    return unpack_raw(packed, info)
+
+def iter_packed(filename, chunk_rows):
+    """read a packed .dlm file in chunks, like pd.read_csv(chunksize=chunk_rows)
+
+    Args:
+        filename (string): directory of the packed .dlm file
+        chunk_rows (int): number of rows of each chunk
+
+    Yields:
+        DataFrame: rows of the chunk
+    """
+    frames = int(get_packed_info(filename)['frames'])
+    for start in range(0, frames, chunk_rows):
+        yield read_packed(filename, start, min(start + chunk_rows, frames))
+
+def read_packed_parameters(filename):
+    """read parameters of a packed .dlm file, saved from its parameters.ini when packed
+
+    Args:
+        filename (string): directory of the packed .dlm file
+
+    Returns:
+        DataFrame: same as read_ini.to_parameter_frame() of read_ini.parse_ini(). None if the .dlm file had no parameters.ini
+    """
+    parameters = get_packed_info(filename)['parameters']
+    if not parameters:
+        return None
+    return pd.DataFrame(json.loads(parameters), index=[0])
+
+def get_decompressor(filename):
+    """get a decompressor of a compressed .dlm file
+
+    Args:
+        filename (string): directory of the .dlm file
+
+    Returns:
+        object with decompress(bytes), None if the file is not compressed
+    """
+    if filename.endswith('.gz'):
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if filename.endswith('.xz'):
+        return lzma.LZMADecompressor()
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError(f"zstandard is required to read {filename}")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+def iter_dlm_bytes(filename, block_bytes):
+    """read a .dlm file as a stream of decompressed bytes, for sampling rows without parsing the file
+
+    Args:
+        filename (string): directory of the .dlm file
+        block_bytes (int): bytes of the file to read at a time
 
+    Yields:
+        bytes: decompressed data
+        int: bytes of the file read
+    """
+    decompressor = get_decompressor(filename)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_bytes), b''):
+            yield (block if decompressor is None else decompressor.decompress(block)), len(block)
 
 def read_dlm(i, filename):
     """Read .dlm files into a DataFrame
 
     Args:
         i (int): index of the file in the folder
-        filename (string): directory of the .dlm file
+        filename (string): directory of the .dlm file, plain, compressed (decompressed by pandas, inferred from the suffix) or packed
 
     Returns:
         DataFrame: 
     """
     # read_dlm takes file index: i, and the file name end with .dlm
-    col_names = ['time','fishNum','ang','absx','absy','absHeadx','absHeady','col7','epochNum','fishLen']
+    col_names = DLM_COLUMNS
     try:
         # raw = pd.read_csv(filename, sep="\t",names = col_names) # load .dlm
-        raw = pd.read_csv(filename, sep="\t",header=None)
+        raw = read_packed(filename) if get_pack(filename) else pd.read_csv(filename, sep="\t",header=None)
     except FileNotFoundError:
         pass
         # print(f"No .dlm file found in the directory entered")
@@ -48,6 +321,17 @@ def read_dlm(i, filename):
         
     # Clear original time data stored in the first row
     raw.loc[0,'time'] = 0
+    return clean_dlm(raw)
+
+def clean_dlm(raw):
+    """drop rows with NA and convert data to float
+
+    Args:
+        raw (DataFrame): .dlm data with column names
+
+    Returns:
+        DataFrame: 
+    """
     # data error results in NA values in epochNum, exclude rows with NA
     raw.dropna(inplace=True)
     # rows with epochNum == NA may have non-numeric data recorded. In this case, change column types to float for calculation. not necessary for most .dlm.
@@ -58,3 +342,140 @@ def read_dlm(i, filename):
     # raw['ang'] = savgol_filter(raw['ang'], 5, 3)
 
     return raw
+
+def read_dlm_chunks(i, filename, chunk_rows=CHUNK_ROWS):
+    """Read .dlm files in chunks. Each chunk contains complete epochs, so that epochs can be analyzed chunk by chunk.
+    Row indices continue across chunks and are the same as the indices returned by read_dlm()
+
+    Args:
+        i (int): index of the file in the folder
+        filename (string): directory of the .dlm file, plain, compressed or packed
+        chunk_rows (int, optional): number of rows to read at a time. Chunks are longer if an epoch is longer than chunk_rows. Defaults to CHUNK_ROWS.
+
+    Yields:
+        DataFrame: raw data of complete epochs
+    """
+    reader = iter_packed(filename, chunk_rows) if get_pack(filename) else pd.read_csv(filename, sep="\t", header=None, chunksize=chunk_rows)
+    if_fishNum_from1 = None
+    carry = pd.DataFrame()
+    raw = next(reader, None)
+    while raw is not None:
+        next_raw = next(reader, None)  # read ahead to find the last chunk
+        if raw.shape[1] == 1:
+            # legacy V2 program debug code, data only comes in one column. read the whole file
+            reader.close()
+            yield read_dlm(i, filename)
+            return
+        raw.columns = DLM_COLUMNS
+        # decide gen2 program (fish num == 1 for 1 fish detected) using the first chunk instead of the whole file
+        if if_fishNum_from1 is None:
+            if_fishNum_from1 = raw['fishNum'].min() > 0
+            raw.loc[0,'time'] = 0
+        if if_fishNum_from1:
+            raw['fishNum'] = raw['fishNum']-1
+        raw = pd.concat([carry, raw])
+        if next_raw is None:
+            yield clean_dlm(raw)
+            return
+        # keep the last epoch, which may continue in the next chunk. rows with NA epochNum are dropped later
+        epoch_num = pd.to_numeric(raw['epochNum'], errors='coerce')
+        if epoch_num.notna().any():
+            other_epochs = np.flatnonzero((epoch_num.notna() & (epoch_num != epoch_num.dropna().iloc[-1])).values)
+            last_epoch_start = other_epochs[-1]+1 if len(other_epochs) else 0
+        else:
+            last_epoch_start = len(raw)
+        carry = raw.iloc[last_epoch_start:]
+        if last_epoch_start > 0:
+            yield clean_dlm(raw.iloc[:last_epoch_start].copy())
+        raw = next_raw
+
+def new_dlm_tail(filename):
+    """state of reading a .dlm file while it is being recorded, see read_dlm_tail()
+
+    Args:
+        filename (string): directory of the .dlm file, plain
+
+    Returns:
+        dict: bytes read (offset), incomplete last line (tail), rows parsed, whether fish num starts from 1 and rows held until it is decided (pending)
+    """
+    return {'filename':filename, 'offset':0, 'tail':b'', 'n_rows':0, 'if_fishNum_from1':None, 'pending':None}
+
+def read_dlm_tail(dlm_tail, idle_s=300):
+    """Read lines appended to a .dlm file being recorded since the last read, without waiting. Only complete lines are parsed until the recording ends:
+    parameters.ini is saved next to the file, or the file is not modified for idle_s seconds.
+    Row indices continue across reads and are the same as the indices returned by read_dlm()
+
+    read_dlm() subtracts 1 from fish num if it is never 0 in the whole file (gen2 program). Here, fish num starts from 0 once a row with fish num 0 is read,
+    and from 1 if there's none in the first FISHNUM_ROWS rows or in the whole file if it is shorter. Rows are held until then, so the first rows may be returned later
+
+    Args:
+        dlm_tail (dict): output of new_dlm_tail(). Updated in place
+        idle_s (float, optional): seconds without modification after which a .dlm file without parameters.ini is closed. Defaults to 300.
+
+    Returns:
+        DataFrame: raw data of new rows, None if there's no new complete line. Epochs may continue in the next read
+        bool: True if the recording ended and the whole file is read
+    """
+    filename = dlm_tail['filename']
+    # checked before reading, so lines appended before the recording ends are read
+    if_closed = os.path.exists(get_ini_file(filename)) or time.time() - os.path.getmtime(filename) >= idle_s
+    with open(filename, 'rb') as f:
+        f.seek(dlm_tail['offset'])
+        block = f.read()
+    dlm_tail['offset'] += len(block)
+    if if_closed:
+        # the last line may not end with a line break
+        lines, dlm_tail['tail'] = dlm_tail['tail'] + block, b''
+    else:
+        lines, _, dlm_tail['tail'] = (dlm_tail['tail'] + block).rpartition(b'\n')
+    raw = dlm_tail['pending']
+    dlm_tail['pending'] = None
+    if lines.strip():
+        new_raw = pd.read_csv(io.BytesIO(lines), sep="\t", header=None)
+        if new_raw.shape[1] != len(DLM_COLUMNS):
+            raise ValueError(f"{filename} has {new_raw.shape[1]} columns instead of {len(DLM_COLUMNS)}. Legacy one-column .dlm files can't be read while recorded")
+        new_raw.columns = DLM_COLUMNS
+        new_raw.index = pd.RangeIndex(dlm_tail['n_rows'], dlm_tail['n_rows'] + len(new_raw))
+        if dlm_tail['n_rows'] == 0:
+            new_raw.loc[0,'time'] = 0
+        dlm_tail['n_rows'] += len(new_raw)
+        raw = new_raw if raw is None else pd.concat([raw, new_raw])
+    if raw is None:
+        return None, if_closed
+    if dlm_tail['if_fishNum_from1'] is None:
+        if (pd.to_numeric(raw['fishNum'], errors='coerce') <= 0).any():
+            dlm_tail['if_fishNum_from1'] = False
+        elif len(raw) >= FISHNUM_ROWS or if_closed:
+            dlm_tail['if_fishNum_from1'] = True
+        else:
+            dlm_tail['pending'] = raw
+            return None, if_closed
+    if dlm_tail['if_fishNum_from1']:
+        raw['fishNum'] = raw['fishNum']-1
+    return clean_dlm(raw), if_closed
+
+def read_dlm_growing(i, filename, poll_s=1, idle_s=300):
+    """Read a .dlm file while it is being recorded. New rows are yielded as complete lines are appended, until the recording ends, see read_dlm_tail().
+    Compressed and packed files are closed, read by read_dlm_chunks()
+
+    Args:
+        i (int): index of the file in the folder
+        filename (string): directory of the .dlm file
+        poll_s (float, optional): seconds between checks for new lines. Defaults to 1.
+        idle_s (float, optional): seconds without modification after which a .dlm file without parameters.ini is closed. Defaults to 300.
+
+    Yields:
+        DataFrame: raw data of new rows. Epochs may continue in the next DataFrame
+    """
+    if get_pack(filename) or get_decompressor(filename) is not None:
+        yield from read_dlm_chunks(i, filename)
+        return
+    dlm_tail = new_dlm_tail(filename)
+    while True:
+        raw, if_closed = read_dlm_tail(dlm_tail, idle_s)
+        if raw is not None:
+            yield raw
+        if if_closed:
+            return
+        if raw is None:
+            time.sleep(poll_s)
@@ -0,0 +1,162 @@
+'''
+Read parameters.ini files saved with .dlm files
+Functions:
+    1. Parse the user-defined parameters of one .ini file. Cached by file and modification time, so unchanged files are parsed once per process
+    2. Read many .ini files at once in threads, as each file is a few requests on network volumes, into one typed DataFrame
+    3. Read parameters of .dlm files with their locations and sizes, see grab_fish_angle_v5.read_exp_parameters()
+    4. List .dlm files in subfolders of an experiment folder, for the arrangement scripts in SAMPL_dataARR
+
+The arrangement scripts import this module, see SAMPL_dataARR/arr_HC.py.
+'''
+import os
+import functools
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+INI_SECTION = 'User-defined parameters'
+INI_FIELDS = {  # column: (key in INI_SECTION, dtype)
+    'box_number':('Box number', 'int64'),
+    'genotype':('Genotype', 'object'),
+    'age':('Age', 'int64'),
+    'notes':('Notes', 'object'),
+    'initials':('Inititals', 'object'),
+    'light_cycle':('Light cycle', 'int64'),
+    'dir':('Save data to?', 'object'),
+    'line_1':('Mom line number', 'int64'),
+    'line_2':('Dad line number', 'int64'),
+    'cross_id':('cross ID', 'object'),
+    'num_fish':('Num fish', 'int64'),
+    'filename':('Filename', 'object'),
+}
+INI_DTYPES = {column:dtype for column, (key, dtype) in INI_FIELDS.items()}
+INI_THREADS = 8
+
+def get_ini_file(dlm_file):
+    """get the parameters.ini saved with a .dlm file
+
+    Args:
+        dlm_file (string): .dlm directory
+
+    Returns:
+        string: .ini directory, which may not exist
+    """
+    return dlm_file.split(".dlm")[0] + " parameters.ini"
+
+def parse_ini(ini_file):
+    """parse parameters of one .ini file
+
+    Args:
+        ini_file (string): ini file directory
+
+    Returns:
+        dict: INI_FIELDS
+    """
+    config = configparser.ConfigParser()
+    config.read(ini_file)
+    parameters = {}
+    for column, (key, dtype) in INI_FIELDS.items():
+        if dtype == 'int64':
+            parameters[column] = config.getint(INI_SECTION, key)
+        else:
+            parameters[column] = config.get(INI_SECTION, key).replace('"','')
+    return parameters
+
+@functools.lru_cache(maxsize=2**16)
+def _read_ini(ini_file, mtime):
+    return parse_ini(ini_file)
+
+def read_ini(ini_file):
+    """parse parameters of one .ini file. Cached until the file is modified
+
+    Args:
+        ini_file (string): ini file directory
+
+    Returns:
+        dict: INI_FIELDS. None if the file does not exist
+    """
+    try:
+        mtime = os.path.getmtime(ini_file)
+    except FileNotFoundError:
+        return None
+    # copied, as cached dicts are shared
+    return dict(_read_ini(ini_file, mtime))
+
+def to_parameter_frame(rows, columns=()):
+    """one DataFrame of parameter rows, typed by INI_DTYPES
+
+    Args:
+        rows (list): dicts of INI_FIELDS and other columns
+        columns (list, optional): other columns, after INI_FIELDS. Defaults to ().
+
+    Returns:
+        DataFrame: one row per dict
+    """
+    return pd.DataFrame(rows, columns=list(INI_FIELDS) + list(columns)).astype(INI_DTYPES)
+
+def read_ini_files(ini_files, threads=INI_THREADS, errors='raise'):
+    """read many .ini files in threads
+
+    Args:
+        ini_files (list): ini file directories
+        threads (int, optional): number of files read at a time. Defaults to INI_THREADS.
+        errors (str, optional): 'raise' or 'skip' files that can't be parsed. Defaults to 'raise'.
+
+    Returns:
+        DataFrame: INI_FIELDS and ini_loc, one row per existing .ini file, in the order of ini_files
+    """
+    def read_row(ini_file):
+        try:
+            parameters = read_ini(ini_file)
+        except (configparser.Error, ValueError):
+            if errors == 'raise':
+                raise
+            return None
+        return None if parameters is None else {**parameters, 'ini_loc':ini_file}
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        rows = [row for row in executor.map(read_row, ini_files) if row is not None]
+    return to_parameter_frame(rows, ['ini_loc'])
+
+def read_dlm_parameters(dlm_files, threads=INI_THREADS, if_print_missing=False):
+    """read parameters.ini of .dlm files in threads, with locations and sizes of the .dlm files
+
+    Args:
+        dlm_files (list): .dlm directories. Not packed, see read_dlm.read_packed_parameters()
+        threads (int, optional): number of files read at a time. Defaults to INI_THREADS.
+        if_print_missing (bool, optional): print .dlm files without parameters.ini, which are skipped. Defaults to False.
+
+    Returns:
+        DataFrame: INI_FIELDS, dlm_loc, dlm_size and ini_loc, one row per .dlm file with a parameters.ini, in the order of dlm_files
+    """
+    def read_row(dlm_file):
+        ini_file = get_ini_file(dlm_file)
+        parameters = read_ini(ini_file)
+        if parameters is None:
+            return None
+        return {**parameters, 'dlm_loc':dlm_file, 'dlm_size':os.path.getsize(dlm_file), 'ini_loc':ini_file}
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        rows = list(executor.map(read_row, dlm_files))
+    missing = [dlm_file for dlm_file, row in zip(dlm_files, rows) if row is None]
+    if if_print_missing and missing:
+        print(f"- {len(missing)} .dlm files without parameters.ini skipped")
+        for dlm_file in missing:
+            print(f"  {dlm_file}")
+    return to_parameter_frame([row for row in rows if row is not None], ['dlm_loc', 'dlm_size', 'ini_loc'])
+
+def get_exp_dlm_files(exp):
+    """.dlm files in subfolders of an experiment folder, e.g. box folders of "<6-digit date> HC"
+
+    Args:
+        exp (string): experiment directory
+
+    Returns:
+        list: .dlm directories, sorted within each subfolder. Hidden files (e.g. ._*.dlm saved by macOS) are not included, as with glob
+    """
+    dlm_files = []
+    for path, dir_list, file_list in os.walk(exp):
+        for folder_name in dir_list:
+            folder = os.path.join(path, folder_name)
+            dlm_files.extend(sorted(entry.path for entry in os.scandir(folder) if entry.name.endswith('.dlm') and not entry.name.startswith('.') and entry.is_file()))
+    return dlm_files
@@ -0,0 +1,275 @@
+'''
+Pre-flight scan of .dlm files before analysis
+Functions:
+    1. Classify each .dlm file from its first and last rows and a few sampled blocks, without reading the whole file
+    2. Estimate number of frames, epochs and duration of each file
+    3. Flag files analysis would skip or fail on, and save the scan report in the order files will be analyzed (largest first, see scheduler.py)
+
+Status of each file:
+    ok: no problem found
+    warn: analyzed, but e.g. legacy one-column layout (V2 program), rows with missing values or no parameters.ini (no metadata)
+    likely_skipped: analyzed, but likely skipped by analysis, e.g. only 1 epoch, or no swim faster than PROPULSION_THRESHOLD in sampled blocks
+    unreadable: e.g. empty file, no time stamp in the file name, unknown layout, non-numeric values. Not analyzed when scanned before analysis, see SAMPL_analysis_mp(if_scan=True)
+
+Estimates are from SAMPLE_BLOCKS blocks of BLOCK_BYTES bytes. Epochs between sampled blocks are estimated from epoch numbers of the first and last rows.
+Compressed .dlm files can't be read at random offsets, so they are decompressed as a stream once, keeping evenly spaced blocks and the last block.
+Packed .dlm files (see pack_dlm.py) are verified when packed and read whole, so their estimates are exact.
+Swim speed is the distance traveled over SPEED_WINDOW frames, so it is noisier than swimSpeed of analyze_dlm. A file with fast swims in sampled blocks may still have no aligned bout.
+'''
+import os
+from datetime import datetime
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from preprocessing.read_dlm import (DLM_COLUMNS, get_decompressor, iter_dlm_bytes, get_time_stamp, get_dlm_name,
+                                    get_dlm_folder, get_dlm_size, get_pack, get_packed_info, read_packed)
+from preprocessing.data_manifest import get_dlm_folders
+from preprocessing.analyze_dlm_v5 import SCALE, DATETIME_FRMT
+from bout_analysis.grab_fish_angle_v5 import PROPULSION_THRESHOLD
+from bout_analysis.scheduler import sort_by_size
+
+SAMPLE_BLOCKS = 8  # number of blocks to read, including the first and last block
+BLOCK_BYTES = 2**14  # ~200 rows
+SPEED_WINDOW = 3  # frames
+SCAN_REPORT = 'SAMPL scan report.csv'
+SCAN_COLUMNS = ['order','folder','file','status','reason','dlm_size','layout','est_frames','est_epochs','duration_s',
+                'malformed_rows','sampled_rows','max_speed','if_ini']
+
+def trim_block(block, if_first, if_last):
+    """drop incomplete rows at both ends of a block
+
+    Args:
+        block (bytes): data read from an offset of the file
+        if_first (bool): whether the block starts at the start of the file
+        if_last (bool): whether the block ends at the end of the file
+
+    Returns:
+        bytes: complete rows
+    """
+    if not if_first:
+        block = block[block.find(b'\n')+1:]
+    if not if_last:
+        block = block[:block.rfind(b'\n')+1]
+    return block
+
+def read_blocks(file):
+    """read sampled blocks of complete rows
+
+    Args:
+        file (string): .dlm directory, plain or compressed
+
+    Returns:
+        list: bytes of each block, from the first to the last block of the file
+        int: size of the .dlm data, decompressed if compressed
+    """
+    if get_decompressor(file) is not None:
+        return read_stream_blocks(file)
+    dlm_size = os.path.getsize(file)
+    if dlm_size <= SAMPLE_BLOCKS * BLOCK_BYTES:
+        with open(file, 'rb') as f:
+            return [f.read()], dlm_size
+    blocks = []
+    with open(file, 'rb') as f:
+        for offset in np.linspace(0, dlm_size - BLOCK_BYTES, SAMPLE_BLOCKS).astype(int):
+            f.seek(offset)
+            blocks.append(trim_block(f.read(BLOCK_BYTES), offset == 0, offset + BLOCK_BYTES >= dlm_size))
+    return blocks, dlm_size
+
+def read_stream_blocks(file):
+    """read sampled blocks of complete rows of a compressed .dlm file, decompressed as a stream.
+    Blocks are kept at a stride, which doubles whenever SAMPLE_BLOCKS blocks are kept, so that kept blocks stay evenly spaced without knowing the size beforehand
+
+    Args:
+        file (string): .dlm directory
+
+    Returns:
+        list: bytes of each block, from the first to the last block of the file
+        int: size of the decompressed data
+    """
+    blocks = []
+    stride = 1
+    block_i = 0
+    pending = b''
+    tail = b''
+    data_size = 0
+    for data, _ in iter_dlm_bytes(file, BLOCK_BYTES):
+        data_size += len(data)
+        tail = (tail + data)[-BLOCK_BYTES:]
+        pending += data
+        while len(pending) >= BLOCK_BYTES:
+            if block_i % stride == 0:
+                blocks.append(pending[:BLOCK_BYTES])
+                # one block is left for the last block
+                if len(blocks) >= SAMPLE_BLOCKS:
+                    blocks = blocks[::2]
+                    stride *= 2
+            pending = pending[BLOCK_BYTES:]
+            block_i += 1
+    if stride == 1:
+        # all blocks kept
+        return [b''.join(blocks) + pending], data_size
+    blocks = [trim_block(block, i == 0, False) for i, block in enumerate(blocks)]
+    return blocks + [trim_block(tail, False, True)], data_size
+
+def parse_block(block):
+    """parse rows of a block
+
+    Args:
+        block (bytes): output of read_blocks()
+
+    Returns:
+        list: values of each row, as lists of float. rows with non-numeric values excluded
+        int: number of rows with non-numeric values
+    """
+    rows = []
+    bad_rows = 0
+    for line in block.split(b'\n'):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rows.append([float(value) for value in line.split(b'\t')])
+        except ValueError:
+            bad_rows += 1
+    return rows, bad_rows
+
+def get_max_speed(rows):
+    """max swim speed in a block, from distance traveled over SPEED_WINDOW frames of the same epoch
+
+    Args:
+        rows (ndarray): rows of a block with DLM_COLUMNS
+
+    Returns:
+        float: speed in mm/s. NaN if no epoch is longer than SPEED_WINDOW frames
+    """
+    if len(rows) <= SPEED_WINDOW:
+        return np.nan
+    time, x, y, epoch_num = (rows[:, DLM_COLUMNS.index(column)] for column in ['time','absx','absy','epochNum'])
+    dist = np.hypot(x[SPEED_WINDOW:] - x[:-SPEED_WINDOW], y[SPEED_WINDOW:] - y[:-SPEED_WINDOW]) / SCALE
+    delta_t = time[SPEED_WINDOW:] - time[:-SPEED_WINDOW]
+    same_epoch = (epoch_num[SPEED_WINDOW:] == epoch_num[:-SPEED_WINDOW]) & (delta_t > 0)
+    if not same_epoch.any():
+        return np.nan
+    return np.max(dist[same_epoch] / delta_t[same_epoch])
+
+def scan_dlm(file, frame_rate):
+    """classify a .dlm file and estimate its size, see module docstring
+
+    Args:
+        file (string): .dlm directory
+        frame_rate (int): frame rate
+
+    Returns:
+        dict: one row of the scan report
+    """
+    scan = {
+        'folder':get_dlm_folder(file),
+        'file':file,
+        'dlm_size':get_dlm_size(file),
+        'layout':None,
+        'est_frames':0,
+        'est_epochs':0,
+        'duration_s':np.nan,
+        'malformed_rows':0,
+        'sampled_rows':0,
+        'max_speed':np.nan,
+        'if_ini':bool(get_packed_info(file)['ini']) if get_pack(file) else os.path.exists(os.path.join(os.path.dirname(file), get_dlm_name(file)+" parameters.ini")),
+    }
+    warnings = []
+    try:
+        datetime.strptime(get_time_stamp(file), DATETIME_FRMT)
+    except ValueError:
+        return {**scan, 'status':'unreadable', 'reason':'no time stamp in file name'}
+    if get_pack(file):
+        # verified when packed. all rows are read, which is fast from the container
+        raw = read_packed(file)
+        valid_rows = raw.dropna().to_numpy(dtype=float)
+        scan.update(layout='packed', est_frames=len(raw), sampled_rows=len(raw), malformed_rows=len(raw) - len(valid_rows))
+        rows = [valid_rows] if len(valid_rows) else []
+    else:
+        blocks, data_size = read_blocks(file)
+        parsed = [parse_block(block) for block in blocks]
+        n_fields = {len(row) for block_rows, _ in parsed for row in block_rows}
+        scan['sampled_rows'] = sum(len(block_rows) + bad_rows for block_rows, bad_rows in parsed)
+        if not scan['sampled_rows']:
+            return {**scan, 'status':'unreadable', 'reason':'empty file'}
+        scan['est_frames'] = int(data_size * scan['sampled_rows'] / sum(len(block) for block in blocks))
+        non_numeric_rows = sum(bad_rows for _, bad_rows in parsed)
+        if non_numeric_rows:
+            # columns with text can't be converted to float in read_dlm()
+            return {**scan, 'malformed_rows':non_numeric_rows, 'status':'unreadable', 'reason':f'{non_numeric_rows} rows with non-numeric values in {scan["sampled_rows"]} sampled rows'}
+        if n_fields == {1}:
+            # legacy V2 program, values of all columns in one column. see read_dlm()
+            scan['layout'] = 'one_column'
+            scan['est_frames'] //= len(DLM_COLUMNS)
+            scan['duration_s'] = scan['est_frames'] / frame_rate
+            warnings.append('legacy one-column layout, time assumed to be 160Hz')
+        elif len(DLM_COLUMNS) in n_fields:
+            scan['layout'] = 'tab'
+            # rows with other numbers of columns or NaN are dropped by read_dlm()
+            rows = []
+            for block_rows, _ in parsed:
+                valid_rows = np.array([row for row in block_rows if len(row) == len(DLM_COLUMNS)]).reshape(-1, len(DLM_COLUMNS))
+                valid_rows = valid_rows[~np.isnan(valid_rows).any(axis=1)]
+                scan['malformed_rows'] += len(block_rows) - len(valid_rows)
+                if len(valid_rows):
+                    rows.append(valid_rows)
+        else:
+            return {**scan, 'status':'unreadable', 'reason':f"{'/'.join(str(n) for n in sorted(n_fields))} columns, expected {len(DLM_COLUMNS)}"}
+    if scan['malformed_rows']:
+        warnings.append(f"{scan['malformed_rows']} malformed rows in {scan['sampled_rows']} sampled rows")
+    if not scan['if_ini']:
+        warnings.append('no parameters.ini')
+    if scan['layout'] in ['tab', 'packed']:
+        if not rows:
+            return {**scan, 'status':'unreadable', 'reason':'no valid row in sampled blocks'}
+        epoch_col = DLM_COLUMNS.index('epochNum')
+        sampled_epochs = np.unique(np.concatenate([block_rows[:, epoch_col] for block_rows in rows]))
+        scan['est_epochs'] = int(max(len(sampled_epochs), rows[-1][-1, epoch_col] - rows[0][0, epoch_col] + 1))
+        # time since the start of recording. the first row stores the start time instead, see read_dlm()
+        scan['duration_s'] = rows[-1][-1, DLM_COLUMNS.index('time')]
+        speeds = [get_max_speed(block_rows) for block_rows in rows]
+        scan['max_speed'] = np.nan if np.isnan(speeds).all() else np.nanmax(speeds)
+        if scan['est_epochs'] <= 1:
+            return {**scan, 'status':'likely_skipped', 'reason':'; '.join(['only 1 epoch'] + warnings)}
+        if scan['max_speed'] < PROPULSION_THRESHOLD:
+            return {**scan, 'status':'likely_skipped', 'reason':'; '.join([f'no swim faster than {PROPULSION_THRESHOLD}mm/s in sampled blocks'] + warnings)}
+    return {**scan, 'status':'warn' if warnings else 'ok', 'reason':'; '.join(warnings)}
+
+def scan_files(filenames, frame_rate, if_multiprocessing=True):
+    """scan .dlm files, largest first
+
+    Args:
+        filenames (list): .dlm directories
+        frame_rate (int or list): frame rate, or frame rate of each file
+        if_multiprocessing (bool, optional): whether to scan files in parallel. Defaults to True.
+
+    Returns:
+        DataFrame: scan report, one row per file in the order of analysis
+    """
+    frame_rates = frame_rate if isinstance(frame_rate, list) else [frame_rate] * len(filenames)
+    scan_input = sort_by_size(list(zip(filenames, frame_rates)), lambda task: [task[0]])
+    if if_multiprocessing and len(scan_input) > 1:
+        with Pool() as pool:
+            scans = pool.starmap(scan_dlm, scan_input, chunksize=16)
+    else:
+        scans = [scan_dlm(*task) for task in scan_input]
+    scan = pd.DataFrame(scans)
+    return scan.assign(order=np.arange(len(scan))).reindex(columns=SCAN_COLUMNS)
+
+def scan_root(root, frame_rate, report_dir=None, if_multiprocessing=True):
+    """scan all .dlm files under root, or in SAMPL data manifest.csv of root, and save SAMPL scan report.csv
+
+    Args:
+        root (string): directory of behavior data
+        frame_rate (int): frame rate
+        report_dir (string, optional): folder to save the report. Defaults to None (root).
+        if_multiprocessing (bool, optional): whether to scan files in parallel. Defaults to True.
+
+    Returns:
+        DataFrame: scan report
+    """
+    filenames = [file for _, files in get_dlm_folders(root)[0] for file in files]
+    scan = scan_files(filenames, frame_rate, if_multiprocessing)
+    scan.to_csv(os.path.join(report_dir or root, SCAN_REPORT))
+    return scan
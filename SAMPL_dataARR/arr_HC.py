@@ -14,6 +14,7 @@ How:
 What does it need from you:
     It asks for root directory containing "HC_organized *" (and "<6-digit date> HC", if there's new data to be organized)
     After detecting new data, it asks if you want to transfer the data or not
+    Then it asks whether to copy files or record them in "SAMPL data manifest.csv" without copying (optionally linked), see SAMPL_analysis_multiprocessing/preprocessing/data_manifest.py
     If new data has been copied, please remember to move the original "<6-digit date> HC" folders into the "HC_archive" folder (or somewhere else)
 
 NOTE
@@ -22,46 +23,19 @@ condition folders are hardcoded
 
 # %%
 import os,glob
-import configparser
+import sys
 import pandas as pd
-import shutil
+# the data manifest format and .ini reading are shared with the analysis pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'SAMPL_analysis_multiprocessing'))
+from preprocessing.data_manifest import DATA_MANIFEST, arrange_exp, get_arrange_mode
+from preprocessing.read_ini import read_dlm_parameters, get_exp_dlm_files
+from copy_files import copy_files
 # import time
 from tqdm import tqdm
 import re
 # def main(root,frame_rate):
     # for progress bar and time estimation (2022.0126 update)
 # %%
-def read_parameters(ini_file):
-    config = configparser.ConfigParser()
-    config.read(ini_file)
-    box_number = config.getround_half_up('User-defined parameters','Box number')
-    genotype = config.get('User-defined parameters','Genotype').replace('"','')
-    age = config.getround_half_up('User-defined parameters','Age')
-    notes = config.get('User-defined parameters','Notes').replace('"','')
-    initials = config.get('User-defined parameters','Inititals').replace('"','')
-    light_cycle = config.getround_half_up('User-defined parameters','Light cycle')
-    dir = config.get('User-defined parameters','Save data to?').replace('"','')
-    line_1 = config.getround_half_up('User-defined parameters','Mom line number')
-    line_2 = config.getround_half_up('User-defined parameters','Dad line number')
-    cross_id = config.get('User-defined parameters','cross ID').replace('"','')
-    num_fish = config.getround_half_up('User-defined parameters','Num fish')
-    filename = config.get('User-defined parameters','Filename').replace('"','')
-    parameters = pd.DataFrame({
-        'box_number':box_number,
-        'genotype':genotype,
-        'age':age,
-        'notes':notes,
-        'initials':initials,
-        'light_cycle':light_cycle,
-        'dir':dir,
-        'line_1':line_1,
-        'line_2':line_2,
-        'cross_id':cross_id,
-        'num_fish':num_fish,
-        'filename':filename,
-    }, index=[0])
-    return parameters
-
 def get_cond_data(df,cond_keys):
     '''
     filter df and get rows matching cond
@@ -109,21 +83,8 @@ def main(root):
             exp_name = os.path.basename(exp)
             date = exp_name[0:6]
             # concatenate all parameter files from one experiment, then arrange data
-            exp_parameters = pd.DataFrame()
-            all_folders = os.walk(exp)
-            for path, dir_list, file_list in all_folders:  
-                for folder_name in dir_list:
-                    folder = os.path.join(path, folder_name)        
-                    dlm_files = glob.glob(f"{folder}/*.dlm")
-                    par_files = [name.split(".dlm")[0]+" parameters.ini" for name in dlm_files]
-                    for i, this_par_file in enumerate(par_files):
-                        this_par = read_parameters(this_par_file)
-                        this_par = this_par.assign(
-                            dlm_loc = dlm_files[i],
-                            dlm_size = os.path.getsize(dlm_files[i]),
-                            ini_loc = this_par_file,
-                        )
-                        exp_parameters = pd.concat([exp_parameters, this_par],ignore_index=True)
+            # .ini files of all box folders read in threads, see preprocessing/read_ini.py
+            exp_parameters = read_dlm_parameters(get_exp_dlm_files(exp), if_print_missing=True)
             # save parameter df
             exp_parameters.to_csv(f"{exp}/{date} dlm metadata.csv")
 
@@ -132,6 +93,8 @@ def main(root):
         confirm = input("- Move files? (y/n): ")
         while confirm != 'n':
             if confirm == 'y':
+                mode = get_arrange_mode()
+                copy_list = [] # (source, dest) of files to copy
                 # copy and paste files
                 for exp in new_exp_folders:
                     # get date
@@ -150,17 +113,25 @@ def main(root):
                         # loop through conditions, get metadata filtered
                         this_cond_metadata = get_cond_data(exp_metadata,i)
                         dest_dir = this_path4conditions[i]
+                        if mode != 'copy':
+                            # record in SAMPL data manifest.csv instead of copying
+                            arrange_exp(root_organized[0], this_cond_metadata, CONDITIONS[i], date, link=mode)
+                            continue
                         for index, row in this_cond_metadata.iterrows():
                             # for the files matching current condition, move dlm
                             tmp_dest_file = os.path.join(dest_dir,f"{row['filename']}.dlm")
-                            shutil.copyfile(row['dlm_loc'],tmp_dest_file)
-                            dest_ini = os.path.join(path,str(row['fish_id']),f"{row['filename']} parameters.ini")
-                            shutil.copyfile(row['ini_loc'],dest_ini)
+                            copy_list.append((row['dlm_loc'],tmp_dest_file))
+                            dest_ini = os.path.join(dest_dir,f"{row['filename']} parameters.ini")
+                            copy_list.append((row['ini_loc'],dest_ini))
                             # save metadata
                             tmp_dest_file = os.path.join(dest_dir,f"{date} metadata.csv")
                             this_cond_metadata.to_csv(tmp_dest_file)
                         
-                print("new data organized. please archive ori data files!")
+                if mode == 'copy':
+                    copy_files(copy_list, report_dir=root_organized[0])
+                    print("new data organized. please archive ori data files!")
+                else:
+                    print(f"new data arranged in {DATA_MANIFEST}. please keep ori data files where they are!")
                 break
             else:
                 confirm = input("- Proceed? (y/n): ")
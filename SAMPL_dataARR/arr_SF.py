@@ -14,6 +14,7 @@ How:
 What does it need from you:
     It asks for root directory containing "HC_organized *" (and "<6-digit date> HC", if there's new data to be organized)
     After detecting new data, it asks if you want to transfer the data or not
+    Then it asks whether to copy files or record them in "SAMPL data manifest.csv" without copying (optionally linked), see SAMPL_analysis_multiprocessing/preprocessing/data_manifest.py
     If new data has been copied, please remember to move the original "<6-digit date> HC" folders into the "HC_archive" folder (or somewhere else)
 
 NOTE
@@ -26,43 +27,15 @@ add option to arrange DD data
 
 # %%
 import os,glob
-import configparser
+import sys
 import pandas as pd
-import shutil
+# the data manifest format and .ini reading are shared with the analysis pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'SAMPL_analysis_multiprocessing'))
+from preprocessing.data_manifest import DATA_MANIFEST, arrange_exp, get_arrange_mode
+from preprocessing.read_ini import read_dlm_parameters
+from copy_files import copy_files, get_folder_sizes
 
 
-# %%
-def read_parameters(ini_file):
-    config = configparser.ConfigParser()
-    config.read(ini_file)
-    box_number = config.getround_half_up('User-defined parameters','Box number')
-    genotype = config.get('User-defined parameters','Genotype').replace('"','')
-    age = config.getround_half_up('User-defined parameters','Age')
-    notes = config.get('User-defined parameters','Notes').replace('"','')
-    initials = config.get('User-defined parameters','Inititals').replace('"','') # "Inititals" misspelled in .ini
-    light_cycle = config.getround_half_up('User-defined parameters','Light cycle')
-    dir = config.get('User-defined parameters','Save data to?').replace('"','')
-    line_1 = config.getround_half_up('User-defined parameters','Mom line number')
-    line_2 = config.getround_half_up('User-defined parameters','Dad line number')
-    cross_id = config.get('User-defined parameters','cross ID').replace('"','')
-    num_fish = config.getround_half_up('User-defined parameters','Num fish')
-    filename = config.get('User-defined parameters','Filename').replace('"','')
-    parameters = pd.DataFrame({
-        'box_number':box_number,
-        'genotype':genotype,
-        'age':age,
-        'notes':notes,
-        'initials':initials,
-        'light_cycle':light_cycle,
-        'dir':dir,
-        'line_1':line_1,
-        'line_2':line_2,
-        'cross_id':cross_id,
-        'num_fish':num_fish,
-        'filename':filename,
-    }, index=[0])
-    return parameters
-
 # %%
 def main(root):
     root_unquantified = glob.glob(f"{root}/* unquantified")
@@ -94,6 +67,11 @@ def main(root):
             all_folders = os.walk(exp) 
             # go through every box folder within one exp folder 
             for path, dir_list, file_list in all_folders:  
+                # box folders at once, as each file is a request on network volumes
+                box_folders = [os.path.join(path, folder_name) for folder_name in dir_list]
+                folder_sizes = get_folder_sizes(box_folders)
+                # .ini files of all box folders read in threads, see preprocessing/read_ini.py
+                path_parameters = read_dlm_parameters([dlm_file for folder in box_folders for dlm_file in glob.glob(f"{folder}/*.dlm")], if_print_missing=True)
                 for folder_name in dir_list:
                     old_folder = os.path.join(path, folder_name) 
                     if 'ctrl' in folder_name:
@@ -102,26 +80,14 @@ def main(root):
                         fish_id = round_half_up(date)*100
                     else:
                         fish_id = round_half_up(date)*100+round_half_up(folder_name) # unless is sibs
-                    size = 0
-                    for ele in os.scandir(old_folder):
-                        size += os.path.getsize(ele)
+                    size = folder_sizes[old_folder]
                         
                     # get metadata
-                    dlm_files = glob.glob(f"{old_folder}/*.dlm")
-                    par_files = [name.split(".dlm")[0]+" parameters.ini" for name in dlm_files]
-                    exp_parameters = pd.DataFrame()
-                    for i, this_par_file in enumerate(par_files):
-                        this_par = read_parameters(this_par_file)
-                        this_par = this_par.assign(
-                            dlm_loc = dlm_files[i],
-                            ini_loc = this_par_file,
-                            fish_id = fish_id,
-                            dlm_size = os.path.getsize(dlm_files[i]),
-
-                        )
-                        if this_par.loc[0,'genotype'] != 'tau':
-                            this_par['fish_id'] = round_half_up(date)*100  # sibs are numbered 00 
-                        exp_parameters = pd.concat([exp_parameters, this_par],ignore_index=True)
+                    exp_parameters = path_parameters.loc[path_parameters['dlm_loc'].map(os.path.dirname) == old_folder].reset_index(drop=True)
+                    exp_parameters = exp_parameters.assign(
+                        fish_id = fish_id,
+                    )
+                    exp_parameters.loc[exp_parameters['genotype'] != 'tau', 'fish_id'] = round_half_up(date)*100  # sibs are numbered 00 
                         
                     all_exp_parameters = pd.concat([all_exp_parameters, exp_parameters],ignore_index=True)
                     # modify this_box_parameters to combine parameters and get one row per box
@@ -141,6 +107,8 @@ def main(root):
         confirm = input("- Move files? (y/n): ")
         while confirm != 'n':
             if confirm == 'y':
+                mode = get_arrange_mode()
+                copy_list = [] # (source, dest) of files to copy
                 # copy and paste files
                 for exp in new_exp_folders:
                     exp_name = os.path.basename(exp)
@@ -163,6 +131,12 @@ def main(root):
                         this_fish_dlm_metadata = exp_metadata.loc[exp_metadata['box_number']==fish['box_number']]
                         this_fish_dlm_metadata.to_csv(os.path.join(this_fish_path,f"{fish['fish_id']}dlm metadata.csv"))
                     
+                    if mode != 'copy':
+                        # record in SAMPL data manifest.csv instead of copying. one exp folder per fish
+                        for index, fish in metadata_by_fish.iterrows():
+                            this_fish_dlm_metadata = exp_metadata.loc[exp_metadata['box_number']==fish['box_number']]
+                            arrange_exp(root_quantified[0], this_fish_dlm_metadata, tau if fish['genotype'] == 'tau' else sibs, str(fish['fish_id']), link=mode)
+                        continue
                     # move dlm files
                     for index, row in exp_metadata.iterrows():
                         if row['genotype'] == 'tau':
@@ -170,10 +144,14 @@ def main(root):
                         else:
                             path = path_q_sibs
                         dest = os.path.join(path,str(row['fish_id']),f"{row['filename']}.dlm")
-                        shutil.copyfile(row['dlm_loc'],dest)
+                        copy_list.append((row['dlm_loc'],dest))
                         dest = os.path.join(path,str(row['fish_id']),f"{row['filename']} parameters.ini")
-                        shutil.copyfile(row['ini_loc'],dest)
-                print("new data organized. please to archive ori data files!")
+                        copy_list.append((row['ini_loc'],dest))
+                if mode == 'copy':
+                    copy_files(copy_list, report_dir=root_quantified[0])
+                    print("new data organized. please to archive ori data files!")
+                else:
+                    print(f"new data arranged in {DATA_MANIFEST}. please keep ori data files where they are!")
                 break
             else:
                 confirm = input("- Proceed? (y/n): ")
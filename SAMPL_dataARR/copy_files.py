@@ -0,0 +1,126 @@
+'''
+What:
+    Copy engine for the arrangement scripts (arr_HC.py, arr_SF.py, arr_TauLong.py, arr_WT_lightcond.py)
+How:
+    Files are copied COPY_THREADS at a time, as copies from acquisition machines and network volumes wait on latency more than on bandwidth
+    Each file is streamed in CHUNK_BYTES chunks into "<dest>.part", hashed (md5) while copying, then renamed to <dest> and verified by hashing <dest> again
+    Modification times are kept, so that copied .dlm files are recognized by resumed analysis (dlm results)
+    Files already copied are skipped: same size and modification time, or same size and md5 if the time differs
+    A failed copy leaves no <dest> and is listed in the report, the other files are still copied
+    Progress is shown in bytes
+What does it need from you:
+    Rerun the arrangement script if any file failed, copied files are skipped
+'''
+
+import os
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from tqdm import tqdm
+
+COPY_THREADS = 8
+CHUNK_BYTES = 2**23  # 8 MB
+COPY_REPORT = 'SAMPL copy report.csv'
+
+def get_checksum(file):
+    '''
+    md5 of a file, read in chunks
+    '''
+    md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def is_copied(source, dest):
+    '''
+    whether dest is a complete copy of source
+    '''
+    if not os.path.exists(dest):
+        return False
+    source_stat, dest_stat = os.stat(source), os.stat(dest)
+    if source_stat.st_size != dest_stat.st_size:
+        return False
+    if source_stat.st_mtime == dest_stat.st_mtime:
+        return True
+    return get_checksum(source) == get_checksum(dest)
+
+def copy_file(source, dest, progress=None):
+    '''
+    copy one file through "<dest>.part" and verify it
+    progress: tqdm in bytes, updated after each chunk
+    returns md5 of the file
+    '''
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    part = dest + '.part'
+    md5 = hashlib.md5()
+    try:
+        with open(source, 'rb') as f_source, open(part, 'wb') as f_dest:
+            for chunk in iter(lambda: f_source.read(CHUNK_BYTES), b''):
+                f_dest.write(chunk)
+                md5.update(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+        shutil.copystat(source, part)
+        os.replace(part, dest)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    checksum = md5.hexdigest()
+    if get_checksum(dest) != checksum:
+        os.remove(dest)
+        raise OSError(f"checksum of {dest} does not match {source}")
+    return checksum
+
+def copy_task(source, dest, progress):
+    '''
+    copy one file unless already copied
+    returns a row of the copy report
+    '''
+    row = {'source':source, 'dest':dest, 'status':'copied', 'bytes':0, 'md5':'', 'message':''}
+    try:
+        if is_copied(source, dest):
+            progress.update(os.path.getsize(source))
+            return {**row, 'status':'skipped'}
+        return {**row, 'bytes':os.path.getsize(source), 'md5':copy_file(source, dest, progress)}
+    except OSError as error:
+        return {**row, 'status':'failed', 'message':str(error)}
+
+def copy_files(copy_list, report_dir=None, threads=COPY_THREADS):
+    '''
+    copy files in parallel
+    copy_list: list of (source, dest)
+    report_dir: folder to save "SAMPL copy report.csv". not saved if None
+    returns the copy report, one row per file
+    '''
+    # the same file may be listed twice, e.g. matching two conditions
+    copy_list = list(dict.fromkeys(copy_list))
+    total_bytes = sum(os.path.getsize(source) for source, _ in copy_list if os.path.exists(source))
+    with tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024, desc='- Copying') as progress:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            tasks = [executor.submit(copy_task, source, dest, progress) for source, dest in copy_list]
+            report = pd.DataFrame([task.result() for task in as_completed(tasks)], columns=['source','dest','status','bytes','md5','message'])
+    report = report.sort_values(by='dest').reset_index(drop=True)
+    if report_dir is not None:
+        report.to_csv(os.path.join(report_dir, COPY_REPORT))
+    failed = report.loc[report['status'] == 'failed']
+    print(f"- {(report['status'] == 'copied').sum()} files copied, {(report['status'] == 'skipped').sum()} skipped, {len(failed)} failed")
+    for index, row in failed.iterrows():
+        print(f"  failed: {row['source']}: {row['message']}")
+    return report
+
+def get_folder_size(folder):
+    '''
+    total size of files in a folder, in bytes. subfolders are not included
+    '''
+    # DirEntry.stat() reuses the directory listing on Windows, one request per folder on network volumes
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+def get_folder_sizes(folders, threads=COPY_THREADS):
+    '''
+    sizes of folders in parallel
+    returns a dict of folder: size in bytes
+    '''
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(folders, executor.map(get_folder_size, folders)))
@@ -19,6 +19,7 @@ if_jackknnife = False # Whether to jackknife (bool)
 import os
 import pandas as pd
 from plot_functions.plt_tools import round_half_up 
+from plot_functions.get_conditions import get_conditions
 import numpy as np 
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -74,13 +75,8 @@ defaultPlotting()
 set_font_type()
 # %%
 # main function
-all_conditions = []
-folder_paths = []
-# get the name of all folders under root
-for folder in os.listdir(root):
-    if folder[0] != '.':
-        folder_paths.append(root+'/'+folder)
-        all_conditions.append(folder)
+# get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+all_conditions, folder_paths = get_conditions(root)
 
 bins = list(range(-90,95,5))
 
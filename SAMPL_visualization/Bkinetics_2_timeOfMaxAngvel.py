@@ -11,13 +11,14 @@ import os
 from pickle import FRAME
 import pandas as pd
 from plot_functions.plt_tools import round_half_up 
+from plot_functions.get_conditions import get_conditions, walk_exps
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from plot_functions.get_data_dir import (get_data_dir, get_figure_dir)
 from plot_functions.plt_tools import (set_font_type, day_night_split)
 from plot_functions.get_index import (get_index)
-from plot_functions.get_bout_features import get_bout_features
+from plot_functions.get_bout_features import (get_bout_features, max_angvel_time_kernel)
 from plot_functions.get_bout_kinetics import get_kinetics
 from scipy.signal import savgol_filter
 from scipy import stats
@@ -74,16 +75,14 @@ exp_data_all = pd.DataFrame()
 
 
 
-for folder in os.listdir(root):
-    if folder[0] != '.':
-        folder_paths.append(root+'/'+folder)
-        all_conditions.append(folder)
+# get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+all_conditions, folder_paths = get_conditions(root)
 # calculate indicies
 idxRANGE = [peak_idx-round_half_up(BEFORE_PEAK*FRAME_RATE),peak_idx+round_half_up(AFTER_PEAK*FRAME_RATE)]
 
 for condition_idx, folder in enumerate(folder_paths):
     # enter each condition folder (e.g. 7dd_ctrl)
-    for subpath, subdir_list, subfile_list in os.walk(folder):
+    for subpath, subdir_list, subfile_list in walk_exps(folder):
         # if folder is not empty
         if subdir_list:
             # reset for each condition
@@ -262,13 +261,11 @@ for this_cond0 in all_cond0:
 
 # %%
 print("calculate maxAngvelTime on averaged traces of each exp repeat")
-mean_angAccel = exp_data_all.groupby(['time_ms','expNum','cond0','cond1'])['adj_angvel'].median().reset_index()
-mean_angAccel = mean_angAccel.loc[mean_angAccel['time_ms']<0]
-idx_mean_max = mean_angAccel.groupby(['expNum','cond0','cond1'])['adj_angvel'].apply(
-    lambda y: np.argmax(y)
-)
-time_by_bout_max = ((idx_mean_max/166 - BEFORE_PEAK)*1000).reset_index()
-time_by_bout_max.columns = ['expNum','cond0','cond1','time_adj_angvel (ms)']
+# exp_data_all is one bout after another, reshape into (bouts, frames) and get median traces of all repeats at once
+adj_angvel = exp_data_all['adj_angvel'].values.reshape(-1, idxRANGE[1]-idxRANGE[0])
+bout_groups = exp_data_all.loc[exp_data_all['idx']==idxRANGE[0], ['cond0','cond1','expNum']]
+_, time_by_bout_max, time_by_jackknife = max_angvel_time_kernel(adj_angvel, bout_groups, FRAME_RATE, BEFORE_PEAK, jackknife=True)
+time_by_bout_max = time_by_bout_max.rename(columns={'max_angvel_time':'time_adj_angvel (ms)'})
 time_of_peak__byBout_mean = time_by_bout_max['time_adj_angvel (ms)'].mean()
 
 plt.figure(figsize=(3,2))
@@ -282,4 +279,5 @@ g = sns.catplot(
 sns.despine()
 plt.savefig(os.path.join(fig_dir,f"timeOfMaxAngvel_byExp.pdf"),format='PDF')
 plt.show()
-print(f"Time of the peak angular accel by Exp mean = {time_of_peak__byBout_mean}±{time_by_bout_max['time_adj_angvel (ms)'].values.std()} ms")
\ No newline at end of file
+print(f"Time of the peak angular accel by Exp mean = {time_of_peak__byBout_mean}±{time_by_bout_max['time_adj_angvel (ms)'].values.std()} ms")
+print(f"Time of the peak angular accel by jackknife = {time_by_jackknife['max_angvel_time'].mean()}±{time_by_jackknife['max_angvel_time'].values.std()} ms")
\ No newline at end of file
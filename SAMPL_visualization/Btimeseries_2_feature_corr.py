@@ -14,6 +14,7 @@ import os,glob
 from pickle import FRAME
 import pandas as pd
 from plot_functions.plt_tools import round_half_up 
+from plot_functions.get_conditions import get_conditions, walk_exps
 import numpy as np 
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -111,13 +112,8 @@ idx_end = round_half_up(peak_idx + T_END * FRAME_RATE)
 idx_dur250ms = round_half_up(250/1000*FRAME_RATE)
 idx_dur275ms = round_half_up(275/1000*FRAME_RATE)
 # %%
-all_conditions = []
-folder_paths = []
-# get the name of all folders under root
-for folder in os.listdir(root):
-    if folder[0] != '.':
-        folder_paths.append(root+'/'+folder)
-        all_conditions.append(folder)
+# get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+all_conditions, folder_paths = get_conditions(root)
 
 all_around_peak_data = pd.DataFrame()
 all_cond0 = []
@@ -126,7 +122,7 @@ all_cond1 = []
 # go through each condition folders under the root
 for condition_idx, folder in enumerate(folder_paths):
     # enter each condition folder (e.g. 7dd_ctrl)
-    for subpath, subdir_list, subfile_list in os.walk(folder):
+    for subpath, subdir_list, subfile_list in walk_exps(folder):
         # if folder is not empty
         if subdir_list:
             # reset for each condition
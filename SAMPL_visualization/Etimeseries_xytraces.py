@@ -1,6 +1,7 @@
 '''
 Plots single epoch x y position in mm
 Require analyzed epoch containing one or more bouts. Requires all_data.h5
+Only the epoch index is loaded. Data of the selected epoch is read from all_data.h5 when plotting
 Input directory needs to be a folder containing analyzed dlm data.
 '''
 
@@ -18,6 +19,7 @@ from plot_functions.get_bout_kinetics import get_kinetics
 from plot_functions.get_IBIangles import get_IBIangles
 from plot_functions.plt_tools import (jackknife_mean,set_font_type, defaultPlotting,distribution_binned_average)
 from plot_functions.get_bout_kinetics import get_bout_kinetics
+from plot_functions.get_epoch_data import (get_epoch_index, fetch_epochs)
 
 ##### Parameters to change #####
 pick_data = 'tmp' # name of your dataset to plot as defined in function get_data_dir()
@@ -65,41 +67,38 @@ def extract_epochs(root):
     if len(all_dir) > 1:
         all_dir = all_dir[1:]
 
+    # read epoch index only. epoch data are fetched when plotting
     epoch_info_all = pd.DataFrame()
-    epoch_data_all = pd.DataFrame()
     for exp_num, exp_path in enumerate(all_dir):
-        # get pitch                
-        all_data = pd.read_hdf(f"{exp_path}/all_data.h5", key='grabbed_all')
-
-        exp_data = all_data.loc[:,all_features.keys()]
-        exp_data = exp_data.rename(columns=all_features)
-        exp_data = exp_data.assign(
-            exp_num = exp_num,
-            epochNum = all_data['epochNum'].values,
-            deltaT = all_data['deltaT'].values
-        )
-        
-        epoch_info = exp_data.groupby('epochNum').size().reset_index()
-
-        epoch_info = epoch_info.rename(columns={
-            'epochNum':'epoch_num',
-            0:'frame_num',
-        })
-        epoch_info.reset_index(drop=True)
+        epoch_info = get_epoch_index(exp_path)
+        epoch_info = epoch_info.rename(columns={'epochNum':'epoch_num'})
         epoch_info = epoch_info.assign(
+            epoch_i = epoch_info.index,
             idx = np.arange(0,len(epoch_info))+1,
             duration = epoch_info['frame_num']/FRAME_RATE,
             exp_num = exp_num,
+            exp_path = exp_path,
         )
         epoch_info_all = pd.concat([epoch_info_all,epoch_info], ignore_index=True)
-        epoch_data_all = pd.concat([epoch_data_all,exp_data], ignore_index=True)
         
     epoch_info_all = epoch_info_all.sort_values(by='duration',ascending=False)
     epoch_info_all = epoch_info_all.reset_index(drop=True)
     print(f'{len(epoch_info_all)} epochs detected. Sorted from long to short.')
-    return epoch_data_all, epoch_info_all
+    return epoch_info_all, all_features
+
+def fetch_epoch_toplt(toplt, all_features):
+    epoch_data = fetch_epochs(toplt['exp_path'], toplt['epoch_i'], toplt['epoch_i'],
+                              columns=list(all_features.keys())+['epochNum','deltaT'])
+    exp_data = epoch_data.loc[:,all_features.keys()]
+    exp_data = exp_data.rename(columns=all_features)
+    exp_data = exp_data.assign(
+        exp_num = toplt['exp_num'],
+        epochNum = epoch_data['epochNum'].values,
+        deltaT = epoch_data['deltaT'].values
+    )
+    return exp_data
 
-epoch_data_all, epoch_info_all = extract_epochs(root)
+epoch_info_all, all_features = extract_epochs(root)
 
 # %%
 
@@ -111,7 +110,7 @@ epoch_number = input(f"which epoch to plot? 0-{len(epoch_info_all)-1}, 'n' to st
 while epoch_number != 'n':
     which_toplt = int(epoch_number)
     toplt = epoch_info_all.loc[which_toplt,:]
-    data_toplt = epoch_data_all.loc[(epoch_data_all['exp_num']==toplt['exp_num']) & (epoch_data_all['epochNum']==round_half_up(toplt['epoch_num'])), :]
+    data_toplt = fetch_epoch_toplt(toplt, all_features)
 
     data_toplt = data_toplt.assign(
         time_s = np.cumsum(data_toplt['deltaT'])
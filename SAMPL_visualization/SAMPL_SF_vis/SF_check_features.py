@@ -11,6 +11,7 @@ import os
 
 import pandas as pd
 from plot_functions.plt_tools import round_half_up 
+from plot_functions.get_conditions import get_conditions
 import numpy as np 
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -71,7 +72,7 @@ folder_paths = []
 metadata_files = []
 # get the name of all folders under root
 
-for folder in os.listdir(root):
+for folder in get_conditions(root)[0]:
     if folder[0] != '.':
         path = os.path.join(root,folder)
         for ele in os.listdir(path):
@@ -1,6 +1,7 @@
 import os,glob
 import pandas as pd
 from plot_functions.plt_tools import round_half_up 
+from plot_functions.get_conditions import get_conditions, walk_exps
 import numpy as np 
 from plot_functions.plt_tools import (day_night_split)
 from plot_functions.get_index import get_index
@@ -19,13 +20,8 @@ def get_IBIangles(root, FRAME_RATE,**kwargs):
         if key == 'ztime':
             which_zeitgeber = value
             
-    all_conditions = []
-    folder_paths = []
-    # get the name of all folders under root
-    for folder in os.listdir(root):
-        if folder[0] != '.':
-            folder_paths.append(root+'/'+folder)
-            all_conditions.append(folder)
+    # get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+    all_conditions, folder_paths = get_conditions(root)
 
     all_feature_cond = pd.DataFrame()
     all_cond0 = []
@@ -33,7 +29,7 @@ def get_IBIangles(root, FRAME_RATE,**kwargs):
     # go through each condition folders under the root
     for condition_idx, folder in enumerate(folder_paths):
         # enter each condition folder (e.g. 7dd_ctrl)
-        for subpath, subdir_list, subfile_list in os.walk(folder):
+        for subpath, subdir_list, subfile_list in walk_exps(folder):
             # if folder is not empty
             if subdir_list:
                 subdir_list.sort()
@@ -2,6 +2,7 @@ import os,glob
 from pickle import FRAME
 import pandas as pd
 from plot_functions.plt_tools import round_half_up 
+from plot_functions.get_conditions import get_conditions, walk_exps
 import numpy as np 
 from plot_functions.plt_tools import (day_night_split)
 from plot_functions.get_index import get_index
@@ -190,13 +191,8 @@ def get_bout_features(root:str, FRAME_RATE:int, **kwargs):
         elif key == 'max_angvel_time':
             max_angvel_df = value
 
-    all_conditions = []
-    folder_paths = []
-    # get the name of all folders under root
-    for folder in os.listdir(root):
-        if folder[0] != '.':
-            folder_paths.append(root+'/'+folder)
-            all_conditions.append(folder)
+    # get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+    all_conditions, folder_paths = get_conditions(root)
 
     all_feature_cond = pd.DataFrame()
     all_cond0 = []
@@ -206,7 +202,7 @@ def get_bout_features(root:str, FRAME_RATE:int, **kwargs):
         cond0 = all_conditions[condition_idx].split("_")[0]
         cond1 = all_conditions[condition_idx].split("_")[1]
         # enter each condition folder (e.g. 7dd_ctrl)
-        for subpath, subdir_list, subfile_list in os.walk(folder):
+        for subpath, subdir_list, subfile_list in walk_exps(folder):
             # if folder is not empty
             if subdir_list:
                 # reset for each condition
@@ -239,8 +235,8 @@ def get_bout_features(root:str, FRAME_RATE:int, **kwargs):
                         bout_num = trunc_exp_data.groupby(np.arange(len(trunc_exp_data))//(idxRANGE[1]-idxRANGE[0])).ngroup()
                     )
                     if not max_angvel_df.empty:
-                        max_angvel_time = max_angvel_df.query("cond1 == @cond1 and cond2 == @cond2")['max_angvel_time'].item()
-                        max_angvel_idx = round_half_up(peak_idx + max_angvel_time/1000*FRAME_RATE)
+                        # max_angvel_idx is calculated by get_max_angvel_rot()
+                        max_angvel_idx = max_angvel_df.query("cond1 == @cond1 and cond0 == @cond0")['max_angvel_idx'].item()
                         this_exp_features = extract_bout_features_v5(trunc_exp_data,peak_idx,FRAME_RATE,idx_max_angvel=max_angvel_idx)
                     else:
                         this_exp_features = extract_bout_features_v5(trunc_exp_data,peak_idx,FRAME_RATE)
@@ -267,123 +263,191 @@ def get_bout_features(root:str, FRAME_RATE:int, **kwargs):
     return all_feature_cond, all_cond0, all_cond1
 
 
+def get_aligned_tensor(exp_path:str, total_aligned:int, idxRANGE:list, columns:list, **kwargs):
+    """read prop_bout_aligned of one experiment as a (bouts, frames, columns) array
+
+    Args:
+        exp_path (str): experiment folder containing bout_data.h5
+        total_aligned (int): number of frames per aligned bout
+        idxRANGE (list): [first, last) frame index to keep for each bout
+        columns (list): columns of prop_bout_aligned to keep
+
+    Returns:
+        np.ndarray: aligned values, shape (n_bouts, idxRANGE[1]-idxRANGE[0], len(columns))
+        pd.DataFrame: prop_bout2 rows of the bouts kept
+    """
+    which_zeitgeber = 'day'
+    for key, value in kwargs.items():
+        if key == 'ztime':
+            which_zeitgeber = value
+    raw = pd.read_hdf(f"{exp_path}/bout_data.h5", key='prop_bout_aligned', columns=columns)
+    bout_time = pd.read_hdf(f"{exp_path}/bout_data.h5", key='prop_bout2').loc[:,['aligned_time']]
+    # one row per frame, total_aligned frames per bout. reshape instead of slicing rows bout by bout
+    aligned = raw[columns].to_numpy(dtype=np.float64).reshape(-1, total_aligned, len(columns))
+    bout_time = day_night_split(bout_time,'aligned_time',ztime=which_zeitgeber)
+    return aligned[bout_time.index.values, idxRANGE[0]:idxRANGE[1], :], bout_time
+
+def get_adj_angvel(pitch:np.ndarray, FRAME_RATE:int, adj_window:list):
+    """smoothed angular velocity of every bout, sign adjusted by the direction of rotation during acceleration
+
+    Args:
+        pitch (np.ndarray): aligned pitch, shape (n_bouts, n_frames)
+        FRAME_RATE (int): 
+        adj_window (list): (start, end) frame positions (exclusive) to determine the sign of rotation
+
+    Returns:
+        np.ndarray: adjusted angular velocity, shape (n_bouts, n_frames). First frame is NaN
+    """
+    # same as applying savgol_filter() and np.diff() bout by bout
+    angvel_sm = np.diff(savgol_filter(pitch, 11, 3, axis=1), axis=1, prepend=np.nan)*FRAME_RATE
+    accel_angvel_mean = np.nanmean(angvel_sm[:, adj_window[0]+1:adj_window[1]], axis=1)
+    adj_by_angvel = accel_angvel_mean/np.absolute(accel_angvel_mean)
+    return angvel_sm * adj_by_angvel[:, np.newaxis]
+
+def max_angvel_time_kernel(adj_angvel:np.ndarray, bout_groups:pd.DataFrame, FRAME_RATE:int, BEFORE_PEAK:float, **kwargs):
+    """time of max angvel on median traces of each condition and each experiment repeat
+
+    Median traces are calculated on the (bouts, frames) array for all groups at once.
+    If jackknife=True, also returns time of max angvel of every leave-one-repeat-out group.
+
+    Args:
+        adj_angvel (np.ndarray): adjusted angular velocity, shape (n_bouts, n_frames), starting at -BEFORE_PEAK
+        bout_groups (pd.DataFrame): one row per bout, columns 'cond0', 'cond1', 'expNum'
+        FRAME_RATE (int): 
+        BEFORE_PEAK (float): time (s) before the peak speed of the first frame
+
+    Returns:
+        pd.DataFrame: time of max angvel by condition, columns 'cond1', 'cond0', 'max_angvel_time'
+        pd.DataFrame: time of max angvel by exp repeat, columns 'cond1', 'cond0', 'expNum', 'max_angvel_time'
+        pd.DataFrame: time of max angvel by jackknife group, columns 'cond1', 'cond0', 'jackknife_idx', 'max_angvel_time'
+    """
+    if_jackknife = False
+    for key, value in kwargs.items():
+        if key == 'jackknife':
+            if_jackknife = value
+    # only look for peaks before time of the peak speed. skip the first frame, which is NaN after np.diff()
+    n_frames = round_half_up(BEFORE_PEAK*FRAME_RATE)
+    traces = adj_angvel[:, 1:n_frames]
+    get_time = lambda median_traces: ((np.nanargmax(median_traces, axis=1)+1)/FRAME_RATE - BEFORE_PEAK)*1000
+    bout_groups = bout_groups.reset_index(drop=True)
+
+    by_cond = []
+    by_exp = []
+    by_jackknife = []
+    for (cond1, cond0), cond_bouts in bout_groups.groupby(['cond1','cond0'], sort=True):
+        cond_traces = traces[cond_bouts.index.values]
+        cond_exp = cond_bouts['expNum'].values
+        all_exp = np.unique(cond_exp)
+        by_cond.append(pd.DataFrame({
+            'cond1':[cond1],
+            'cond0':[cond0],
+            'max_angvel_time':get_time(np.nanmedian(cond_traces, axis=0)[np.newaxis,:]),
+        }))
+        # median trace of each repeat
+        exp_median = np.stack([np.nanmedian(cond_traces[cond_exp == exp], axis=0) for exp in all_exp])
+        by_exp.append(pd.DataFrame({
+            'cond1':cond1,
+            'cond0':cond0,
+            'expNum':all_exp,
+            'max_angvel_time':get_time(exp_median),
+        }))
+        if if_jackknife and len(all_exp) > 1:
+            # median trace of all bouts except those from one repeat
+            jackknife_median = np.stack([np.nanmedian(cond_traces[cond_exp != exp], axis=0) for exp in all_exp])
+            by_jackknife.append(pd.DataFrame({
+                'cond1':cond1,
+                'cond0':cond0,
+                'jackknife_idx':all_exp,
+                'max_angvel_time':get_time(jackknife_median),
+            }))
+    time_by_cond = pd.concat(by_cond, ignore_index=True)
+    time_by_exp = pd.concat(by_exp, ignore_index=True)
+    if by_jackknife:
+        time_by_jackknife = pd.concat(by_jackknife, ignore_index=True)
+    else:
+        time_by_jackknife = pd.DataFrame(columns=['cond1','cond0','jackknife_idx','max_angvel_time'])
+    return time_by_cond, time_by_exp, time_by_jackknife
+
 def get_max_angvel_rot(root, FRAME_RATE,**kwargs):
+    """time of max adjusted angvel for each condition. Calculated on median traces of each exp repeat, then averaged
+
+    Args:
+        root (str): input directory
+        FRAME_RATE (int): 
+        ztime (str, optional): 'day', 'night' or 'all'. Defaults to 'day'
+        jackknife (bool, optional): average over jackknife groups instead of individual repeats. Defaults to False
+
+    Returns:
+        pd.DataFrame: max_angvel_time (ms) and max_angvel_idx for each condition, to be passed to get_bout_features(max_angvel_time=)
+        list: all_cond0
+        list: all_cond1
+    """
     peak_idx , total_aligned = get_index(FRAME_RATE)
     idx_pre_bout = round_half_up(peak_idx - 0.1 * FRAME_RATE)
     idx_mid_accel = round_half_up(peak_idx - 0.05 * FRAME_RATE)
 
     BEFORE_PEAK = 0.3 # s
     AFTER_PEAK = 0.2 #s
-    
-    all_conditions = []
-    folder_paths = []
-    all_cond0 = []
-    all_cond1 = []
-    exp_data_all = pd.DataFrame()
     idxRANGE = [peak_idx-round_half_up(BEFORE_PEAK*FRAME_RATE),peak_idx+round_half_up(AFTER_PEAK*FRAME_RATE)]
 
     # for day night split
     which_zeitgeber = 'day'
+    if_jackknife = False
     for key, value in kwargs.items():
         if key == 'ztime':
             which_zeitgeber = value
+        elif key == 'jackknife':
+            if_jackknife = value
 
-    all_conditions = []
-    folder_paths = []
-    # get the name of all folders under root
-    for folder in os.listdir(root):
-        if folder[0] != '.':
-            folder_paths.append(root+'/'+folder)
-            all_conditions.append(folder)
+    # get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+    all_conditions, folder_paths = get_conditions(root)
 
     all_cond0 = []
     all_cond1 = []
+    all_pitch = []
+    all_bout_groups = []
     # go through each condition folders under the root
     for condition_idx, folder in enumerate(folder_paths):
+        cond0 = all_conditions[condition_idx].split("_")[0]
+        cond1 = all_conditions[condition_idx].split("_")[1]
         # enter each condition folder (e.g. 7dd_ctrl)
-        for subpath, subdir_list, subfile_list in os.walk(folder):
+        for subpath, subdir_list, subfile_list in walk_exps(folder):
             # if folder is not empty
             if subdir_list:
-                # reset for each condition
-                this_cond_data = pd.DataFrame()
                 subdir_list.sort()
                 # loop through each sub-folder (experiment) under each condition
                 for expNum, exp in enumerate(subdir_list):
-                    rows = []
                     exp_path = os.path.join(subpath, exp)
-                    # get pitch                
-                    raw = pd.read_hdf(f"{exp_path}/bout_data.h5", key='prop_bout_aligned')
-                    # assign frame number, total_aligned frames per bout
-                    raw = raw.assign(
-                        idx = round_half_up(len(raw)/total_aligned)*list(range(0,total_aligned)),
-                        )
-                    # - get the index of the rows in exp_data to keep
-                    bout_time = pd.read_hdf(f"{exp_path}/bout_data.h5", key='prop_bout2').loc[:,['aligned_time']]
-                    # for i in bout_time.index:
-                    # # if only need day or night bouts:
-                    for i in day_night_split(bout_time,'aligned_time').index:
-                        rows.extend(list(range(i*total_aligned+idxRANGE[0],i*total_aligned+idxRANGE[1])))
-                    selected_range = raw.loc[rows,:]
-                    # calculate angular speed (smoothed)
-                    grp = selected_range.groupby(np.arange(len(selected_range))//(idxRANGE[1]-idxRANGE[0]))
-                    propBoutAligned_angVel = grp['propBoutAligned_pitch'].apply(
-                        lambda grp_pitch: np.diff(savgol_filter(grp_pitch, 11, 3),prepend=np.array([np.nan]))*FRAME_RATE,
-                    )
-                    propBoutAligned_angVel = propBoutAligned_angVel.apply(pd.Series).T.melt()
-                    # assign angvel and ang speed
-                    selected_range = selected_range.assign(
-                        propBoutAligned_angVel_sm = propBoutAligned_angVel['value'].values,
-                        # propBoutAligned_angSpeed = np.absolute(propBoutAligned_angVel['value'].values),
-                    )
-                    grp = selected_range.groupby(np.arange(len(selected_range))//(idxRANGE[1]-idxRANGE[0]))
-                    accel_angvel_mean = grp.apply(
-                        lambda group: group.loc[(group['idx']>idx_pre_bout)&(group['idx']<idx_mid_accel), 
-                                                'propBoutAligned_angVel_sm'].mean()
-                    )
-                    adj_by_angvel = accel_angvel_mean/np.absolute(accel_angvel_mean)
-                    #|||||||||||||||||||||||||
-                    adj_by_which = adj_by_angvel #adj_by_traj_deviation #  #
-                    #|||||||||||||||||||||||||
-                    
-                    adj_angvel = selected_range['propBoutAligned_angVel_sm'] * (np.repeat(adj_by_which,(idxRANGE[1]-idxRANGE[0])).values)
-
-                    selected_range = selected_range.assign(
-                        adj_angvel = adj_angvel,
-                    )
-
-                    exp_data = selected_range
-                    exp_data = exp_data.assign(
-                        time_ms = (exp_data['idx']-peak_idx)/FRAME_RATE*1000,
-                        expNum = expNum)
-                    this_cond_data = pd.concat([this_cond_data,exp_data.loc[rows,:]])
-                
-        cond0 = all_conditions[condition_idx].split("_")[0]
-        cond1 = all_conditions[condition_idx].split("_")[1]
+                    aligned, bout_time = get_aligned_tensor(exp_path, total_aligned, idxRANGE, ['propBoutAligned_pitch'], ztime=which_zeitgeber)
+                    all_pitch.append(aligned[:,:,0])
+                    all_bout_groups.append(pd.DataFrame({
+                        'cond0':[cond0]*len(aligned),
+                        'cond1':[cond1]*len(aligned),
+                        'expNum':[expNum]*len(aligned),
+                    }))
         all_cond0.append(cond0)
         all_cond1.append(cond1)
-        
-        this_cond_data = this_cond_data.reset_index(drop=True)
-        this_cond_data = this_cond_data.assign(
-            cond0 = cond0,
-            cond1 = cond1,
-        )
-        exp_data_all = pd.concat([exp_data_all,this_cond_data], ignore_index=True)
-    
+
     all_cond0 = list(set(all_cond0))
     all_cond0.sort()
     all_cond1 = list(set(all_cond1))
     all_cond1.sort()
-    
-    # calculate time of max angaccel, mean of each exp, then average
-    mean_angAccel = exp_data_all.groupby(['time_ms','cond1','cond0','expNum'])['adj_angvel'].median().reset_index()
-    mean_angAccel = mean_angAccel.loc[mean_angAccel['time_ms']<0]
-    idx_mean_max = mean_angAccel.groupby(['cond1','cond0','expNum'])['adj_angvel'].apply(
-        lambda y: np.argmax(y)
-    )
-    time_by_bout_max = ((idx_mean_max/FRAME_RATE - BEFORE_PEAK)*1000).reset_index()
-    time_by_bout_max.columns = ['cond1','cond0','expNum','max_angvel_time']
-    max_angvel_time = time_by_bout_max.groupby(['cond1','cond0'])['max_angvel_time'].mean()
+
+    # one (bouts, frames) array for all conditions and repeats
+    adj_angvel = get_adj_angvel(np.concatenate(all_pitch), FRAME_RATE, [idx_pre_bout-idxRANGE[0], idx_mid_accel-idxRANGE[0]])
+    bout_groups = pd.concat(all_bout_groups, ignore_index=True)
+
+    # calculate time of max angvel, median of each exp (or jackknife group), then average
+    _, time_by_exp, time_by_jackknife = max_angvel_time_kernel(adj_angvel, bout_groups, FRAME_RATE, BEFORE_PEAK, jackknife=if_jackknife)
+    if if_jackknife:
+        time_by_group = time_by_jackknife
+    else:
+        time_by_group = time_by_exp
+    max_angvel_time = time_by_group.groupby(['cond1','cond0'])['max_angvel_time'].mean()
     max_angvel_time = max_angvel_time.reset_index()
+    max_angvel_time = max_angvel_time.assign(
+        max_angvel_idx = [round_half_up(peak_idx + t/1000*FRAME_RATE) for t in max_angvel_time['max_angvel_time']]
+    )
     
     return max_angvel_time, all_cond0, all_cond1
 
@@ -405,13 +469,8 @@ def get_connected_bouts(root:str, FRAME_RATE:int, **kwargs):
     # CONSTANTS
     BIN_NUM = 4  # number of speed bins
     SMOOTH = 11
-    all_conditions = []
-    folder_paths = []
-    # get the name of all folders under root
-    for folder in os.listdir(root):
-        if folder[0] != '.':
-            folder_paths.append(root+'/'+folder)
-            all_conditions.append(folder)
+    # get the name of all condition folders under root, or conditions in SAMPL data manifest.csv
+    all_conditions, folder_paths = get_conditions(root)
 
 
     all_around_peak_data = pd.DataFrame()
@@ -422,7 +481,7 @@ def get_connected_bouts(root:str, FRAME_RATE:int, **kwargs):
     # go through each condition folders under the root
     for condition_idx, folder in enumerate(folder_paths):
         # enter each condition folder (e.g. 7dd_ctrl)
-        for subpath, subdir_list, subfile_list in os.walk(folder):
+        for subpath, subdir_list, subfile_list in walk_exps(folder):
             # if folder is not empty
             if subdir_list:
                 subdir_list.sort()
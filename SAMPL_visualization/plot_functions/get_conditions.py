@@ -0,0 +1,52 @@
+import os
+import sys
+# the data manifest format is shared with the analysis pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), 'SAMPL_analysis_multiprocessing'))
+from preprocessing.data_manifest import has_data_manifest, read_manifest_rows
+
+CACHE_FOLDER = 'dlm results'  # results of each .dlm file, saved by the analysis pipeline
+
+def get_conditions(root:str):
+    """get condition folders under root (e.g. 7dd_ctrl), and conditions in SAMPL data manifest.csv if root has one
+
+    Args:
+        root (str): directory of analyzed data
+
+    Returns:
+        list: condition names
+        list: condition folders
+    """
+    all_conditions = [folder for folder in os.listdir(root) if folder[0] != '.' and os.path.isdir(os.path.join(root, folder))]
+    if has_data_manifest(root):
+        # a root may hold copied and manifest experiments
+        all_conditions = sorted(set(all_conditions) | set(read_manifest_rows(root)['condition']))
+    folder_paths = [root+'/'+folder for folder in all_conditions]
+    return all_conditions, folder_paths
+
+def walk_exps(condition_folder:str):
+    """same as os.walk(condition_folder) for looping through experiment folders, without dlm results folders.
+    If the root has SAMPL data manifest.csv, yields analyzed experiments of the condition, in the manifest or copied into the condition folder
+
+    Args:
+        condition_folder (str): output of get_conditions()
+
+    Yields:
+        str: folder containing experiment folders
+        list: names of experiment folders
+        list: file names
+    """
+    root = os.path.dirname(condition_folder)
+    if has_data_manifest(root):
+        manifest = read_manifest_rows(root)
+        exps = set(manifest.loc[manifest['condition'] == os.path.basename(condition_folder), 'exp'])
+        if os.path.isdir(condition_folder):
+            exps |= {entry.name for entry in os.scandir(condition_folder) if entry.is_dir() and entry.name != CACHE_FOLDER}
+        exps = sorted(exps)
+        # not analyzed yet
+        exps = [exp for exp in exps if os.path.exists(os.path.join(condition_folder, exp, 'bout_data.h5'))]
+        yield condition_folder, exps, []
+        return
+    for subpath, subdir_list, subfile_list in os.walk(condition_folder):
+        # not entered by os.walk either
+        subdir_list[:] = [subdir for subdir in subdir_list if subdir != CACHE_FOLDER]
+        yield subpath, subdir_list, subfile_list
@@ -0,0 +1,94 @@
+'''
+Read epoch data (grabbed_all) from all_data.h5 without loading the full table
+Uses the epoch index saved by the analysis code (key = 'epoch_index'), in which row_start:row_stop locate each epoch in grabbed_all.
+For data analyzed by older versions, the epoch index is rebuilt from grabbed_all once per call of get_epoch_index()
+'''
+
+import pandas as pd
+import numpy as np
+
+def get_epoch_index(exp_path):
+    """read epoch index of an analyzed experiment folder
+
+    Args:
+        exp_path (string): folder containing all_data.h5
+
+    Returns:
+        DataFrame: one row per epoch, indexed by epoch order in grabbed_all.
+            columns: epochNum, file, row_start, row_stop, start_time, end_time, frame_num, duration, bout_num, aligned_bout_num
+    """
+    with pd.HDFStore(f"{exp_path}/all_data.h5", mode='r') as store:
+        if '/epoch_index' in store.keys():
+            return store.select('epoch_index')
+        # older versions, no epoch index saved. rebuild from grabbed_all
+        grabbed = store.select('grabbed_all', columns=['epochNum','absTime'])
+    # epochNum is only unique within each dlm file, new epoch starts when epochNum changes
+    epoch_start = np.flatnonzero(np.diff(grabbed['epochNum'].values, prepend=np.nan) != 0)
+    epoch_stop = np.append(epoch_start[1:], len(grabbed))
+    epoch_index = pd.DataFrame({
+        'epochNum':grabbed['epochNum'].values[epoch_start],
+        'file':np.nan,
+        'row_start':epoch_start,
+        'row_stop':epoch_stop,
+        'start_time':grabbed['absTime'].values[epoch_start],
+        'end_time':grabbed['absTime'].values[epoch_stop-1],
+    })
+    epoch_index = epoch_index.assign(
+        frame_num = epoch_stop - epoch_start,
+        duration = (epoch_index['end_time'] - epoch_index['start_time']).dt.total_seconds(),
+        bout_num = np.nan,
+        aligned_bout_num = np.nan,
+    )
+    return epoch_index
+
+def fetch_epochs(exp_path, first, last, columns=None, epoch_index=None):
+    """read epochs first to last (inclusive) from grabbed_all
+
+    Args:
+        exp_path (string): folder containing all_data.h5
+        first (int): first epoch to read, index of the epoch index
+        last (int): last epoch to read, index of the epoch index
+        columns (list, optional): columns to read. Defaults to None (all columns).
+        epoch_index (DataFrame, optional): epoch index from get_epoch_index(). Pass it to avoid reading it again.
+
+    Returns:
+        DataFrame: grabbed_all of selected epochs, with 'epoch_i' column matching the epoch index
+    """
+    if epoch_index is None:
+        epoch_index = get_epoch_index(exp_path)
+    selected = epoch_index.loc[first:last]
+    epoch_data = pd.read_hdf(f"{exp_path}/all_data.h5", key='grabbed_all', columns=columns,
+                             start=selected['row_start'].min(), stop=selected['row_stop'].max())
+    epoch_data = epoch_data.assign(
+        epoch_i = np.repeat(selected.index.values, selected['frame_num'].values)
+    )
+    return epoch_data
+
+def fetch_frames(exp_path, start_time, end_time, columns=None, epoch_index=None):
+    """read frames recorded between start_time and end_time from grabbed_all
+
+    Args:
+        exp_path (string): folder containing all_data.h5
+        start_time (Timestamp or string): e.g. '2023-01-01 10:00:00'
+        end_time (Timestamp or string): frames before end_time are returned
+        columns (list, optional): columns to read. Defaults to None (all columns).
+        epoch_index (DataFrame, optional): epoch index from get_epoch_index(). Pass it to avoid reading it again.
+
+    Returns:
+        DataFrame: grabbed_all of selected frames, with 'epoch_i' column matching the epoch index
+    """
+    if epoch_index is None:
+        epoch_index = get_epoch_index(exp_path)
+    start_time = pd.Timestamp(start_time)
+    end_time = pd.Timestamp(end_time)
+    # epochs from different dlm files may overlap in time. read each run of consecutive epochs at once
+    overlapped = epoch_index.loc[(epoch_index['end_time'] >= start_time) & (epoch_index['start_time'] < end_time)]
+    if columns is not None and 'absTime' not in columns:
+        columns = list(columns) + ['absTime']
+    run_num = np.cumsum(overlapped['row_start'].values != overlapped['row_stop'].shift().values)
+    frames = pd.DataFrame()
+    for _, this_run in overlapped.groupby(run_num):
+        this_data = fetch_epochs(exp_path, this_run.index[0], this_run.index[-1], columns=columns, epoch_index=epoch_index)
+        this_data = this_data.loc[(this_data['absTime'] >= start_time) & (this_data['absTime'] < end_time)]
+        frames = pd.concat([frames, this_data])
+    return frames
@@ -1,6 +1,7 @@
 #%%
 # import sys
 import os
+import sqlite3
 from plot_functions.plt_tools import round_half_up
 import pandas as pd 
 import numpy as np 
@@ -10,6 +11,26 @@ from plot_functions.get_data_dir import ( get_figure_dir)
 from plot_functions.plt_tools import (set_font_type)
 import matplotlib as mpl
 
+INDEX_FILE = 'SAMPL recordings.sqlite'  # saved by SAMPL_analysis_mp(), see SAMPL_analysis_multiprocessing/bout_analysis/recording_index.py
+
+def read_recording_index(root):
+    """read analyzed recordings from SAMPL recordings.sqlite of root, without reading metadata.csv of each experiment
+
+    Args:
+        root (str): directory of analyzed data
+
+    Returns:
+        DataFrame: one row per .dlm file with date, expNum, box_number, num_fish and aligned_bout
+    """
+    with sqlite3.connect(os.path.join(root, INDEX_FILE)) as connection:
+        all_metadata = pd.read_sql("SELECT exp, start_time, box_number, num_fish, aligned_bout FROM recordings WHERE status = 'analyzed'", connection)
+    connection.close()
+    all_metadata = all_metadata.assign(
+        expNum = all_metadata['exp'],
+        date = pd.to_datetime(all_metadata['start_time']).dt.strftime('%y%m%d').astype(int),
+    )
+    return all_metadata[['date','expNum','box_number','num_fish','aligned_bout']]
+
 
 def Fig2_throughput(root):
     set_font_type()
@@ -24,32 +45,35 @@ def Fig2_throughput(root):
         pass
 
     # %% get total box number
-    folder_dir_list = []
-    for folder in os.listdir(root):
-        if folder.startswith("."):
-            pass
-        else:
-            folder_dir_list.append(os.path.join(root,folder))
-
-    metadata_list = []  
-    menadata_name_list = []
-    for folder_dir in folder_dir_list:
-        for item in os.listdir(folder_dir):
-            if item.endswith("metadata.csv"):
-                metadata_list.append(os.path.join(folder_dir,item))
-                menadata_name_list.append(item)
-        
-    all_metadata = pd.DataFrame()       
-    for i, metadata_file in enumerate(metadata_list):
-        df = pd.read_csv(metadata_file, index_col=0)
-        df = df.assign(
-            expNum = menadata_name_list[i][0:-13]
-        )
-        all_metadata = pd.concat([all_metadata,df],ignore_index=True)
-        
-    all_metadata = all_metadata.assign(
-        date = [int(filename[0:6]) for filename in all_metadata["filename"]]
-    ) 
+    if os.path.exists(os.path.join(root, INDEX_FILE)):
+        all_metadata = read_recording_index(root)
+    else:
+        folder_dir_list = []
+        for folder in os.listdir(root):
+            if folder.startswith(".") or not os.path.isdir(os.path.join(root,folder)):
+                pass
+            else:
+                folder_dir_list.append(os.path.join(root,folder))
+
+        metadata_list = []  
+        menadata_name_list = []
+        for folder_dir in folder_dir_list:
+            for item in os.listdir(folder_dir):
+                if item.endswith("metadata.csv"):
+                    metadata_list.append(os.path.join(folder_dir,item))
+                    menadata_name_list.append(item)
+            
+        all_metadata = pd.DataFrame()       
+        for i, metadata_file in enumerate(metadata_list):
+            df = pd.read_csv(metadata_file, index_col=0)
+            df = df.assign(
+                expNum = menadata_name_list[i][0:-13]
+            )
+            all_metadata = pd.concat([all_metadata,df],ignore_index=True)
+            
+        all_metadata = all_metadata.assign(
+            date = [int(filename[0:6]) for filename in all_metadata["filename"]]
+        ) 
 
     bout_number24h = all_metadata.groupby(['date','expNum','box_number']).sum()
 